@@ -1,13 +1,22 @@
+import asyncio
 import os
 from typing import Optional
 
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse, RedirectResponse
+from loguru import logger
 
 from breadinfer import inference
+from breadinfer.cache import resultcache
+from db.models import authorcache, leaderboardcache, writequeue
 from discordroutes.botevents import bot
+from discordroutes import download, prefilter
+from discordroutes.bread import inferenceadmission, rescore_bread_messages
+from plots.plots import plotcache
 
 router = APIRouter()
+# Only one reinit (load + swap) at a time
+_reinit_lock = asyncio.Lock()
 
 
 @router.get("/status")
@@ -41,6 +50,10 @@ async def set_infer_confidence(
     OVERRIDE_DETECTION_CONFIDENCE: Optional[float] = None,
 ):
     """Endpoint to set bread inference confidences.Note that this will NOT reinstantiate the inference handler
+    Models always run at INFERENCE_FLOOR_CONFIDENCE, these are filters applied to the raw predictions,
+    so they apply right away without re-running inference. Use /rescore to apply them to stored messages.
+    Stored predictions only keep masks over INFERENCE_STORED_SEG_CONFIDENCE: seg confidences under it
+    only apply to new messages
 
     Args:
         MIN_BREAD_LABEL_CONFIDENCE (float, optional): Float, 0 to 1
@@ -70,6 +83,20 @@ async def set_infer_confidence(
     return {"status": "ok"}
 
 
+@router.post("/rescore")
+async def rescore():
+    """Recomputes labels and roundness of every stored message under the current confidences,
+    using the stored raw predictions (the models are not run)
+
+    Returns:
+        json: status ok and number of rescored messages
+    """
+    loop = asyncio.get_event_loop()
+    rescored = await loop.run_in_executor(None, rescore_bread_messages)
+    plotcache.clear()  # History plots show the old scores
+    return {"status": "ok", "rescored": rescored}
+
+
 @router.post("/setroboflowargs")
 async def set_roboflow_args(
     roboflow_endpoint: Optional[str] = "https://outline.roboflow.com",
@@ -96,16 +123,100 @@ async def reinit_inference(
     local_det_model: Optional[str] = "breadv7m-det.pt",
     http_seg_model: Optional[str] = "bread-segmentation-hfhm8/4",
     local_seg_model: Optional[str] = "breadsegv4m-seg.pt",
+    backend: Optional[str] = None,
+    variant: Optional[str] = None,
 ):
-    # Reinit the inference model with new parameters
-    inference.inferhandler = inference.InferenceHandler(
-        local=local,
-        http_det_model=http_det_model,
-        http_seg_model=http_seg_model,
-        local_det_model=local_det_model,
-        local_seg_model=local_seg_model,
-    )
-    return {"status": "ok"}
+    """Reinit the inference models with new parameters, without downtime.
+    The new handler is loaded and warmed up in the background while the current one keeps serving,
+    then they are swapped. Requests already sent to the old handler finish on it before it is shut down
+
+    Args:
+        backend (str, optional): pytorch, onnx or openvino. Defaults to INFERENCE_BACKEND.
+        variant (str, optional): fp32 or int8. Defaults to INFERENCE_MODEL_VARIANT.
+
+    Returns:
+        json: status ok, model id, load time (s) and warmup latency (ms) of the new handler
+    """
+    async with _reinit_lock:
+        handler = inference.InferenceHandler(
+            local=local,
+            http_det_model=http_det_model,
+            http_seg_model=http_seg_model,
+            local_det_model=local_det_model,
+            local_seg_model=local_seg_model,
+            workers=int(os.environ.get("INFERENCE_WORKERS", 0)),
+            backend=backend or os.environ.get("INFERENCE_BACKEND", "pytorch"),
+            variant=variant or os.environ.get("INFERENCE_MODEL_VARIANT", "fp32"),
+        )
+        loop = asyncio.get_event_loop()
+        try:
+            status = await loop.run_in_executor(None, handler.warmup)
+        except Exception as e:
+            logger.error(f"Couldn't load the new inference models: {e}")
+            handler.shutdown()
+            return JSONResponse(
+                status_code=500, content={"status": "error", "detail": str(e)}
+            )
+        # Swap: new requests pick the new handler up. Requests that got the old one but haven't submitted yet
+        # are forwarded to the new one by its closed batcher, so once the submitted ones are done nothing
+        # can reach the old models anymore
+        old_handler, inference.inferhandler = inference.inferhandler, handler
+        old_handler.batcher.close()
+        await old_handler.batcher.drain()
+        old_handler.shutdown()
+    return {"status": "ok", **status}
+
+
+@router.get("/inferencestatus")
+async def inference_status():
+    """Load state of the current inference handler
+
+    Returns:
+        json: model id, whether it's loaded, load time (s) and warmup latency (ms)
+    """
+    return inference.inferhandler.status()
+
+
+@router.get("/inferencemetrics")
+async def inference_metrics():
+    """Inference metrics: admission (queue depth, wait times and rejections), micro-batching (batch sizes, queue
+    depth and wait times) and result cache
+
+    Returns:
+        json: metrics of the current inference handler
+    """
+    return {
+        "admission": inferenceadmission.stats(),
+        "batching": inference.inferhandler.batcher.stats(),
+        "cache": resultcache.stats(),
+    }
+
+
+@router.get("/dbmetrics")
+async def db_metrics():
+    """Database metrics: write-behind queue (queue depth, coalesced writes and flush latency), author, leaderboard
+    and history plot caches
+
+    Returns:
+        json: metrics of the write queue and caches
+    """
+    return {
+        "writequeue": writequeue.stats(),
+        "authorcache": authorcache.stats(),
+        "leaderboardcache": leaderboardcache.stats(),
+        "plotcache": plotcache.stats(),
+    }
+
+
+@router.get("/messagemetrics")
+async def message_metrics():
+    """Discord messages received, routed (command, bread, areyousure) and dropped by each pre-filter stage,
+    attachments downloaded and rejected (with the bytes that weren't downloaded)
+
+    Returns:
+        json: counters
+    """
+    return {"prefilter": prefilter.stats(), "downloads": download.stats()}
 
 
 @router.get("/checkcuda")
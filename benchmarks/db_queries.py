@@ -0,0 +1,114 @@
+"""Stats queries benchmark on a synthetic messages table at every schema version: 1 (no indexes), 2 (indexes), 3
+(materialized stats, queries that don't exist yet at a version are skipped) and 4 (stats tables row counts)
+
+Run from the repo root: python -m benchmarks.db_queries [--rows 1000000]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+from loguru import logger
+
+
+def fill(conn: sqlite3.Connection, rows: int, authors: int = 2000, guilds: int = 20, seed: int = 0) -> None:
+    # Skewed authors (a few post most of the breads), like a real server
+    rng = np.random.default_rng(seed)
+    author_ids = rng.zipf(1.3, rows) % authors
+    roundness = rng.random(rows)
+    data = (
+        (
+            i,
+            f"https://discord.com/channels/{i}",
+            i + 1,
+            int(author_ids[i]),
+            int(author_ids[i]) % 7,
+            int(author_ids[i]) % guilds,
+            float(roundness[i]),
+            "{}",
+        )
+        for i in range(rows)
+    )
+    conn.executemany(
+        "INSERT INTO messages (ogmessage_id, replymessage_jump_url, replymessage_id, author_id, channel_id, guild_id, roundness, labels_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        data,
+    )
+    conn.commit()
+
+
+# User stats computed from messages (before they were materialized), for comparison
+AGGREGATE_USER_STATS_SQL = """
+SELECT
+    agg.count, agg.mean, mn.roundness, mx.roundness,
+    (SELECT COUNT(*) FROM messages WHERE roundness < mx.roundness) AS below,
+    (SELECT COUNT(*) FROM messages WHERE roundness not null) AS total
+FROM (
+    SELECT COUNT(roundness) AS count, AVG(roundness) AS mean FROM messages WHERE author_id = :user_id
+) AS agg
+LEFT JOIN (
+    SELECT roundness FROM messages WHERE author_id = :user_id AND roundness not null ORDER BY roundness ASC LIMIT 1
+) AS mn
+LEFT JOIN (
+    SELECT roundness FROM messages WHERE author_id = :user_id AND roundness not null ORDER BY roundness DESC LIMIT 1
+) AS mx
+"""
+
+
+def time_queries(conn: sqlite3.Connection, queries: list, repeat: int) -> dict:
+    timings = {}
+    for name, sql, params in queries:
+        try:
+            timings[name] = timeit.timeit(lambda: conn.execute(sql, params).fetchall(), number=repeat) / repeat * 1000
+        except sqlite3.OperationalError:
+            timings[name] = None  # Table not created yet at this schema version
+    return timings
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    logger.remove()
+    os.environ.setdefault("DBDATAPATH", os.path.join(tempfile.mkdtemp(), "unused.db"))
+    from db.migrations import MIGRATIONS, check_query_plans, migrate
+    from db.models import HOT_QUERIES
+
+    db_path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    conn = sqlite3.connect(db_path)
+    migrate(conn, target=1)
+    print(f"Filling {args.rows} messages...")
+    fill(conn, args.rows)
+    # A regular author (100th most active)
+    author = conn.execute(
+        "SELECT author_id FROM messages GROUP BY author_id ORDER BY COUNT(*) DESC LIMIT 1 OFFSET 100"
+    ).fetchone()[0]
+    queries = [("user stats (aggregate)", AGGREGATE_USER_STATS_SQL, {"user_id": author})]
+    for name, sql, params in HOT_QUERIES:
+        if isinstance(params, dict):
+            params = {key: author if key == "user_id" else value for key, value in params.items()}
+        elif name.startswith(("user", "roundness")):
+            params = (author,)
+        queries.append((name, sql, params))
+    timings = {}
+    for version in range(1, len(MIGRATIONS) + 1):
+        migrate(conn, target=version)
+        timings[version] = time_queries(conn, queries, args.repeat)
+    problems = check_query_plans(conn, queries)
+    print(f"Migrated: {len(problems)} plan problems")
+    for problem in problems:
+        print(f"Not indexed: {problem}")
+    print(f"{'query':>22} | " + " | ".join(f"{f'v{version} ms':>9}" for version in timings))
+    for name, *_ in queries:
+        cells = [f"{'-' if t[name] is None else f'{t[name]:.3f}':>9}" for t in timings.values()]
+        print(f"{name:>22} | " + " | ".join(cells))
+    conn.close()
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
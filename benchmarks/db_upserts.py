@@ -0,0 +1,71 @@
+"""SQLite upserts benchmark: new connection per statement (previous implementation) vs pooled WAL connections
+
+Runs upsert_user_info-style upserts against a temporary database, from one thread and from several threads.
+Run from the repo root: python -m benchmarks.db_upserts
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+UPSERT_SQL = """
+INSERT INTO discordusers (author_id, author_nickname, author_name)
+VALUES (?, ?, ?)
+ON CONFLICT(author_id) DO UPDATE SET
+    author_nickname=excluded.author_nickname,
+    author_name=excluded.author_name
+"""
+
+
+def legacy_upsert(db_path: str, row: tuple) -> None:
+    # Previous sqlite_connection: connect, execute, commit (fsync) and close for every statement
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(UPSERT_SQL, row)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def run(upsert, rows: list, threads: int) -> float:
+    started = time.perf_counter()
+    if threads == 1:
+        for row in rows:
+            upsert(row)
+    else:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(upsert, rows))
+    return len(rows) / (time.perf_counter() - started)
+
+
+def main(n: int = 2000) -> int:
+    logger.remove()
+    tmpdir = tempfile.mkdtemp()
+    legacy_path = os.path.join(tmpdir, "legacy.db")
+    os.environ["DBDATAPATH"] = os.path.join(tmpdir, "pooled.db")
+    # Imported after DBDATAPATH is set, so the pooled functions use the temporary database
+    from db import models
+    from db.connection import close_all
+
+    models.create_db()
+    conn = sqlite3.connect(legacy_path)
+    conn.execute("CREATE TABLE discordusers (author_id INTEGER PRIMARY KEY, author_nickname TEXT, author_name TEXT)")
+    conn.close()
+    # Few authors with many messages each, like on_message
+    rows = [(i % 50, f"nick{i % 7}", f"name{i % 50}") for i in range(n)]
+    print(f"{'threads':>7} | {'legacy upserts/s':>16} | {'pooled upserts/s':>16} | {'speedup':>7}")
+    for threads in [1, 4]:
+        legacy = run(lambda row: legacy_upsert(legacy_path, row), rows, threads)
+        pooled = run(lambda row: models.upsert_user_info(*row), rows, threads)
+        print(f"{threads:>7} | {legacy:>16.0f} | {pooled:>16.0f} | {pooled / legacy:>6.1f}x")
+    close_all()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""Large photo decoding benchmark: full resolution decode (previous behavior) vs reduced decode (INFERENCE_MAX_IMAGE_SIDE)
+
+Each mode runs analyze_bytes (decode + inference + annotated jpg) in its own process, so peak memory (RSS) is
+measured per mode. Reports decode time, p50 / p95 of the whole analyze_bytes call, peak RSS and the roundness
+difference against full resolution (masks are in original image coordinates in both modes).
+
+Run from the repo root:
+python -m benchmarks.decode --images path/to/photo1.jpg path/to/photo2.jpg
+python -m benchmarks.decode  # Synthetic 12MP photos
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import cv2
+import numpy as np
+
+MODES = {"full": "0", "reduced": None}  # INFERENCE_MAX_IMAGE_SIDE of each mode (None: the configured one)
+
+
+def synthetic_photos(count: int, width: int = 4000, height: int = 3000, seed: int = 0) -> List[bytes]:
+    # Noisy background with a loaf-ish ellipse, encoded like a phone photo
+    rng = np.random.default_rng(seed)
+    photos = []
+    for _ in range(count):
+        image = cv2.resize(rng.integers(0, 255, (30, 40, 3), dtype=np.uint8), (width, height))
+        center = (int(rng.integers(width // 3, 2 * width // 3)), int(rng.integers(height // 3, 2 * height // 3)))
+        axes = (int(rng.integers(width // 8, width // 4)), int(rng.integers(height // 8, height // 4)))
+        cv2.ellipse(image, center, axes, 0, 0, 360, (60, 120, 190), -1)
+        image = cv2.add(image, rng.integers(0, 25, image.shape, dtype=np.uint8))
+        photos.append(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes())
+    return photos
+
+
+def run_mode(mode: str, max_side: str, photos: List[bytes], runs: int) -> dict:
+    """Measures one decode mode (runs in a separate process)"""
+    if max_side is not None:
+        os.environ["INFERENCE_MAX_IMAGE_SIDE"] = max_side
+    from breadinfer.inference import InferenceHandler
+    from breadinfer.preprocess import decode_image
+
+    handler = InferenceHandler(local=True)
+    handler.warmup()
+    confidence = handler.floor_confidence()
+    decode_ms, latencies, analyses = [], [], []
+    for _ in range(runs):
+        for image_bytes in photos:
+            started = time.perf_counter()
+            decode_image(image_bytes, max_side=handler.decode_max_side())
+            decode_ms.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            analyses = handler.analyze_bytes([image_bytes], confidence, confidence)
+            latencies.append((time.perf_counter() - started) * 1000)
+    # Roundness of every photo (last run)
+    roundness = [analysis.roundness for analysis in handler.analyze_bytes(photos, confidence, confidence)]
+    return {
+        "mode": mode,
+        "decode_ms": float(np.mean(decode_ms)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "roundness": roundness,
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", nargs="*", help="Photos to analyze. Defaults to synthetic 12MP photos")
+    parser.add_argument("--count", type=int, default=4, help="Synthetic photos")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args(argv)
+    if args.images:
+        photos = []
+        for path in args.images:
+            with open(path, "rb") as f:
+                photos.append(f.read())
+    else:
+        photos = synthetic_photos(args.count)
+    print(f"{len(photos)} photos, {np.mean([len(photo) for photo in photos]) / 1024 / 1024:.1f}MB on average")
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for mode, max_side in MODES.items():
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(run_mode, mode, max_side, photos, args.runs).result())
+    reference = results[0]["roundness"]
+    print(f"{'mode':>8} | {'decode ms':>9} | {'p50 ms':>8} | {'p95 ms':>8} | {'peak RSS MB':>11} | roundness error")
+    for result in results:
+        errors = [abs(a - b) for a, b in zip(reference, result["roundness"]) if a is not None and b is not None]
+        error = f"{max(errors):.4f}" if errors else "-"
+        print(
+            f"{result['mode']:>8} | {result['decode_ms']:>9.1f} | {result['p50_ms']:>8.1f} | {result['p95_ms']:>8.1f}"
+            f" | {result['peak_rss_mb']:>11.0f} | {error}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
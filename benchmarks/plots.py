@@ -0,0 +1,75 @@
+"""History plot benchmark: import cost (time and RSS, in a fresh process) and render time of each plot renderer
+
+Run from the repo root: python -m benchmarks.plots [--points 50] [--repeat 20]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+from loguru import logger
+
+# Imports needed by each renderer (what a bot process pays at startup if it imports it)
+IMPORTS = {
+    "opencv": "import plots.cvplot",
+    "matplotlib": "import matplotlib; matplotlib.use('Agg'); import matplotlib.pyplot; import seaborn",
+    "plots.plots": "import plots.plots",
+}
+IMPORT_SCRIPT = """
+import resource, sys, time
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - started
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed * 1000, (after - before) / 1024, "matplotlib" in sys.modules)
+"""
+
+
+def import_cost(statement: str) -> tuple[float, float, bool]:
+    # Fresh interpreter, so nothing is already imported. Returns (ms, RSS increase in MB, matplotlib imported)
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(statement=statement)],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    return float(output[0]), float(output[1]), output[2] == "True"
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--points", type=int, default=50, help="History length (the bot plots the last 50)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--dpi", type=int, default=100)
+    args = parser.parse_args(argv)
+    logger.remove()
+    os.environ.setdefault("DBDATAPATH", os.path.join(tempfile.mkdtemp(), "unused.db"))
+
+    print(f"{'import':>12} | {'ms':>8} | {'RSS MB':>8} | matplotlib")
+    for name, statement in IMPORTS.items():
+        ms, rss, matplotlib_imported = import_cost(statement)
+        print(f"{name:>12} | {ms:>8.0f} | {rss:>8.1f} | {matplotlib_imported}")
+
+    from plots import cvplot, plots
+
+    rng = np.random.default_rng(0)
+    data = list(enumerate(rng.random(args.points), start=1))
+    renderers = {
+        "opencv": lambda: cvplot.render_roundness_history(data, scale=args.dpi / 100),
+        "matplotlib": lambda: plots.render_roundness_history_matplotlib(data, dpi=args.dpi),
+    }
+    print(f"{'render':>12} | {'ms':>8} | {'PNG KB':>8}")
+    for name, render in renderers.items():
+        size = len(render())  # Warm up (first matplotlib render loads fonts)
+        ms = timeit.timeit(render, number=args.repeat) / args.repeat * 1000
+        print(f"{name:>12} | {ms:>8.1f} | {size / 1024:>8.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
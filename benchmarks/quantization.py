@@ -0,0 +1,141 @@
+"""INT8 quantized models benchmark: accuracy and speed of each backend/variant against the fp32 PyTorch models
+
+Every variant runs in its own process so peak memory (RSS) is measured per variant. Reports:
+- mAP50 / mAP50-95 on the validation split (only if the datasets are available, see yolov8/trainedmodels/datasets.yaml)
+- roundness and label confidence error against the fp32 PyTorch reference, on the same images
+- p50 / p95 latency of the fused pipeline (one image per call) and peak RSS
+
+Run from the repo root:
+python -m benchmarks.quantization --images path/to/bread1.jpg path/to/bread2.jpg
+python -m benchmarks.quantization --variants pytorch:fp32 onnx:int8 --det-data det/data.yaml --seg-data seg/data.yaml
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import cv2
+import numpy as np
+
+DEFAULT_VARIANTS = ["pytorch:fp32", "onnx:fp32", "onnx:int8", "openvino:fp32", "openvino:int8"]
+
+
+def validate(model, data: str, imgsz: int, mask: bool) -> dict:
+    # ultralytics validation on the dataset's val split, on CPU with batch 1 (same as the bot)
+    metrics = model.val(data=data, imgsz=imgsz, batch=1, device="cpu", plots=False, verbose=False)
+    result = metrics.seg if mask else metrics.box
+    return {"map50": float(result.map50), "map": float(result.map)}
+
+
+def run_variant(spec: str, images: List[np.ndarray], runs: int, imgsz: int, det_data: str, seg_data: str) -> dict:
+    """Loads one backend:variant and measures it (runs in a separate process)"""
+    from breadinfer.inference import InferenceHandler
+
+    backend, variant = spec.split(":")
+    started = time.perf_counter()
+    handler = InferenceHandler(local=True, backend=backend, variant=variant, imgsz=imgsz)
+    load_s = time.perf_counter() - started
+    confidence = handler.floor_confidence()
+    analyses = handler.analyze_images(images, confidence, confidence)  # Also warms up the models
+    latencies = []
+    for _ in range(runs):
+        for image in images:
+            started = time.perf_counter()
+            handler.analyze_images([image], confidence, confidence)
+            latencies.append((time.perf_counter() - started) * 1000)
+    result = {
+        "spec": spec,
+        "load_s": load_s,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "labels": [analysis.labels for analysis in analyses],
+        "roundness": [analysis.roundness for analysis in analyses],
+    }
+    if det_data:
+        result["det"] = validate(handler.local_det_model, det_data, imgsz, mask=False)
+    if seg_data:
+        result["seg"] = validate(handler.local_seg_model, seg_data, imgsz, mask=True)
+    # ru_maxrss is in KB on Linux
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def compare(reference: dict, result: dict) -> dict:
+    """Max label confidence and mean/max roundness error of a variant against the reference"""
+    label_errors, roundness_errors = [0.0], [0.0]
+    for ref_labels, labels in zip(reference["labels"], result["labels"]):
+        for label in set(ref_labels) | set(labels):
+            label_errors.append(abs(ref_labels.get(label, 0) - labels.get(label, 0)))
+    for ref_roundness, roundness in zip(reference["roundness"], result["roundness"]):
+        if ref_roundness is not None or roundness is not None:
+            roundness_errors.append(abs((ref_roundness or 0) - (roundness or 0)))
+    return {
+        "max_label_err": max(label_errors),
+        "mean_roundness_err": float(np.mean(roundness_errors[1:])) if len(roundness_errors) > 1 else 0.0,
+        "max_roundness_err": max(roundness_errors),
+    }
+
+
+def existing(path: str) -> str:
+    return path if path and os.path.exists(path) else None
+
+
+def main(argv: List[str] = None) -> int:
+    from breadinfer.export import dataset_for_model
+
+    parser = argparse.ArgumentParser(description="Benchmark fp32 and int8 model variants against fp32 PyTorch")
+    parser.add_argument(
+        "--variants", nargs="+", default=DEFAULT_VARIANTS, help="backend:variant, the first one is the reference"
+    )
+    parser.add_argument("--images", nargs="*", help="Images for roundness error and latency (random noise if empty)")
+    parser.add_argument("--runs", type=int, default=5, help="Latency runs over the images")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--det-data", help="Detection data.yaml for mAP. Defaults to datasets.yaml if it exists")
+    parser.add_argument("--seg-data", help="Segmentation data.yaml for mAP. Defaults to datasets.yaml if it exists")
+    args = parser.parse_args(argv)
+    if args.images:
+        images = [cv2.imread(path) for path in args.images]
+    else:
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 255, (720, 960, 3), dtype=np.uint8) for _ in range(4)]
+    det_data = existing(args.det_data or dataset_for_model("breadv7m-det.pt"))
+    seg_data = existing(args.seg_data or dataset_for_model("breadsegv4m-seg.pt"))
+    if not (det_data and seg_data):
+        print("Datasets not found, mAP is skipped for the missing ones")
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for spec in args.variants:
+        # Fresh process per variant: no models of the previous ones in memory and its own peak RSS
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            try:
+                results.append(
+                    pool.submit(run_variant, spec, images, args.runs, args.imgsz, det_data, seg_data).result()
+                )
+            except Exception as e:
+                print(f"{spec}: failed ({e})")
+    if not results:
+        return 1
+    reference = results[0]
+    print(
+        f"{'variant':>14} | {'load s':>6} | {'p50 ms':>7} | {'p95 ms':>7} | {'RSS MB':>7} | {'label err':>9} | "
+        f"{'round err (mean/max)':>20} | {'det mAP50':>9} | {'seg mAP50':>9}"
+    )
+    for result in results:
+        errors = compare(reference, result)
+        det_map = f"{result['det']['map50']:.4f}" if "det" in result else "n/a"
+        seg_map = f"{result['seg']['map50']:.4f}" if "seg" in result else "n/a"
+        print(
+            f"{result['spec']:>14} | {result['load_s']:>6.2f} | {result['p50_ms']:>7.1f} | {result['p95_ms']:>7.1f} | "
+            f"{result['peak_rss_mb']:>7.0f} | {errors['max_label_err']:>9.4f} | "
+            f"{errors['mean_roundness_err']:>9.4f} / {errors['max_roundness_err']:<8.4f} | {det_map:>9} | {seg_map:>9}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""Roundness estimation benchmark: rasterized canvas (previous implementation) vs polygon geometry
+
+Run from the repo root: python -m benchmarks.roundness
+"""
+
+import timeit
+
+import cv2
+import numpy as np
+
+from breadinfer.inference import InferenceHandler
+
+IMAGE_SIZES = [(480, 640), (1080, 1920), (3024, 4032), (4000, 6000)]
+
+
+def rasterized_roundness(orig_shape, polygon) -> float:
+    # Previous implementation: draws the polygon on a full size canvas and finds the contour back
+    black_image = np.zeros((orig_shape[0], orig_shape[1], 3), dtype=np.uint8)
+    cv2.polylines(black_image, np.int32([polygon]), True, (255, 255, 255), 2)
+    gray_image = cv2.cvtColor(black_image, cv2.COLOR_BGR2GRAY)
+    contours, _ = cv2.findContours(gray_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    area = cv2.contourArea(contours[0])
+    _, radius = cv2.minEnclosingCircle(contours[0])
+    return area / (np.pi * radius**2)
+
+
+def bread_polygon(orig_shape, points: int = 400, seed: int = 0) -> np.ndarray:
+    # Slightly noisy ellipse covering most of the image, like a loaf photo
+    rng = np.random.default_rng(seed)
+    height, width = orig_shape
+    angles = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    radius = 1 + rng.normal(0, 0.01, points)
+    x = width / 2 + 0.4 * width * radius * np.cos(angles)
+    y = height / 2 + 0.3 * height * radius * np.sin(angles)
+    return np.stack([x, y], axis=1).astype(np.float32)
+
+
+def main(repeat: int = 20):
+    handler = InferenceHandler.__new__(InferenceHandler)  # Only the geometry is used, no models needed
+    print(f"{'image size':>12} | {'rasterized ms':>13} | {'polygon ms':>10} | {'speedup':>7} | {'abs diff':>8}")
+    for orig_shape in IMAGE_SIZES:
+        polygon = bread_polygon(orig_shape)
+        old = rasterized_roundness(orig_shape, polygon)
+        _, new = handler.estimate_roundness_from_polygons([polygon])
+        old_time = timeit.timeit(lambda: rasterized_roundness(orig_shape, polygon), number=repeat) / repeat
+        new_time = timeit.timeit(lambda: handler.estimate_roundness_from_polygons([polygon]), number=repeat) / repeat
+        print(
+            f"{orig_shape[0]:>5}x{orig_shape[1]:<6} | {old_time * 1000:>13.3f} | {new_time * 1000:>10.3f} | "
+            f"{old_time / new_time:>6.0f}x | {abs(old - new):>8.4f}"
+        )
+    # Multiple instances are only supported by the polygon path
+    polygons = [bread_polygon(IMAGE_SIZES[-1], seed=seed) * scale for seed, scale in enumerate([1, 0.5, 0.25])]
+    instance_roundness, roundness = handler.estimate_roundness_from_polygons(polygons)
+    print(f"3 instances: {[round(value, 4) for value in instance_roundness]} -> aggregate {roundness:.4f}")
+
+
+if __name__ == "__main__":
+    main()
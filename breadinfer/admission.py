@@ -0,0 +1,187 @@
+import asyncio
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable
+
+
+class AdmissionRejected(Exception):
+    """The request wasn't admitted: too many requests are already waiting"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Asyncio side admission control in front of the inference
+
+    At most max_in_flight requests run at the same time (max_in_flight_per_guild for a single guild), the others
+    wait in a queue. Waiting requests are admitted round-robin: one per guild in turn, and one per user in turn
+    within a guild, so a big post (or a busy server) can't starve everyone else. When max_queued requests are
+    already waiting (or max_queued_per_user for that user) new ones are rejected right away with AdmissionRejected
+    instead of piling up images in memory.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 4,
+        max_queued: int = 32,
+        max_queued_per_user: int = 10,
+        max_in_flight_per_guild: int = 2,
+    ):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queued = max(0, max_queued)
+        self.max_queued_per_user = max(0, max_queued_per_user)
+        self.max_in_flight_per_guild = max(1, max_in_flight_per_guild)
+        # guild -> user -> waiting futures, both in round-robin order
+        self._queues: OrderedDict[
+            Hashable, OrderedDict[Hashable, Deque[asyncio.Future]]
+        ] = OrderedDict()
+        self._queued = 0
+        self._queued_by_user: Counter = Counter()
+        self._in_flight = 0
+        self._in_flight_by_guild: Counter = Counter()
+        # Metrics
+        self._admitted = 0
+        self._rejected: Dict[str, int] = Counter()
+        self._max_queue_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @asynccontextmanager
+    async def slot(self, user_id: Hashable, guild_id: Hashable):
+        """Waits for a slot and holds it for the duration of the block
+
+        Args:
+            user_id (Hashable): User that made the request
+            guild_id (Hashable): Guild of the request
+
+        Raises:
+            AdmissionRejected: The queue (or this user's share of it) is full
+        """
+        await self.acquire(user_id, guild_id)
+        try:
+            yield
+        finally:
+            self.release(guild_id)
+
+    async def acquire(self, user_id: Hashable, guild_id: Hashable) -> None:
+        """Waits for a slot, release(guild_id) must be called once done"""
+        must_wait = (
+            self._queued > 0
+            or self._in_flight >= self.max_in_flight
+            or self._in_flight_by_guild[guild_id] >= self.max_in_flight_per_guild
+        )
+        if must_wait and self._queued >= self.max_queued:
+            self._rejected["queue_full"] += 1
+            raise AdmissionRejected("queue_full")
+        if must_wait and self._queued_by_user[user_id] >= self.max_queued_per_user:
+            self._rejected["user_limit"] += 1
+            raise AdmissionRejected("user_limit")
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(guild_id, OrderedDict()).setdefault(
+            user_id, deque()
+        ).append(future)
+        self._queued += 1
+        self._queued_by_user[user_id] += 1
+        self._dispatch()
+        self._max_queue_depth = max(self._max_queue_depth, self._queued)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted right before the caller was cancelled
+                self.release(guild_id)
+            else:
+                self._remove(user_id, guild_id, future)
+            raise
+        wait = time.perf_counter() - started
+        self._admitted += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+
+    def release(self, guild_id: Hashable) -> None:
+        """Frees a slot and admits the next waiting requests"""
+        self._in_flight -= 1
+        self._in_flight_by_guild[guild_id] -= 1
+        if self._in_flight_by_guild[guild_id] <= 0:
+            del self._in_flight_by_guild[guild_id]
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._in_flight < self.max_in_flight:
+            guild_id = next(
+                (
+                    guild_id
+                    for guild_id in self._queues
+                    if self._in_flight_by_guild[guild_id] < self.max_in_flight_per_guild
+                ),
+                None,
+            )
+            if guild_id is None:
+                return
+            users = self._queues[guild_id]
+            user_id, futures = next(iter(users.items()))
+            future = futures.popleft()
+            self._dequeued(user_id, guild_id)
+            if future.done():
+                continue  # Cancelled while waiting
+            future.set_result(None)
+            self._in_flight += 1
+            self._in_flight_by_guild[guild_id] += 1
+
+    def _dequeued(self, user_id: Hashable, guild_id: Hashable) -> None:
+        # Counts the first future of the user as gone and rotates the user and guild to the back of the line
+        self._queued -= 1
+        self._queued_by_user[user_id] -= 1
+        if self._queued_by_user[user_id] <= 0:
+            del self._queued_by_user[user_id]
+        users = self._queues[guild_id]
+        if users[user_id]:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            self._queues.move_to_end(guild_id)
+        else:
+            del self._queues[guild_id]
+
+    def _remove(
+        self, user_id: Hashable, guild_id: Hashable, future: asyncio.Future
+    ) -> None:
+        futures = self._queues.get(guild_id, {}).get(user_id)
+        if futures is None or future not in futures:
+            return
+        futures.remove(future)
+        self._queued -= 1
+        self._queued_by_user[user_id] -= 1
+        if self._queued_by_user[user_id] <= 0:
+            del self._queued_by_user[user_id]
+        if not futures:
+            del self._queues[guild_id][user_id]
+            if not self._queues[guild_id]:
+                del self._queues[guild_id]
+
+    def stats(self) -> dict:
+        """Queue depth, wait time and rejection metrics
+
+        Returns:
+            dict: Metrics
+        """
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_in_flight_per_guild": self.max_in_flight_per_guild,
+            "max_queued": self.max_queued,
+            "max_queued_per_user": self.max_queued_per_user,
+            "in_flight": self._in_flight,
+            "queue_depth": self._queued,
+            "max_queue_depth": self._max_queue_depth,
+            "admitted": self._admitted,
+            "rejected": dict(self._rejected),
+            "mean_wait_ms": (
+                self._total_wait / self._admitted * 1000 if self._admitted else 0
+            ),
+            "max_wait_ms": self._max_wait * 1000,
+        }
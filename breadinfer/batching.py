@@ -0,0 +1,205 @@
+import asyncio
+import time
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+from loguru import logger
+
+
+class BatcherClosed(Exception):
+    """The batcher was closed (its handler is being replaced) and takes no new requests"""
+
+
+class InferenceBatcher:
+    """Asyncio side micro-batching scheduler for inference requests
+
+    Requests are queued and a single worker task collects them for up to max_wait_ms (or until max_batch_size
+    requests are pending), groups them by key (requests can only share a batch if they use the same settings, e.g.
+    same confidences) and runs one batch_fn call per group on the executor. Each caller gets its own result back.
+    Up to max_concurrent_batches batches run at the same time (e.g. one per worker process).
+
+    batch_fn(key, items) must return a list with one result per item, in the same order.
+    An item result can be an Exception instance, in which case it is raised to that caller only.
+    If load_fn is set, it's run (blocking, on the default executor) before the first batch, e.g. to load the models
+    or start the worker pool the executor is set from. It must be idempotent: concurrent batches may call it at once.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[Hashable, List[Any]], List[Any]],
+        max_batch_size: int = 4,
+        max_wait_ms: float = 20.0,
+        executor=None,
+        max_concurrent_batches: int = 1,
+        load_fn: Callable[[], Any] = None,
+    ):
+        self.batch_fn = batch_fn
+        self.load_fn = load_fn
+        self._loaded = load_fn is None
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.executor = executor
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self._queue: asyncio.Queue = None
+        self._slots: asyncio.Semaphore = None
+        self._worker: asyncio.Task = None
+        self._running = set()  # Keep references to the running batch tasks
+        self._closed = False
+        self._pending = 0  # Submitted requests without a result yet
+        # Metrics
+        self._requests = 0
+        self._batches = 0
+        self._errors = 0
+        self._batch_sizes: Dict[int, int] = {}
+        self._max_queue_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._total_batch_time = 0.0
+
+    async def submit(self, key: Hashable, item: Any) -> Any:
+        """Queue an item and wait for its result
+
+        Args:
+            key (Hashable): Batch key, only items with the same key are batched together
+            item (Any): Item to be passed to batch_fn
+
+        Raises:
+            BatcherClosed: The batcher was closed
+
+        Returns:
+            Any: Result for this item
+        """
+        if self._closed:
+            raise BatcherClosed()
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._pending += 1
+        try:
+            await self._queue.put((key, item, future, time.perf_counter()))
+            self._requests += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+            return await future
+        finally:
+            self._pending -= 1
+
+    def close(self):
+        """Refuses new requests (submit raises BatcherClosed), the ones already submitted still run"""
+        self._closed = True
+
+    async def drain(self, poll_ms: float = 50.0):
+        """Waits until every submitted request has its result (used before discarding a batcher, after close)
+
+        Args:
+            poll_ms (float, optional): How often to check. Defaults to 50.0.
+        """
+        while self._pending or self._running:
+            await asyncio.sleep(poll_ms / 1000)
+        if self._closed and self._worker is not None:
+            self._worker.cancel()
+
+    async def _run(self):
+        """Worker loop: waits for a free slot, collects a batch, then runs it. New requests keep queueing while
+        all slots are busy, so under load batches grow on their own up to max_batch_size
+        """
+        while True:
+            await self._slots.acquire()
+            pending = [await self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(
+                        await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            groups: Dict[Hashable, List[Tuple[Any, asyncio.Future, float]]] = {}
+            for key, item, future, queued_at in pending:
+                groups.setdefault(key, []).append((item, future, queued_at))
+            batches = [
+                self._run_batch(key, requests) for key, requests in groups.items()
+            ]
+            task = asyncio.get_running_loop().create_task(self._run_batches(batches))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_batches(self, batches: list):
+        """Runs the batches collected in one window (one per key) and frees the slot"""
+        try:
+            for batch in batches:
+                await batch
+        finally:
+            self._slots.release()
+
+    async def _run_batch(
+        self, key: Hashable, requests: List[Tuple[Any, asyncio.Future, float]]
+    ):
+        """Runs one batch on the executor and resolves the futures of every caller"""
+        requests = [request for request in requests if not request[1].cancelled()]
+        if not requests:
+            return
+        started = time.perf_counter()
+        for _, _, queued_at in requests:
+            wait = started - queued_at
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+        self._batches += 1
+        self._batch_sizes[len(requests)] = self._batch_sizes.get(len(requests), 0) + 1
+        logger.debug(f"Running inference batch of {len(requests)} for key {key}")
+        loop = asyncio.get_running_loop()
+        try:
+            if not self._loaded:
+                await loop.run_in_executor(None, self.load_fn)
+                self._loaded = True
+            results = await loop.run_in_executor(
+                self.executor, self.batch_fn, key, [item for item, _, _ in requests]
+            )
+        except Exception as e:
+            logger.error(f"Error running inference batch: {e}")
+            self._errors += 1
+            results = [e] * len(requests)
+        finally:
+            self._total_batch_time += time.perf_counter() - started
+        for (_, future, _), result in zip(requests, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        """Batch size, queue depth and wait time metrics, to tune throughput against latency
+
+        Returns:
+            dict: Metrics
+        """
+        batched_requests = sum(
+            size * count for size, count in self._batch_sizes.items()
+        )
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_concurrent_batches": self.max_concurrent_batches,
+            "batch_wait_ms": self.max_wait * 1000,
+            "requests": self._requests,
+            "batches": self._batches,
+            "errors": self._errors,
+            "batch_sizes": dict(sorted(self._batch_sizes.items())),
+            "mean_batch_size": batched_requests / self._batches if self._batches else 0,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "pending": self._pending,
+            "max_queue_depth": self._max_queue_depth,
+            "mean_wait_ms": (
+                self._total_wait / batched_requests * 1000 if batched_requests else 0
+            ),
+            "max_wait_ms": self._max_wait * 1000,
+            "mean_batch_ms": (
+                self._total_batch_time / self._batches * 1000 if self._batches else 0
+            ),
+        }
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+# Hashing images and both cache tiers (JSON, SQLite) are blocking: coroutines run them on this thread
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inferencecache")
+
+
+async def run_in_cache_thread(func: Callable, *args, **kwargs):
+    """Runs a blocking cache function on the cache thread and waits for it"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+class ResultCache:
+    """Inference result cache keyed by image content hash, model id and confidences
+
+    Two tiers: an in-memory LRU and an optional persistent SQLite file (db_path). Entries are the raw predictions
+    (BreadAnalysis.to_dict: detections, mask polygons, roundness), never the images themselves.
+    """
+
+    def __init__(self, max_entries: int = 256, db_path: str = None):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._memory: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection = None
+        # Metrics
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(image_bytes: bytes, model_id: str, *confidences: float) -> str:
+        """Cache key for an image
+
+        Args:
+            image_bytes (bytes): Encoded image
+            model_id (str): Models used for the predictions
+            confidences (float): Confidences the models were run with
+
+        Returns:
+            str: key
+        """
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return ":".join(
+            [digest, model_id, *[str(confidence) for confidence in confidences]]
+        )
+
+    def _disk(self) -> sqlite3.Connection:
+        # Opened on first use, so processes that never touch the cache (e.g. inference workers) don't open the file
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS inferencecache (cache_key TEXT PRIMARY KEY, entry_json TEXT, created_at REAL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> Optional[dict]:
+        """Returns the cached entry (or None) and marks it as recently used"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._memory_hits += 1
+                return self._memory[key]
+            if self.db_path:
+                try:
+                    row = (
+                        self._disk()
+                        .execute(
+                            "SELECT entry_json FROM inferencecache WHERE cache_key = ?",
+                            (key,),
+                        )
+                        .fetchone()
+                    )
+                except sqlite3.Error as e:
+                    logger.error(f"Inference cache error: {e}")
+                    row = None
+                if row:
+                    entry = json.loads(row[0])
+                    self._store_memory(key, entry)
+                    self._disk_hits += 1
+                    return entry
+            self._misses += 1
+            return None
+
+    def put(self, key: str, entry: dict) -> None:
+        """Stores an entry in both tiers"""
+        with self._lock:
+            self._store_memory(key, entry)
+            if self.db_path:
+                try:
+                    self._disk().execute(
+                        "INSERT OR REPLACE INTO inferencecache (cache_key, entry_json, created_at) VALUES (?, ?, ?)",
+                        (key, json.dumps(entry), time.time()),
+                    )
+                    self._disk().commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Inference cache error: {e}")
+
+    def _store_memory(self, key: str, entry: dict) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self) -> None:
+        """Empties both tiers"""
+        with self._lock:
+            self._memory.clear()
+            if self.db_path:
+                self._disk().execute("DELETE FROM inferencecache")
+                self._disk().commit()
+
+    def stats(self) -> dict:
+        """Hit/miss metrics
+
+        Returns:
+            dict: Metrics
+        """
+        lookups = self._memory_hits + self._disk_hits + self._misses
+        return {
+            "max_entries": self.max_entries,
+            "memory_entries": len(self._memory),
+            "persistent": bool(self.db_path),
+            "memory_hits": self._memory_hits,
+            "disk_hits": self._disk_hits,
+            "misses": self._misses,
+            "hit_rate": (
+                (self._memory_hits + self._disk_hits) / lookups if lookups else 0
+            ),
+        }
+
+
+# Default cache, persistent tier is only enabled if INFERENCE_CACHE_PATH is set
+_cache_path = os.environ.get("INFERENCE_CACHE_PATH")
+resultcache = ResultCache(
+    max_entries=int(os.environ.get("INFERENCE_CACHE_SIZE", 256)),
+    db_path=os.path.join(os.getcwd(), _cache_path) if _cache_path else None,
+)
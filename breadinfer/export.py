@@ -0,0 +1,262 @@
+import argparse
+import os
+import sys
+from typing import List
+
+import cv2
+import numpy as np
+from loguru import logger
+
+MODELS_DIR = os.path.join("yolov8", "trainedmodels")
+DATASETS_FILE = os.path.join(MODELS_DIR, "datasets.yaml")
+# Suffix of the converted artifact, it's written next to the .pt model (same naming as ultralytics export)
+BACKENDS = {"pytorch": "", "onnx": ".onnx", "openvino": "_openvino_model"}
+# INT8 variants: dynamic quantization for ONNX Runtime, static (calibrated on the training dataset) for OpenVINO
+INT8_SUFFIXES = {"onnx": "-int8.onnx", "openvino": "_int8_openvino_model"}
+VARIANTS = ["fp32", "int8"]
+
+
+def artifact_path(
+    model_name: str, backend: str = "pytorch", variant: str = "fp32"
+) -> str:
+    """Path of the model for the given backend and variant
+
+    Args:
+        model_name (str): Model filename (.pt) in yolov8/trainedmodels
+        backend (str, optional): pytorch, onnx or openvino. Defaults to "pytorch".
+        variant (str, optional): fp32 or int8 (onnx and openvino only). Defaults to "fp32".
+
+    Raises:
+        ValueError: Unknown backend or variant
+
+    Returns:
+        str: Path to the .pt file, .onnx file or openvino model folder
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    if variant not in VARIANTS or (variant == "int8" and backend not in INT8_SUFFIXES):
+        raise ValueError(f"Unknown model variant for {backend}: {variant}")
+    path = os.path.join(MODELS_DIR, model_name)
+    if backend == "pytorch":
+        return path
+    suffix = INT8_SUFFIXES[backend] if variant == "int8" else BACKENDS[backend]
+    return os.path.splitext(path)[0] + suffix
+
+
+def dataset_for_model(model_name: str) -> str:
+    """Dataset (data.yaml) a model was trained on, from yolov8/trainedmodels/datasets.yaml
+
+    Args:
+        model_name (str): Model filename (.pt)
+
+    Returns:
+        str: data.yaml path (None if the model isn't listed)
+    """
+    import yaml
+
+    if not os.path.exists(DATASETS_FILE):
+        return None
+    with open(DATASETS_FILE) as file:
+        for entry in yaml.safe_load(file) or []:
+            if model_name in entry:
+                return entry[model_name].get("data")
+    return None
+
+
+def export_model(
+    model_name: str,
+    backend: str,
+    imgsz: int = 640,
+    force: bool = False,
+    variant: str = "fp32",
+    data: str = None,
+) -> str:
+    """Converts a .pt model for the given backend. Converted artifacts are cached: nothing is done if it already exists
+
+    Args:
+        model_name (str): Model filename (.pt) in yolov8/trainedmodels
+        backend (str): onnx or openvino
+        imgsz (int, optional): Model input size. Defaults to 640.
+        force (bool, optional): Convert again even if the artifact exists. Defaults to False.
+        variant (str, optional): fp32 or int8. Defaults to "fp32".
+        data (str, optional): data.yaml to calibrate openvino int8 models. Defaults to the one in datasets.yaml.
+
+    Returns:
+        str: Path to the converted model
+    """
+    path = artifact_path(model_name, backend, variant)
+    if backend == "pytorch" or (os.path.exists(path) and not force):
+        return path
+    if variant == "int8" and backend == "onnx":
+        # Dynamic quantization of the fp32 onnx model: int8 weights, activations quantized at runtime
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        fp32_path = export_model(model_name, backend, imgsz=imgsz)
+        logger.info(f"Quantizing {fp32_path} (dynamic int8)")
+        quantize_dynamic(fp32_path, path, weight_type=QuantType.QUInt8)
+        return path
+    from ultralytics import YOLO
+
+    export_kwargs = {}
+    if variant == "int8":
+        # Static quantization, calibrated on the dataset the model was trained on
+        export_kwargs = {"int8": True, "data": data or dataset_for_model(model_name)}
+        if not export_kwargs["data"] or not os.path.exists(export_kwargs["data"]):
+            raise ValueError(
+                f"Calibration dataset not found for {model_name}: {export_kwargs['data']}"
+            )
+    logger.info(f"Exporting {model_name} for {backend} ({variant})")
+    # Dynamic axes so the micro-batching scheduler can send batches of any size
+    exported = YOLO(os.path.join(MODELS_DIR, model_name)).export(
+        format=backend, imgsz=imgsz, dynamic=True, half=False, **export_kwargs
+    )
+    logger.info(f"Exported {model_name} for {backend} ({variant}): {exported}")
+    return str(exported)
+
+
+def load_model(
+    model_name: str,
+    backend: str = "pytorch",
+    task: str = None,
+    imgsz: int = 640,
+    variant: str = "fp32",
+):
+    """Loads a model with the given backend and variant, converting it first if the artifact doesn't exist yet
+
+    Args:
+        model_name (str): Model filename (.pt) in yolov8/trainedmodels
+        backend (str, optional): pytorch, onnx or openvino. Defaults to "pytorch".
+        task (str, optional): detect or segment, needed for converted models. Defaults to None.
+        imgsz (int, optional): Model input size. Defaults to 640.
+        variant (str, optional): fp32 or int8. Defaults to "fp32".
+
+    Returns:
+        YOLO: ultralytics model
+    """
+    from ultralytics import YOLO
+
+    path = export_model(model_name, backend, imgsz=imgsz, variant=variant)
+    logger.info(f"Loading {path} ({backend}, {variant})")
+    return YOLO(path, task=task)
+
+
+def check_parity(
+    backend: str,
+    images: List[np.ndarray],
+    tolerance: float = 0.02,
+    variant: str = "fp32",
+    **handler_kwargs,
+) -> dict:
+    """Runs the fused pipeline with fp32 PyTorch and with the given backend and variant on the same images
+    and compares the results
+
+    Args:
+        backend (str): onnx or openvino
+        images (List[np.ndarray]): BGR images
+        tolerance (float, optional): Max allowed difference for label confidences and roundness. Defaults to 0.02.
+        variant (str, optional): Variant of the checked backend, fp32 or int8. Defaults to "fp32".
+        handler_kwargs: Extra InferenceHandler arguments (models, imgsz)
+
+    Returns:
+        dict: max differences found and whether they are within tolerance. Not ok if the reference found
+            nothing at all (no labels and no masks): there was nothing to compare
+    """
+    from breadinfer.inference import InferenceHandler
+
+    reference = InferenceHandler(
+        local=True, backend="pytorch", variant="fp32", **handler_kwargs
+    )
+    candidate = InferenceHandler(
+        local=True, backend=backend, variant=variant, **handler_kwargs
+    )
+    # Same (lowest) confidences on both so they can't disagree on borderline instances being filtered
+    confidence = reference.floor_confidence()
+    expected = reference.analyze_images(images, confidence, confidence)
+    actual = candidate.analyze_images(images, confidence, confidence)
+    reference_labels = sum(len(ref.labels) for ref in expected)
+    reference_masks = sum(len(ref.masks) for ref in expected)
+    if not reference_labels and not reference_masks:
+        logger.warning(
+            "The reference found no labels and no masks on these images, nothing was compared. "
+            "Check parity on real bread pictures"
+        )
+    label_diff, roundness_diff, mask_count_diff = 0.0, 0.0, 0
+    for ref, cand in zip(expected, actual):
+        for label in set(ref.labels) | set(cand.labels):
+            label_diff = max(
+                label_diff, abs(ref.labels.get(label, 0) - cand.labels.get(label, 0))
+            )
+        if ref.roundness is not None or cand.roundness is not None:
+            roundness_diff = max(
+                roundness_diff, abs((ref.roundness or 0) - (cand.roundness or 0))
+            )
+        mask_count_diff = max(mask_count_diff, abs(len(ref.masks) - len(cand.masks)))
+    return {
+        "backend": backend,
+        "variant": variant,
+        "images": len(images),
+        "max_label_confidence_diff": label_diff,
+        "max_roundness_diff": roundness_diff,
+        "max_mask_count_diff": mask_count_diff,
+        "reference_labels": reference_labels,
+        "reference_masks": reference_masks,
+        "ok": bool(reference_labels or reference_masks)
+        and label_diff <= tolerance
+        and roundness_diff <= tolerance,
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Convert the bread models for ONNX Runtime / OpenVINO (fp32 or int8) and check them against PyTorch"
+    )
+    parser.add_argument("--backend", choices=["onnx", "openvino"], required=True)
+    parser.add_argument("--det-model", default="breadv7m-det.pt")
+    parser.add_argument("--seg-model", default="breadsegv4m-seg.pt")
+    parser.add_argument("--variant", choices=VARIANTS, default="fp32")
+    parser.add_argument(
+        "--det-data", help="data.yaml to calibrate the int8 detection model"
+    )
+    parser.add_argument(
+        "--seg-data", help="data.yaml to calibrate the int8 segmentation model"
+    )
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--force", action="store_true", help="Convert again")
+    parser.add_argument(
+        "--check",
+        nargs="+",
+        metavar="IMAGE",
+        help="Check parity on these images (real bread pictures, the check fails if nothing is detected)",
+    )
+    args = parser.parse_args(argv)
+    for model_name, data in [
+        (args.det_model, args.det_data),
+        (args.seg_model, args.seg_data),
+    ]:
+        print(
+            export_model(
+                model_name, args.backend, args.imgsz, args.force, args.variant, data
+            )
+        )
+    if args.check is None:
+        return 0
+    images = []
+    for path in args.check:
+        image = cv2.imread(path)
+        if image is None:
+            parser.error(f"Couldn't read image: {path}")
+        images.append(image)
+    result = check_parity(
+        args.backend,
+        images,
+        variant=args.variant,
+        local_det_model=args.det_model,
+        local_seg_model=args.seg_model,
+        imgsz=args.imgsz,
+    )
+    print(result)
+    return 0 if result["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
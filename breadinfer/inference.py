@@ -1,13 +1,88 @@
 import asyncio
-import json
 import os
-import shutil
-from typing import Dict, Tuple
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
+from dotenv import load_dotenv
 from loguru import logger
 
+from breadinfer.batching import BatcherClosed, InferenceBatcher
+from breadinfer.cache import resultcache, run_in_cache_thread
+from breadinfer.preprocess import MAX_IMAGE_SIDE, decode_image, scale_polygons
+
+load_dotenv()
+
+# Attributes set by InferenceHandler.load, accessing any of them loads the models
+MODEL_ATTRIBUTES = {
+    "local_det_model",
+    "local_seg_model",
+    "http_client",
+    "http_mask_annotator",
+    "http_label_annotator",
+}
+
+
+@dataclass
+class BreadAnalysis:
+    """Result of the fused detection + segmentation pipeline for a single image
+
+    Attributes:
+        labels: predictions as key (name) and confidence (value)
+        detections: every detection as (name, confidence), labels are built from these
+        masks: segmentation polygons, in original image coordinates (one (N, 2) array per instance)
+        mask_confidences: confidence of each mask instance
+        segmented: whether the segmentation model was run at all (see bread_confidence)
+        roundness: estimated roundness (0 to 1) or None if it couldn't be computed
+        instance_roundness: estimated roundness of each mask instance
+        annotated_image: original image with the masks drawn over it (None if there were no masks)
+        annotated_image_bytes: annotated image encoded as jpg (only when the input was an encoded image)
+        annotated_confidence: min confidence of the masks drawn on the annotated image
+        output_img_path: path where the annotated image was written (None if it wasn't written)
+        raw_predictions: predictions this analysis was filtered from, as stored (see stored_predictions)
+    """
+
+    labels: Dict[str, float] = field(default_factory=dict)
+    detections: List[Tuple[str, float]] = field(default_factory=list)
+    masks: List[np.ndarray] = field(default_factory=list)
+    mask_confidences: List[float] = field(default_factory=list)
+    segmented: bool = False
+    roundness: Optional[float] = None
+    instance_roundness: List[Optional[float]] = field(default_factory=list)
+    annotated_image: Optional[np.ndarray] = None
+    annotated_image_bytes: Optional[bytes] = None
+    annotated_confidence: Optional[float] = None
+    output_img_path: Optional[str] = None
+    raw_predictions: Optional[dict] = None
+
+    def to_dict(self) -> dict:
+        """Serializable version of the predictions (images are not included)"""
+        return {
+            "labels": self.labels,
+            "detections": self.detections,
+            "masks": [np.round(mask, 1).tolist() for mask in self.masks],
+            "mask_confidences": self.mask_confidences,
+            "segmented": self.segmented,
+            "roundness": self.roundness,
+            "instance_roundness": self.instance_roundness,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BreadAnalysis":
+        """Builds the analysis back from to_dict"""
+        return cls(
+            labels=data["labels"],
+            detections=[tuple(detection) for detection in data["detections"]],
+            masks=[np.array(mask, dtype=np.float32) for mask in data["masks"]],
+            mask_confidences=data["mask_confidences"],
+            segmented=data["segmented"],
+            roundness=data["roundness"],
+            instance_roundness=data["instance_roundness"],
+        )
+
 
 class InferenceHandler:
     """Main Inference class, works for both local and http requests (roboflow) based on the input parameter. Default is local model"""
@@ -19,145 +94,949 @@ class InferenceHandler:
         local_det_model: str = "breadv7m-det.pt",
         http_seg_model: str = "bread-segmentation-hfhm8/4",
         local_seg_model: str = "breadsegv4m-seg.pt",
+        imgsz: int = 640,
+        workers: int = 0,
+        backend: str = "pytorch",
+        variant: str = "fp32",
     ):
         self._local = local
+        self.imgsz = imgsz
+        self.backend = backend
+        self.variant = variant
+        self.workers = workers
+        self.http_det_model = http_det_model
+        self.http_seg_model = http_seg_model
+        self._local_det_name = local_det_model
+        self._local_seg_name = local_seg_model
+        self._pool = None
+        # Models are loaded on first use (or by warmup), never when the handler is created
+        self._load_lock = threading.Lock()
+        self.loaded = False
+        self.load_seconds: float = None
+        self.warmup_ms: float = None
+        # Identifies the models in the result cache
         if local:
-            logger.info("Loading inference models: Local")
-            from ultralytics import YOLO
-
-            self.local_det_model = YOLO(
-                os.path.join("yolov8", "trainedmodels", local_det_model)
+            self.model_id = (
+                f"local:{local_det_model}:{local_seg_model}:{imgsz}:{backend}:{variant}"
             )
-            self.local_seg_model = YOLO(
-                os.path.join("yolov8", "trainedmodels", local_seg_model)
+        else:
+            self.model_id = f"http:{http_det_model}:{http_seg_model}"
+        batch_size = int(os.environ.get("INFERENCE_BATCH_SIZE", 4))
+        batch_wait_ms = float(os.environ.get("INFERENCE_BATCH_WAIT_MS", 20))
+        if workers:
+            from breadinfer import workers as inferworkers
+
+            # The worker pool is the executor, it's set when the handler is loaded (before the first batch runs)
+            self.batcher = InferenceBatcher(
+                inferworkers.analyze_batch,
+                max_batch_size=batch_size,
+                max_wait_ms=batch_wait_ms,
+                max_concurrent_batches=workers,
+                load_fn=self.load,
             )
         else:
-            import supervision as sv
-            from inference_sdk import InferenceConfiguration, InferenceHTTPClient
-
-            logger.info("Loading inference models: HTTP")
-            self.http_mask_annotator = sv.MaskAnnotator()
-            self.http_label_annotator = sv.LabelAnnotator()
-            self.http_client = InferenceHTTPClient(
-                api_url=os.environ.get("ROFOBLOW_ENDPOINT"),
-                api_key=os.environ.get("ROBOFLOW_API_KEY"),
+            # Micro-batching scheduler for the async fused pipeline
+            self.batcher = InferenceBatcher(
+                self.analyze_batch,
+                max_batch_size=batch_size,
+                max_wait_ms=batch_wait_ms,
+                load_fn=self.load,
             )
-            self.http_det_model = http_det_model
-            self.http_seg_model = http_seg_model
-        ...
 
-    async def async_labels_from_imgpath(
-        self, input_img_path: str = None, confidence: float = None
-    ):
-        """Async helper to run inference on detection(labels)
+    def __getattr__(self, name: str):
+        # Only called for missing attributes: the models are loaded the first time any of them is used
+        if name in MODEL_ATTRIBUTES and not self.__dict__.get("loaded", True):
+            self.load()
+            return getattr(self, name)
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'"
+        )
 
-        Args:
-            filename (_type_): _description_
+    def load(self) -> float:
+        """Loads the models (or starts the worker processes and waits for them). Does nothing if already loaded.
+        Blocking: from async code, run it in an executor
 
         Returns:
-            _type_: _description_
+            float: Load time in seconds
         """
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None, self.labels_from_imgpath, input_img_path, confidence
-        )
+        with self._load_lock:
+            if self.loaded:
+                return self.load_seconds
+            started = time.perf_counter()
+            if self.workers:
+                # Models are loaded once in each worker process instead of in this one
+                from breadinfer import workers as inferworkers
+
+                logger.info(f"Starting {self.workers} inference worker processes")
+                self._pool = inferworkers.create_worker_pool(
+                    self.workers,
+                    handler_kwargs={
+                        "local": self._local,
+                        "http_det_model": self.http_det_model,
+                        "local_det_model": self._local_det_name,
+                        "http_seg_model": self.http_seg_model,
+                        "local_seg_model": self._local_seg_name,
+                        "imgsz": self.imgsz,
+                        "backend": self.backend,
+                        "variant": self.variant,
+                    },
+                )
+                self.batcher.executor = self._pool
+            elif self._local:
+                logger.info(
+                    f"Loading inference models: Local ({self.backend}, {self.variant})"
+                )
+                from breadinfer.export import load_model
+
+                self.local_det_model = load_model(
+                    self._local_det_name,
+                    backend=self.backend,
+                    task="detect",
+                    imgsz=self.imgsz,
+                    variant=self.variant,
+                )
+                self.local_seg_model = load_model(
+                    self._local_seg_name,
+                    backend=self.backend,
+                    task="segment",
+                    imgsz=self.imgsz,
+                    variant=self.variant,
+                )
+            else:
+                import supervision as sv
+                from inference_sdk import InferenceHTTPClient
+
+                logger.info("Loading inference models: HTTP")
+                self.http_mask_annotator = sv.MaskAnnotator()
+                self.http_label_annotator = sv.LabelAnnotator()
+                self.http_client = InferenceHTTPClient(
+                    api_url=os.environ.get("ROFOBLOW_ENDPOINT"),
+                    api_key=os.environ.get("ROBOFLOW_API_KEY"),
+                )
+            self.load_seconds = time.perf_counter() - started
+            self.loaded = True
+            logger.info(f"Inference models loaded in {self.load_seconds:.2f}s")
+            return self.load_seconds
+
+    def warmup(self) -> dict:
+        """Loads the models and runs a first inference on a blank image, so the first real request
+        doesn't pay for the lazy initialization of the backends. Blocking: from async code, run it in an executor
+
+        Returns:
+            dict: Load and warmup times, see status
+        """
+        self.load()
+        if self.workers:
+            # Every worker warms its own models up when it starts (see workers.init_worker)
+            self.warmup_ms = 0.0
+            return self.status()
+        started = time.perf_counter()
+        blank = np.zeros((self.imgsz, self.imgsz, 3), dtype=np.uint8)
+        confidence = self.floor_confidence()
+        if self._local:
+            self.analyze_images([blank], confidence, confidence)
+        self.warmup_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"Inference models warmed up in {self.warmup_ms:.0f}ms")
+        return self.status()
+
+    def status(self) -> dict:
+        """Load state and times of the handler
+
+        Returns:
+            dict: model_id, whether it is loaded, load time (s) and warmup latency (ms)
+        """
+        return {
+            "model_id": self.model_id,
+            "workers": self.workers,
+            "loaded": self.loaded,
+            "load_seconds": self.load_seconds,
+            "warmup_ms": self.warmup_ms,
+        }
+
+    def shutdown(self):
+        """Stops the inference worker processes (if any). Batches already sent to them still finish"""
+        if self._pool is not None:
+            logger.info("Stopping inference worker processes")
+            self._pool.shutdown(wait=False)
+            self._pool = None
 
-    async def async_segmentation_from_imgpath(
+    async def async_analyze_imgpath(
         self,
         input_img_path: str = None,
         output_img_path: str = None,
-        confidence: float = None,
-    ) -> Tuple[str, Dict]:
-        """Async helper to run inference on segmentation
+        label_confidence: float = None,
+        seg_confidence: float = None,
+        bread_confidence: float = None,
+    ) -> BreadAnalysis:
+        """Async helper to run the fused detection + segmentation pipeline
+        Requests go through the micro-batching scheduler, so concurrent requests with the same
+        confidences share a single batched predict call
 
         Args:
-            input_img_path (str): _description_
-            output_img_path (str): _description_
+            input_img_path (str): Input image path
+            output_img_path (str, optional): Output image path. Defaults to None.
+            label_confidence (float, optional): Min confidence for the labels. Defaults to None.
+            seg_confidence (float, optional): Min confidence for the masks. Defaults to None.
+            bread_confidence (float, optional): Min "bread" confidence to run segmentation. Defaults to None.
 
         Returns:
-            Tuple[str, Dict]: _description_
+            BreadAnalysis: labels, masks, roundness and annotated image
         """
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            self.segmentation_from_imgpath,
-            input_img_path,
-            output_img_path,
-            confidence,
+        if input_img_path is None:
+            raise ValueError("Invalid image")
+        try:
+            return await self.batcher.submit(
+                key=self._batch_key(
+                    "path", label_confidence, seg_confidence, bread_confidence
+                ),
+                item=(input_img_path, output_img_path),
+            )
+        except BatcherClosed:
+            # This handler was replaced (reinit) after the caller got it: the current one runs the request
+            return await inferhandler.async_analyze_imgpath(
+                input_img_path,
+                output_img_path,
+                label_confidence,
+                seg_confidence,
+                bread_confidence,
+            )
+
+    async def async_analyze_bytes(
+        self,
+        image_bytes: bytes = None,
+        label_confidence: float = None,
+        seg_confidence: float = None,
+        bread_confidence: float = None,
+    ) -> BreadAnalysis:
+        """Async helper to run the fused detection + segmentation pipeline on an encoded image (e.g. jpg file contents)
+
+        Args:
+            image_bytes (bytes): Encoded image
+            label_confidence (float, optional): Min confidence for the labels. Defaults to None.
+            seg_confidence (float, optional): Min confidence for the masks. Defaults to None.
+            bread_confidence (float, optional): Min "bread" confidence to run segmentation. Defaults to None.
+
+        Returns:
+            BreadAnalysis: labels, masks, roundness and annotated image (encoded as jpg)
+        """
+        if not image_bytes:
+            raise ValueError("Invalid image")
+        # The models always run at the floor confidence and the raw predictions are cached by content hash,
+        # so reposts, "are you sure" overrides and threshold changes only re-filter them instead of running the models again
+        kind, label_floor, seg_floor, _ = self._batch_key("bytes")
+        cache_key, raw, raw_predictions = await run_in_cache_thread(
+            self._cache_lookup, image_bytes, label_floor, seg_floor
+        )
+        if raw is None or (
+            not raw.segmented
+            and (
+                bread_confidence is None
+                or raw.labels.get("bread", 0) > bread_confidence
+            )
+        ):
+            # The overlay is drawn in the same pass with the masks the caller keeps, so it isn't rendered twice
+            try:
+                raw = await self.batcher.submit(
+                    key=(
+                        kind,
+                        label_floor,
+                        seg_floor,
+                        bread_confidence,
+                        seg_confidence,
+                    ),
+                    item=image_bytes,
+                )
+            except BatcherClosed:
+                # This handler was replaced (reinit) after the caller got it: the current one runs the request
+                return await inferhandler.async_analyze_bytes(
+                    image_bytes, label_confidence, seg_confidence, bread_confidence
+                )
+            raw_predictions = await run_in_cache_thread(
+                self._cache_store, cache_key, raw
+            )
+        analysis = self.filter_analysis(raw, label_confidence, seg_confidence)
+        analysis.raw_predictions = raw_predictions
+        if analysis.masks and analysis.annotated_image_bytes is None:
+            loop = asyncio.get_event_loop()
+            analysis.annotated_image_bytes = await loop.run_in_executor(
+                None, self.render_bytes, image_bytes, analysis.masks
+            )
+        return analysis
+
+    def _cache_lookup(
+        self, image_bytes: bytes, label_floor: float, seg_floor: float
+    ) -> Tuple[str, Optional[BreadAnalysis], Optional[dict]]:
+        """Cache key of an image, its cached raw analysis and serialized predictions (None if it isn't cached).
+        Blocking: hashes the image and reads the persistent tier"""
+        cache_key = resultcache.key(
+            image_bytes,
+            self.model_id,
+            label_floor,
+            seg_floor,
+            self.stored_seg_confidence(),
         )
+        entry = resultcache.get(cache_key)
+        if entry is None:
+            return cache_key, None, None
+        return cache_key, BreadAnalysis.from_dict(entry), entry
 
-    def segmentation_from_imgpath(
+    def _cache_store(self, cache_key: str, raw: BreadAnalysis) -> dict:
+        """Caches a raw analysis, returns its serialized predictions. Blocking: writes the persistent tier"""
+        raw_predictions = self.stored_predictions(raw)
+        resultcache.put(cache_key, raw_predictions)
+        return raw_predictions
+
+    def decode_max_side(self) -> int:
+        """Longest side encoded images are decoded at (INFERENCE_MAX_IMAGE_SIDE, never below the model input size)"""
+        return max(MAX_IMAGE_SIDE, self.imgsz) if MAX_IMAGE_SIDE else 0
+
+    def floor_confidence(self) -> float:
+        """Confidence the models are run with (INFERENCE_FLOOR_CONFIDENCE). Every other threshold
+        (MIN_*, FILTER_*, detection) is applied afterwards on the raw predictions, so changing them never needs inference
+
+        Returns:
+            float: floor confidence
+        """
+        return float(os.environ.get("INFERENCE_FLOOR_CONFIDENCE", 0.01))
+
+    def stored_seg_confidence(self) -> float:
+        """Min confidence of the masks kept in the stored predictions (INFERENCE_STORED_SEG_CONFIDENCE).
+        Seg confidences under it can't be applied to stored or cached predictions
+
+        Returns:
+            float: stored seg confidence
+        """
+        return float(os.environ.get("INFERENCE_STORED_SEG_CONFIDENCE", 0.05))
+
+    def stored_predictions(self, analysis: BreadAnalysis) -> dict:
+        """Predictions as stored in DB and in the result cache (to_dict): the best detection of each label
+        (the only one that can change the labels at any label confidence) and the masks over the stored seg
+        confidence, so floor level noise isn't kept
+
+        Args:
+            analysis (BreadAnalysis): Raw analysis, at the floor confidence
+
+        Returns:
+            dict: Serializable predictions, see BreadAnalysis.to_dict
+        """
+        stored = self.filter_analysis(
+            analysis, seg_confidence=self.stored_seg_confidence()
+        )
+        stored.detections = list(stored.labels.items())
+        return stored.to_dict()
+
+    def _batch_key(
+        self,
+        kind: str,
+        label_confidence: float = None,
+        seg_confidence: float = None,
+        bread_confidence: float = None,
+    ) -> Tuple[str, float, float, float]:
+        """Batch key for the scheduler: only requests of the same kind and confidences can share a batch"""
+        if label_confidence is None:
+            label_confidence = self.floor_confidence()
+        if seg_confidence is None:
+            seg_confidence = self.floor_confidence()
+        return kind, label_confidence, seg_confidence, bread_confidence
+
+    def analyze_batch(
+        self, key: Tuple[str, float, float, float], items: list, compact: bool = False
+    ) -> List[BreadAnalysis]:
+        """Batch function for the scheduler
+
+        Args:
+            key (Tuple[str, float, float, float]): kind ("path" or "bytes") and confidences
+                ("bytes" keys may add the render confidence, see analyze_bytes)
+            items (list): (input, output) paths for "path" requests or encoded images for "bytes" requests
+            compact (bool, optional): Drop the decoded annotated image from the results,
+                so they are cheap to send between processes. Defaults to False.
+
+        Returns:
+            List[BreadAnalysis]: One result (or error) per item
+        """
+        kind, *confidences = key
+        if kind == "bytes":
+            analyses = self.analyze_bytes(items, *confidences, return_exceptions=True)
+        else:
+            input_img_paths, output_img_paths = zip(*items)
+            analyses = self.analyze_imgpaths(
+                list(input_img_paths),
+                list(output_img_paths),
+                *confidences,
+                return_exceptions=True,
+            )
+        if compact:
+            for analysis in analyses:
+                if isinstance(analysis, BreadAnalysis):
+                    analysis.annotated_image = None
+        return analyses
+
+    def analyze_imgpath(
         self,
         input_img_path: str = None,
         output_img_path: str = None,
-        confidence: float = None,
-    ) -> Tuple[str, dict]:
-        """Creates segmentation image
-        Uses model from https://universe.roboflow.com/school-dkgod/bread-segmentation-hfhm8/model/4
-        Creates a new image that has the segmented bread drawn over it. Returns image path and the results (json object)
+        label_confidence: float = None,
+        seg_confidence: float = None,
+        bread_confidence: float = None,
+    ) -> BreadAnalysis:
+        """Fused detection + segmentation pipeline for a single image, see analyze_imgpaths
+
         Args:
-            input_img (str, optional): Input image path. Defaults to None.
-            output_img (str, optional): Output image path to be written to. Defaults to None: If None, it will be saved on default location.
+            input_img_path (str, optional): Input image path. Defaults to None.
+            output_img_path (str, optional): Output image path to be written to. Defaults to None: If None, it will be saved on default location.
+            label_confidence (float, optional): Min confidence for the labels. Defaults to INFERENCE_FLOOR_CONFIDENCE.
+            seg_confidence (float, optional): Min confidence for the masks. Defaults to INFERENCE_FLOOR_CONFIDENCE.
+            bread_confidence (float, optional): Segmentation only runs if the "bread" label is over this value.
+                Defaults to None: segmentation always runs.
 
         Raises:
-            ValueError: Raise error if input image is not provided
+            ValueError: Raise error if input image is not provided or can't be read
 
         Returns:
-            output_img_path: path of the saved file (will match output_img_path if it's not null)
-            result: json object with the results from the API
+            BreadAnalysis: labels, masks, roundness and annotated image
         """
-
         if input_img_path is None:
             raise ValueError("Invalid image")
-        if confidence is None:
-            confidence = float(os.environ.get("MIN_BREAD_SEG_CONFIDENCE"))
-        if output_img_path is None:
-            # Default to standard output folder
-            outputfolder = os.path.join(os.getcwd(), "output", "segmented")
-            os.makedirs(outputfolder, exist_ok=True)
-            output_img_path = os.path.join(
-                outputfolder, os.path.basename(input_img_path)
+        return self.analyze_imgpaths(
+            [input_img_path],
+            [output_img_path],
+            label_confidence,
+            seg_confidence,
+            bread_confidence,
+        )[0]
+
+    def analyze_imgpaths(
+        self,
+        input_img_paths: List[str] = None,
+        output_img_paths: List[str] = None,
+        label_confidence: float = None,
+        seg_confidence: float = None,
+        bread_confidence: float = None,
+        return_exceptions: bool = False,
+    ) -> List[BreadAnalysis]:
+        """Fused detection + segmentation pipeline for images on disk, see analyze_images
+        Annotated images are written to the output paths
+
+        Args:
+            input_img_paths (List[str], optional): Input image paths. Defaults to None.
+            output_img_paths (List[str], optional): Output image paths to be written to. Defaults to None: If None, they will be saved on default location.
+            label_confidence (float, optional): Min confidence for the labels. Defaults to INFERENCE_FLOOR_CONFIDENCE.
+            seg_confidence (float, optional): Min confidence for the masks. Defaults to INFERENCE_FLOOR_CONFIDENCE.
+            bread_confidence (float, optional): Segmentation only runs if the "bread" label is over this value.
+                Defaults to None: segmentation always runs.
+            return_exceptions (bool, optional): Return the error in place of the result for images that can't be read
+                instead of raising it. Defaults to False.
+
+        Raises:
+            ValueError: Raise error if input images are not provided or can't be read
+
+        Returns:
+            List[BreadAnalysis]: labels, masks, roundness and annotated image for each image
+        """
+        if not input_img_paths:
+            raise ValueError("Invalid image")
+        if output_img_paths is None:
+            output_img_paths = [None] * len(input_img_paths)
+        images = []
+        for input_img_path in input_img_paths:
+            image = cv2.imread(input_img_path)
+            if image is None:
+                image = ValueError(f"Couldn't read image: {input_img_path}")
+                if not return_exceptions:
+                    raise image
+            images.append(image)
+        logger.info(f"Computing fused inference for: {input_img_paths}")
+        results = self.analyze_images(
+            images, label_confidence, seg_confidence, bread_confidence
+        )
+        for analysis, input_img_path, output_img_path in zip(
+            results, input_img_paths, output_img_paths
+        ):
+            if isinstance(analysis, Exception) or analysis.annotated_image is None:
+                continue
+            if output_img_path is None:
+                # Default to standard output folder
+                outputfolder = os.path.join(os.getcwd(), "output", "segmented")
+                output_img_path = os.path.join(
+                    outputfolder, os.path.basename(input_img_path)
+                )
+            os.makedirs(os.path.dirname(output_img_path), exist_ok=True)
+            cv2.imwrite(output_img_path, analysis.annotated_image)
+            logger.info(f"Written image for Segmentation: {output_img_path}")
+            analysis.output_img_path = output_img_path
+        return results
+
+    def analyze_bytes(
+        self,
+        images_bytes: List[bytes] = None,
+        label_confidence: float = None,
+        seg_confidence: float = None,
+        bread_confidence: float = None,
+        render_confidence: float = None,
+        return_exceptions: bool = False,
+    ) -> List[BreadAnalysis]:
+        """Fused detection + segmentation pipeline for encoded images, see analyze_images
+        Annotated images are encoded back as jpg (annotated_image_bytes)
+
+        Args:
+            images_bytes (List[bytes], optional): Encoded images. Defaults to None.
+            label_confidence (float, optional): Min confidence for the labels. Defaults to INFERENCE_FLOOR_CONFIDENCE.
+            seg_confidence (float, optional): Min confidence for the masks. Defaults to INFERENCE_FLOOR_CONFIDENCE.
+            bread_confidence (float, optional): Segmentation only runs if the "bread" label is over this value.
+                Defaults to None: segmentation always runs.
+            render_confidence (float, optional): Only masks over this confidence are drawn on the annotated image.
+                Defaults to None: seg_confidence.
+            return_exceptions (bool, optional): Return the error in place of the result for images that can't be
+                decoded instead of raising it. Defaults to False.
+
+        Raises:
+            ValueError: Raise error if input images are not provided, can't be decoded or are too large
+                (INFERENCE_MAX_IMAGE_BYTES / INFERENCE_MAX_IMAGE_PIXELS)
+
+        Returns:
+            List[BreadAnalysis]: labels, masks, roundness and annotated image for each image
+        """
+        if not images_bytes:
+            raise ValueError("Invalid image")
+        images, scales = [], []
+        for image_bytes in images_bytes:
+            # Decoded at the size the models and the reply need, not the full photo size
+            try:
+                image, scale = decode_image(
+                    image_bytes, max_side=self.decode_max_side()
+                )
+            except ValueError as e:
+                if not return_exceptions:
+                    raise
+                image, scale = e, None
+            images.append(image)
+            scales.append(scale)
+        logger.info(f"Computing fused inference for {len(images)} encoded images")
+        results = self.analyze_images(
+            images,
+            label_confidence,
+            seg_confidence,
+            bread_confidence,
+            render_confidence,
+        )
+        for analysis, scale in zip(results, scales):
+            if isinstance(analysis, Exception):
+                continue
+            if analysis.masks and scale != (1.0, 1.0):
+                # Masks (and roundness) are stored in original image coordinates
+                analysis.masks = scale_polygons(analysis.masks, scale)
+                (
+                    analysis.instance_roundness,
+                    analysis.roundness,
+                ) = self.estimate_roundness_from_polygons(analysis.masks)
+            if analysis.annotated_image is None:
+                continue
+            ok, buffer = cv2.imencode(".jpg", analysis.annotated_image)
+            if ok:
+                analysis.annotated_image_bytes = buffer.tobytes()
+        return results
+
+    def analyze_images(
+        self,
+        images: List[np.ndarray] = None,
+        label_confidence: float = None,
+        seg_confidence: float = None,
+        bread_confidence: float = None,
+        render_confidence: float = None,
+    ) -> List[BreadAnalysis]:
+        """Fused detection + segmentation pipeline
+        Each image is (for local models) letterboxed once: the same input tensor is fed
+        to both the detection and the segmentation model, so the decode and preprocessing only happen once.
+        All the images are run as a single batch on each model.
+
+        Args:
+            images (List[np.ndarray], optional): Decoded BGR images. Exceptions in the list are passed through as results.
+            label_confidence (float, optional): Min confidence for the labels. Defaults to INFERENCE_FLOOR_CONFIDENCE.
+            seg_confidence (float, optional): Min confidence for the masks. Defaults to INFERENCE_FLOOR_CONFIDENCE.
+            bread_confidence (float, optional): Segmentation only runs if the "bread" label is over this value.
+                Defaults to None: segmentation always runs.
+            render_confidence (float, optional): Only masks over this confidence are drawn on the annotated image.
+                Defaults to None: seg_confidence.
+
+        Returns:
+            List[BreadAnalysis]: labels, masks, roundness and annotated image for each image
+        """
+        if label_confidence is None:
+            label_confidence = self.floor_confidence()
+        if seg_confidence is None:
+            seg_confidence = self.floor_confidence()
+        if render_confidence is None:
+            render_confidence = seg_confidence
+        valid_images = [image for image in images if not isinstance(image, Exception)]
+        if not valid_images:
+            analyses = []
+        elif self._local:
+            analyses = self._analyze_local(
+                valid_images,
+                label_confidence,
+                seg_confidence,
+                bread_confidence,
+                render_confidence,
             )
         else:
-            # Create output folder as requested
-            outputfolder = os.path.dirname(output_img_path)
-            os.makedirs(outputfolder, exist_ok=True)
-        if self._local:
-            # Get inference and file from computing with local YOLOv8 model
-            logger.info(f"Computing local inference for segmentation: {input_img_path}")
-            results = self.local_seg_model.predict(
-                input_img_path,
-                save=True,
-                device="cpu",
-                conf=confidence,
-                project="output",
-                name="segmented",
-                exist_ok=True,
-                show_labels=False,
-                show_conf=False,
-                show_boxes=False,
-            )
-            if results and results[0].masks is not None:
-                # It's saved when running predict but we can't set the path directly so we retrieve it here and moved to destination path
-                temp_filepath = os.path.join(
-                    results[0].save_dir, os.path.basename(results[0].path)
+            analyses = [
+                self._analyze_http(
+                    image,
+                    label_confidence,
+                    seg_confidence,
+                    bread_confidence,
+                    render_confidence,
                 )
-                logger.debug(f"Moving from {temp_filepath} to {output_img_path}")
-                shutil.move(temp_filepath, output_img_path)
-                logger.debug(f"File moved from {temp_filepath} to {output_img_path}")
-                return output_img_path, results
+                for image in valid_images
+            ]
+        analyses = iter(analyses)
+        results = []
+        for image in images:
+            if isinstance(image, Exception):
+                results.append(image)
             else:
-                return None, None
+                analysis = next(analyses)
+                logger.info(f"Label Predictions: {analysis.labels}")
+                results.append(analysis)
+        return results
+
+    def _analyze_local(
+        self,
+        images: List[np.ndarray],
+        label_confidence: float,
+        seg_confidence: float,
+        bread_confidence: float = None,
+        render_confidence: float = None,
+    ) -> List[BreadAnalysis]:
+        """Runs both local models on the same letterboxed batch tensor
+
+        Args:
+            images (List[np.ndarray]): BGR images, already decoded
+            label_confidence (float): Min confidence for the labels
+            seg_confidence (float): Min confidence for the masks
+            bread_confidence (float, optional): Min "bread" confidence to run segmentation. Defaults to None.
+            render_confidence (float, optional): Min confidence of the masks drawn. Defaults to None (all of them).
+
+        Returns:
+            List[BreadAnalysis]: labels, masks, roundness and annotated image for each image
+        """
+        import torch
+
+        letterboxed = [self.letterbox_tensor(image) for image in images]
+        tensor = torch.cat([item[0] for item in letterboxed])
+        # Tensor inputs are taken as already preprocessed by ultralytics: no second resize/letterbox
+        det_results = self.local_det_model.predict(
+            tensor, save=False, device="cpu", conf=label_confidence, verbose=False
+        )
+        analyses = []
+        for det_result in det_results:
+            detections = self.detections_from_results([det_result])
+            analyses.append(
+                BreadAnalysis(
+                    labels=self.labels_from_detections(detections),
+                    detections=detections,
+                )
+            )
+        seg_idxs = [
+            idx
+            for idx, analysis in enumerate(analyses)
+            if bread_confidence is None
+            or analysis.labels.get("bread", 0) > bread_confidence
+        ]
+        if not seg_idxs:
+            return analyses
+        seg_results = self.local_seg_model.predict(
+            tensor[seg_idxs],
+            save=False,
+            device="cpu",
+            conf=seg_confidence,
+            verbose=False,
+        )
+        for idx, seg_result in zip(seg_idxs, seg_results):
+            analysis = analyses[idx]
+            analysis.segmented = True
+            if seg_result.masks is None:
+                continue
+            _, gain, pad = letterboxed[idx]
+            analysis.masks = [
+                (polygon - np.array(pad)) / gain for polygon in seg_result.masks.xy
+            ]
+            analysis.mask_confidences = seg_result.boxes.conf.tolist()
+            (
+                analysis.instance_roundness,
+                analysis.roundness,
+            ) = self.estimate_roundness_from_polygons(analysis.masks)
+            drawn = [
+                mask
+                for mask, confidence in zip(analysis.masks, analysis.mask_confidences)
+                if render_confidence is None or confidence >= render_confidence
+            ]
+            if drawn:
+                analysis.annotated_image = self.draw_masks(images[idx], drawn)
+                analysis.annotated_confidence = render_confidence or 0
+        return analyses
+
+    def _analyze_http(
+        self,
+        image: np.ndarray,
+        label_confidence: float,
+        seg_confidence: float,
+        bread_confidence: float = None,
+        render_confidence: float = None,
+    ) -> BreadAnalysis:
+        """Runs both roboflow models on the same decoded image
+
+        Args:
+            image (np.ndarray): BGR image, already decoded
+            label_confidence (float): Min confidence for the labels
+            seg_confidence (float): Min confidence for the masks
+            bread_confidence (float, optional): Min "bread" confidence to run segmentation. Defaults to None.
+            render_confidence (float, optional): Min confidence of the masks drawn. Defaults to None (all of them).
+
+        Returns:
+            BreadAnalysis: labels, masks and annotated image
+        """
+        result = self.http_client.infer(image, model_id=self.http_det_model)
+        detections = [
+            (prediction["class"], prediction["confidence"])
+            for prediction in result["predictions"]
+            if prediction["confidence"] >= label_confidence
+        ]
+        analysis = BreadAnalysis(
+            labels=self.labels_from_detections(detections), detections=detections
+        )
+        if (
+            bread_confidence is not None
+            and analysis.labels.get("bread", 0) <= bread_confidence
+        ):
+            return analysis
+        result = self.http_client.infer(image, model_id=self.http_seg_model)
+        analysis.segmented = True
+        result["predictions"] = [
+            prediction
+            for prediction in result["predictions"]
+            if prediction["confidence"] >= seg_confidence
+        ]
+        if not result["predictions"]:
+            return analysis
+        analysis.masks = [
+            np.array(
+                [[point["x"], point["y"]] for point in prediction["points"]],
+                dtype=np.float32,
+            )
+            for prediction in result["predictions"]
+        ]
+        analysis.mask_confidences = [
+            prediction["confidence"] for prediction in result["predictions"]
+        ]
+        (
+            analysis.instance_roundness,
+            analysis.roundness,
+        ) = self.estimate_roundness_from_polygons(analysis.masks)
+        drawn = [
+            prediction
+            for prediction in result["predictions"]
+            if render_confidence is None
+            or prediction["confidence"] >= render_confidence
+        ]
+        if drawn:
+            analysis.annotated_image = self.annotate_mask(
+                image=image, result={**result, "predictions": drawn}
+            )
+            analysis.annotated_confidence = render_confidence or 0
+        return analysis
+
+    def letterbox_tensor(self, image: np.ndarray):
+        """Resizes and pads the image to the model input size (same as ultralytics letterbox)
+        and turns it into a normalized BCHW RGB tensor, ready to be fed to any of the local models
+
+        Args:
+            image (np.ndarray): BGR image
+
+        Returns:
+            tensor: torch tensor (1, 3, imgsz, imgsz)
+            gain: resize ratio applied to the image
+            pad: (x, y) padding added on the left/top side
+        """
+        import torch
+
+        height, width = image.shape[:2]
+        gain = min(self.imgsz / height, self.imgsz / width)
+        new_width, new_height = round(width * gain), round(height * gain)
+        pad_x, pad_y = (self.imgsz - new_width) / 2, (self.imgsz - new_height) / 2
+        if (new_width, new_height) != (width, height):
+            image = cv2.resize(
+                image, (new_width, new_height), interpolation=cv2.INTER_LINEAR
+            )
+        top, bottom = round(pad_y - 0.1), round(pad_y + 0.1)
+        left, right = round(pad_x - 0.1), round(pad_x + 0.1)
+        image = cv2.copyMakeBorder(
+            image,
+            top,
+            bottom,
+            left,
+            right,
+            cv2.BORDER_CONSTANT,
+            value=(114, 114, 114),
+        )
+        # BGR HWC uint8 -> RGB CHW float (0 to 1)
+        array = np.ascontiguousarray(image[..., ::-1].transpose(2, 0, 1))
+        tensor = torch.from_numpy(array).float().div_(255.0).unsqueeze(0)
+        return tensor, gain, (left, top)
+
+    def detections_from_results(self, results) -> List[Tuple[str, float]]:
+        """Turns local detection results into a list of (name, confidence)
+
+        Args:
+            results: ultralytics results (only the first image is read)
+
+        Returns:
+            List[Tuple[str, float]]: detections
+        """
+        detections = []
+        if results and results[0].boxes is not None:
+            names = results[0].names
+            for cls, confidence in zip(
+                results[0].boxes.cls.tolist(), results[0].boxes.conf.tolist()
+            ):
+                detections.append((names[int(cls)], confidence))
+        return detections
+
+    def labels_from_detections(
+        self, detections: List[Tuple[str, float]], min_confidence: float = 0
+    ) -> Dict[str, float]:
+        """Turns detections into predictions as key (name) and confidence (value)
+        If a label is found more than once, the highest confidence is kept
+
+        Args:
+            detections (List[Tuple[str, float]]): detections as (name, confidence)
+            min_confidence (float, optional): Detections under this confidence are ignored. Defaults to 0.
+
+        Returns:
+            predictions:dict: predictions as key (name) and confidence (value)
+        """
+        predictions = {}
+        for name, confidence in detections:
+            if confidence >= min_confidence:
+                predictions[name] = max(confidence, predictions.get(name, 0))
+        return predictions
+
+    def filter_analysis(
+        self,
+        analysis: BreadAnalysis,
+        label_confidence: float = None,
+        seg_confidence: float = None,
+    ) -> BreadAnalysis:
+        """Re-filters an analysis at higher confidences, without running the models again.
+        Roundness is recomputed from the remaining masks. The annotated image is only kept if it shows exactly
+        the remaining masks
+
+        Args:
+            analysis (BreadAnalysis): Analysis computed at lower (or equal) confidences
+            label_confidence (float, optional): Min confidence for the labels. Defaults to None (no filter).
+            seg_confidence (float, optional): Min confidence for the masks. Defaults to None (no filter).
+
+        Returns:
+            BreadAnalysis: Filtered analysis
+        """
+        label_confidence = label_confidence or 0
+        seg_confidence = seg_confidence or 0
+        detections = [
+            detection
+            for detection in analysis.detections
+            if detection[1] >= label_confidence
+        ]
+        keep = [
+            idx
+            for idx, confidence in enumerate(analysis.mask_confidences)
+            if confidence >= seg_confidence
+        ]
+        filtered = BreadAnalysis(
+            labels=self.labels_from_detections(detections),
+            detections=detections,
+            masks=[analysis.masks[idx] for idx in keep],
+            mask_confidences=[analysis.mask_confidences[idx] for idx in keep],
+            segmented=analysis.segmented,
+        )
+        if analysis.annotated_confidence is not None and keep == [
+            idx
+            for idx, confidence in enumerate(analysis.mask_confidences)
+            if confidence >= analysis.annotated_confidence
+        ]:
+            filtered.annotated_image = analysis.annotated_image
+            filtered.annotated_image_bytes = analysis.annotated_image_bytes
+            filtered.annotated_confidence = analysis.annotated_confidence
+        if len(keep) == len(analysis.masks):
+            filtered.roundness = analysis.roundness
+            filtered.instance_roundness = analysis.instance_roundness
         else:
-            logger.info(f"Requesting Inference for Segmentation on: {input_img_path}")
-            result = self.http_client.infer(
-                input_img_path, model_id=self.http_seg_model
+            (
+                filtered.instance_roundness,
+                filtered.roundness,
+            ) = self.estimate_roundness_from_polygons(filtered.masks)
+        return filtered
+
+    def rescore_predictions(
+        self,
+        predictions: dict,
+        label_confidence: float = None,
+        seg_confidence: float = None,
+    ) -> Tuple[Dict[str, float], Optional[float]]:
+        """Recomputes labels and roundness from stored raw predictions (BreadAnalysis.to_dict) at new confidences
+
+        Args:
+            predictions (dict): Raw predictions
+            label_confidence (float, optional): Min confidence for the labels. Defaults to None (no filter).
+            seg_confidence (float, optional): Min confidence for the masks. Defaults to None (no filter).
+
+        Returns:
+            labels: predictions as key (name) and confidence (value)
+            roundness: roundness of the remaining masks (None if there are none)
+        """
+        filtered = self.filter_analysis(
+            BreadAnalysis.from_dict(predictions), label_confidence, seg_confidence
+        )
+        return filtered.labels, filtered.roundness
+
+    def render_bytes(self, image_bytes: bytes, masks: List[np.ndarray]) -> bytes:
+        """Draws the masks over an encoded image and encodes the result as jpg
+
+        Args:
+            image_bytes (bytes): Encoded image
+            masks (List[np.ndarray]): polygons in original image coordinates
+
+        Returns:
+            bytes: Annotated jpg image, at the decoded size (None if the image can't be decoded/encoded)
+        """
+        try:
+            image, (scale_x, scale_y) = decode_image(
+                image_bytes, max_side=self.decode_max_side()
             )
-            image = cv2.imread(input_img_path)
-            annotated_image = self.annotate_mask(image=image, result=result)
-            cv2.imwrite(output_img_path, annotated_image)
-            logger.info(f"Written image for Segmentation: {output_img_path}")
-            return output_img_path, result
+        except ValueError:
+            return None
+        masks = scale_polygons(masks, (1 / scale_x, 1 / scale_y))
+        ok, buffer = cv2.imencode(".jpg", self.draw_masks(image, masks))
+        return buffer.tobytes() if ok else None
+
+    def draw_masks(
+        self, image: np.ndarray, masks: List[np.ndarray], alpha: float = 0.5
+    ) -> np.ndarray:
+        """Draws the segmentation polygons over (a copy of) the image
+
+        Args:
+            image (np.ndarray): BGR image
+            masks (List[np.ndarray]): polygons in image coordinates
+            alpha (float, optional): Opacity of the filled masks. Defaults to 0.5.
+
+        Returns:
+            np.ndarray: Annotated image
+        """
+        polygons = [np.int32(np.round(mask)) for mask in masks if len(mask)]
+        overlay = image.copy()
+        cv2.fillPoly(overlay, polygons, (56, 56, 255))
+        annotated = cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0)
+        cv2.polylines(annotated, polygons, True, (56, 56, 255), 2)
+        return annotated
 
     def annotate_labels(self, image: np.ndarray, result: dict) -> np.ndarray:
         """Input is Result from the inference
@@ -258,59 +1137,6 @@ class InferenceHandler:
                 )
             return reshaped_image
 
-    def labels_from_imgpath(
-        self, input_img_path: str = None, confidence: float = None
-    ) -> Dict[str, float]:
-        """Generate labels for the image
-
-        Args:
-            input_img (str, optional): Input image path. Defaults to None.
-
-        Raises:
-            ValueError: Raises error if input is null
-
-        Returns:
-            predictions:dict: predictions as key (name) and confidence (value)
-        """
-        # https://universe.roboflow.com/class-tu4kk/bread-seg/model/7
-        if input_img_path is None:
-            raise ValueError("invalid image")
-        if confidence is None:
-            confidence = float(os.environ.get("MIN_BREAD_LABEL_CONFIDENCE"))
-        if self._local:
-            # Compute inference with local model
-            logger.info(f"Computing label predictions for: {input_img_path}")
-            results = self.local_det_model.predict(
-                input_img_path,
-                save=False,
-                device="cpu",
-                conf=confidence,
-            )
-            if results:
-                resulttojson = json.loads(
-                    results[0].tojson()
-                )  # We already check if there's any and we only expect one image when we call this
-                predictions = {
-                    prediction["name"]: prediction["confidence"]
-                    for prediction in resulttojson
-                }
-            else:
-                predictions = {}
-            logger.info(f"Label Predictions: {predictions}")
-            return predictions
-        else:
-            # Compute with Roboflow
-            logger.info(f"Requesting label predictions for: {input_img_path}")
-            result = self.http_client.infer(
-                input_img_path, model_id=self.http_det_model
-            )
-            predictions = {
-                prediction["class"]: prediction["confidence"]
-                for prediction in result["predictions"]
-            }
-            logger.info(f"Label Predictions: {predictions}")
-            return predictions
-
     def map_confidence_to_sentiment(self, confidence: float, label: str) -> str:
         """Translate a confidence percentage to a text to indicate how accurate the element is
 
@@ -367,49 +1193,54 @@ class InferenceHandler:
         """Estimates roundness from mask, based on how close it is to a perfect circunscribed circle
 
         Args:
-            results (float): percentage (0 to 1) of roundness
+            results: ultralytics segmentation results (only the first image is read)
 
         Raises:
-            ValueError: _description_
-            ValueError: _description_
-            ValueError: _description_
+            ValueError: Raised if there are no masks
 
         Returns:
-            float: _description_
+            float: percentage (0 to 1) of roundness, see estimate_roundness_from_polygons
         """
-        if results and results[0].masks is not None:
-            orig_shape = results[0].masks.orig_shape
-            mask = results[0].masks.xy
-        else:
+        if not results or results[0].masks is None:
             raise ValueError("No masks to read")
-        if orig_shape is None:
-            raise ValueError("Orig Shape is mandatory")
-        if mask is None:
-            raise ValueError("Mask is mandatory")
-        black_image = np.zeros(
-            (orig_shape[0], orig_shape[1], 3), dtype=np.uint8
-        )  # Empty image to draw lines and use to estimate contours
-        cv2.polylines(black_image, np.int32([mask]), True, (255, 255, 255), 2)
-        gray_image = cv2.cvtColor(
-            black_image, cv2.COLOR_BGR2GRAY
-        )  # Polylines turns the image to BGR so we need to turn it back to grayscale
-        # Find contours in the mask
-        contours, _ = cv2.findContours(
-            gray_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-        )
-        # Assuming there's only one closed contour
-        if contours:
-            contour = contours[0]
-            # Calculate area of the contour
-            area = cv2.contourArea(contour)
-            # Calculate minimum enclosing circle and its area
-            (x, y), radius = cv2.minEnclosingCircle(contour)
+        _, roundness = self.estimate_roundness_from_polygons(results[0].masks.xy)
+        return roundness
+
+    def estimate_roundness_from_polygons(
+        self, polygons: List[np.ndarray]
+    ) -> Tuple[List[Optional[float]], Optional[float]]:
+        """Estimates roundness of each mask instance straight from its polygon (no image is drawn):
+        ratio of the polygon area to the area of its minimum enclosing circle
+
+        Args:
+            polygons (List[np.ndarray]): One (N, 2) array of points per instance
+
+        Returns:
+            instance_roundness: percentage (0 to 1) of roundness for each instance (None for degenerate polygons)
+            roundness: aggregate roundness, area-weighted mean of the instances (None if there are none)
+        """
+        instance_roundness = []
+        areas = []
+        for polygon in polygons:
+            points = np.asarray(polygon, dtype=np.float32).reshape(-1, 2)
+            if len(points) < 3:
+                instance_roundness.append(None)
+                continue
+            # Shoelace formula for the polygon area
+            x, y = points[:, 0].astype(np.float64), points[:, 1].astype(np.float64)
+            area = 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+            _, radius = cv2.minEnclosingCircle(points)
             circle_area = np.pi * radius**2
-            # Calculate roundness (ratio of contour area to area of minimum enclosing circle)
-            roundness = area / circle_area
-            return roundness
-        else:
-            return None
+            if area <= 0 or circle_area <= 0:
+                instance_roundness.append(None)
+                continue
+            instance_roundness.append(min(float(area / circle_area), 1.0))
+            areas.append(area)
+        valid = [value for value in instance_roundness if value is not None]
+        if not valid:
+            return instance_roundness, None
+        roundness = float(np.average(valid, weights=areas))
+        return instance_roundness, roundness
 
     def get_message_from_roundness(self, roundness: float = None):
         if roundness is None:
@@ -419,8 +1250,13 @@ class InferenceHandler:
         return messagecontent
 
 
-# Default inference handler with local models ready to import
-inferhandler = InferenceHandler(local=True)
+# Default inference handler ready to import. Models are loaded on first use or by warmup (see main.py startup)
+inferhandler = InferenceHandler(
+    local=True,
+    workers=int(os.environ.get("INFERENCE_WORKERS", 0)),
+    backend=os.environ.get("INFERENCE_BACKEND", "pytorch"),
+    variant=os.environ.get("INFERENCE_MODEL_VARIANT", "fp32"),
+)
 
 if __name__ == "__main__":
     from dotenv import load_dotenv
@@ -431,9 +1267,9 @@ if __name__ == "__main__":
     input_img = "downloads/IMG_3904.png"
     output_img = "output/segmented/roboresult.png"
 
-    labels = inferhandler.labels_from_imgpath(input_img_path=input_img)
-    if "bread" in labels.keys():
-        _, result = inferhandler.segmentation_from_imgpath(
-            input_img_path=input_img, output_img_path=output_img
-        )
-        print("A")
+    analysis = inferhandler.analyze_imgpath(
+        input_img_path=input_img,
+        output_img_path=output_img,
+        bread_confidence=float(os.environ.get("MIN_BREAD_LABEL_CONFIDENCE", 0)),
+    )
+    logger.info(f"Labels: {analysis.labels}, roundness: {analysis.roundness}")
@@ -0,0 +1,190 @@
+import os
+import struct
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Larger images are rejected before decoding them
+MAX_IMAGE_BYTES = int(os.environ.get("INFERENCE_MAX_IMAGE_BYTES", 25 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get("INFERENCE_MAX_IMAGE_PIXELS", 50_000_000))
+# Images are decoded (and downscaled) to this longest side at most: enough for the models and the annotated reply.
+# 0 decodes them at full resolution
+MAX_IMAGE_SIDE = int(os.environ.get("INFERENCE_MAX_IMAGE_SIDE", 1280))
+
+# JPEG start of frame markers (every one except DHT C4, JPG C8 and DAC CC)
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# IMREAD_REDUCED_* decode JPEGs straight at 1/2, 1/4 or 1/8 of the size (DCT scaling): faster and less memory
+_REDUCED_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+
+def is_jpeg(image_bytes: bytes) -> bool:
+    return image_bytes[:3] == b"\xff\xd8\xff"
+
+
+def image_format(image_bytes: bytes) -> Optional[str]:
+    """Format of an encoded image from its magic bytes, only the ones decode_image handles
+
+    Args:
+        image_bytes (bytes): Encoded image (at least its first 12 bytes)
+
+    Returns:
+        Optional[str]: jpeg, png, webp or bmp. None for anything else
+    """
+    if is_jpeg(image_bytes):
+        return "jpeg"
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "webp"
+    if image_bytes[:2] == b"BM":
+        return "bmp"
+    return None
+
+
+def _webp_dimensions(image_bytes: bytes) -> Optional[Tuple[int, int]]:
+    # First chunk of the RIFF container: lossy (VP8), lossless (VP8L) or extended (VP8X, canvas size)
+    chunk = image_bytes[12:16]
+    if (
+        chunk == b"VP8 "
+        and len(image_bytes) >= 30
+        and image_bytes[23:26] == b"\x9d\x01\x2a"
+    ):
+        width, height = struct.unpack("<HH", image_bytes[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(image_bytes) >= 25 and image_bytes[20] == 0x2F:
+        (bits,) = struct.unpack("<I", image_bytes[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(image_bytes) >= 30:
+        width = int.from_bytes(image_bytes[24:27], "little") + 1
+        height = int.from_bytes(image_bytes[27:30], "little") + 1
+        return width, height
+    return None
+
+
+def _bmp_dimensions(image_bytes: bytes) -> Optional[Tuple[int, int]]:
+    if len(image_bytes) < 26:
+        return None
+    (header_size,) = struct.unpack("<I", image_bytes[14:18])
+    if header_size == 12:  # BITMAPCOREHEADER
+        return struct.unpack("<HH", image_bytes[18:22])
+    width, height = struct.unpack("<ii", image_bytes[18:26])
+    return abs(width), abs(height)  # Negative height: rows stored top-down
+
+
+def image_dimensions(image_bytes: bytes) -> Optional[Tuple[int, int]]:
+    """Width and height of an image read from its header, without decoding it
+
+    Args:
+        image_bytes (bytes): Encoded image
+
+    Returns:
+        Optional[Tuple[int, int]]: (width, height), None for other formats (see image_format) or broken headers
+    """
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n" and len(image_bytes) >= 24:
+        return struct.unpack(">II", image_bytes[16:24])
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return _webp_dimensions(image_bytes)
+    if image_bytes[:2] == b"BM":
+        return _bmp_dimensions(image_bytes)
+    if not is_jpeg(image_bytes):
+        return None
+    i = 2
+    while i + 9 <= len(image_bytes):
+        if image_bytes[i] != 0xFF:
+            return None
+        marker = image_bytes[i + 1]
+        if marker == 0xFF:  # Fill byte
+            i += 1
+            continue
+        if marker in _JPEG_SOF:
+            height, width = struct.unpack(">HH", image_bytes[i + 5 : i + 9])
+            return width, height
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # No length
+            i += 2
+            continue
+        (length,) = struct.unpack(">H", image_bytes[i + 2 : i + 4])
+        i += 2 + length
+    return None
+
+
+def decode_image(
+    image_bytes: bytes,
+    max_side: int = MAX_IMAGE_SIDE,
+    max_pixels: int = MAX_IMAGE_PIXELS,
+    max_bytes: int = MAX_IMAGE_BYTES,
+) -> Tuple[np.ndarray, Tuple[float, float]]:
+    """Decodes an image at (about) the resolution it's needed at: JPEGs are decoded reduced (DCT scaling) and
+    anything still larger than max_side is downscaled
+
+    Args:
+        image_bytes (bytes): Encoded image
+        max_side (int, optional): Max longest side of the decoded image, 0 for full resolution.
+            Defaults to MAX_IMAGE_SIDE.
+        max_pixels (int, optional): Max pixels of the original image. Defaults to MAX_IMAGE_PIXELS.
+        max_bytes (int, optional): Max size of the encoded image. Defaults to MAX_IMAGE_BYTES.
+
+    Raises:
+        ValueError: The image is too large, its format isn't supported (see image_format) or it can't be decoded
+
+    Returns:
+        Tuple[np.ndarray, Tuple[float, float]]: BGR image and (x, y) scale from its coordinates to the original ones
+    """
+    if len(image_bytes) > max_bytes:
+        raise ValueError(f"Image too large ({len(image_bytes)} bytes)")
+    # Checked before decoding: a small file can still decode to a huge image
+    dimensions = image_dimensions(image_bytes)
+    if dimensions is None:
+        raise ValueError("Unsupported image format or unreadable header")
+    if dimensions[0] * dimensions[1] > max_pixels:
+        raise ValueError(f"Image too large ({dimensions[0]}x{dimensions[1]})")
+    factor, flag = 1, cv2.IMREAD_COLOR
+    if max_side and is_jpeg(image_bytes):
+        factor, flag = next(
+            (
+                (f, reduced)
+                for f, reduced in _REDUCED_FLAGS
+                if max(dimensions) / f >= max_side
+            ),
+            (1, cv2.IMREAD_COLOR),
+        )
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+    if image is None:
+        raise ValueError("Couldn't decode image")
+    height, width = image.shape[:2]
+    original = dimensions
+    header_landscape, decoded_landscape = original[0] > original[1], width > height
+    if header_landscape != decoded_landscape and original[0] != original[1]:
+        original = original[::-1]  # Rotated by its EXIF orientation when decoded
+    if max_side and max(width, height) > max_side:
+        ratio = max_side / max(width, height)
+        size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    height, width = image.shape[:2]
+    return image, (original[0] / width, original[1] / height)
+
+
+def scale_polygons(
+    polygons: List[np.ndarray], scale: Tuple[float, float]
+) -> List[np.ndarray]:
+    """Scales (N, 2) polygons, e.g. from decoded image coordinates to original ones
+
+    Args:
+        polygons (List[np.ndarray]): (N, 2) arrays of x, y points
+        scale (Tuple[float, float]): x and y scale
+
+    Returns:
+        List[np.ndarray]: Scaled polygons
+    """
+    factors = np.array(scale, dtype=np.float32)
+    return [
+        np.asarray(polygon, dtype=np.float32).reshape(-1, 2) * factors
+        for polygon in polygons
+    ]
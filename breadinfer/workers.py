@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from loguru import logger
+
+# Inference handler of the current worker process, loaded once by init_worker
+_handler = None
+
+
+def init_worker(handler_kwargs: dict, threads: int):
+    """Worker process initializer: loads the inference models once for the lifetime of the process
+
+    Args:
+        handler_kwargs (dict): InferenceHandler arguments
+        threads (int): Torch threads for this worker, so workers don't oversubscribe the cores
+    """
+    global _handler
+    # Worker processes run inference themselves, they must never start a pool of their own
+    os.environ["INFERENCE_WORKERS"] = "0"
+    import torch
+
+    torch.set_num_threads(threads)
+    from breadinfer import inference
+
+    _handler = inference.InferenceHandler(**handler_kwargs)
+    # The default handler is lazy and never loaded here, replace it so nothing in the worker uses a second copy
+    inference.inferhandler = _handler
+    status = _handler.warmup()
+    logger.info(
+        f"Inference worker {os.getpid()} ready: loaded in {status['load_seconds']:.2f}s, "
+        f"warmed up in {status['warmup_ms']:.0f}ms"
+    )
+
+
+def analyze_batch(key: tuple, items: list) -> list:
+    """Runs a scheduler batch on the worker's handler. Results are compacted (no decoded images)
+    so they are cheap to send back to the main process
+
+    Args:
+        key (tuple): Batch key, see InferenceHandler.analyze_batch
+        items (list): Batch items, see InferenceHandler.analyze_batch
+
+    Returns:
+        list: One result (or error) per item
+    """
+    return _handler.analyze_batch(key, items, compact=True)
+
+
+def ping() -> int:
+    """No-op task, used to make the pool start its processes (and load the models) right away"""
+    return os.getpid()
+
+
+def create_worker_pool(workers: int, handler_kwargs: dict) -> ProcessPoolExecutor:
+    """Creates the inference process pool and waits for it to be up. Every worker loads and warms up its own models at startup
+
+    Args:
+        workers (int): Number of worker processes
+        handler_kwargs (dict): InferenceHandler arguments for the workers
+
+    Returns:
+        ProcessPoolExecutor: Pool to be used as executor by the scheduler
+    """
+    # Spawn (not fork) so workers don't inherit the event loop, discord connection or torch threads
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(
+            {**handler_kwargs, "workers": 0},
+            max(1, (os.cpu_count() or 1) // workers),
+        ),
+    )
+    # Processes are started on demand, so start all of them and wait until the pool answers
+    pings = [pool.submit(ping) for _ in range(workers)]
+    for ping_future in pings:
+        ping_future.result()
+    return pool
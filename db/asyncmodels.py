@@ -0,0 +1,127 @@
+"""Async versions of the db.models functions, for coroutines (discord handlers and API endpoints)
+
+Same functions and arguments as db.models, but they run on a dedicated DB thread so slow disk I/O never blocks
+the event loop (discord heartbeats and message handling). A single thread also means a single connection
+from the pool, so queries are run one at a time and in the order they were awaited.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable
+
+from db import models
+from db.models import OrderBy
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+async def run_in_db_thread(func: Callable, *args, **kwargs):
+    """Runs a blocking DB function on the DB thread and waits for it"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+async def create_db() -> None:
+    return await run_in_db_thread(models.create_db)
+
+
+async def load_author_cache() -> None:
+    return await run_in_db_thread(models.load_author_cache)
+
+
+async def upsert_message_stats(
+    ogmessage_id: int,
+    roundness: float,
+    labels_json: dict,
+    predictions: dict = None,
+    model_id: str = None,
+    overrideconfidence: bool = False,
+    guild_id: int = None,
+) -> None:
+    return await run_in_db_thread(
+        models.upsert_message_stats,
+        ogmessage_id,
+        roundness,
+        labels_json,
+        predictions=predictions,
+        model_id=model_id,
+        overrideconfidence=overrideconfidence,
+        guild_id=guild_id,
+    )
+
+
+async def get_message_predictions() -> list[dict]:
+    return await run_in_db_thread(models.get_message_predictions)
+
+
+async def update_message_scores(scores: list[tuple[int, float, dict]]) -> None:
+    return await run_in_db_thread(models.update_message_scores, scores)
+
+
+async def upsert_user_info(author_id: int, author_nickname: str, author_name: str) -> None:
+    return await run_in_db_thread(models.upsert_user_info, author_id, author_nickname, author_name)
+
+
+async def select_user_info(author_id: int) -> dict:
+    return await run_in_db_thread(models.select_user_info, author_id)
+
+
+async def upsert_message_discordinfo(
+    ogmessage_id: int,
+    replymessage_jump_url: str,
+    replymessage_id: int,
+    author_id: int,
+    channel_id: int,
+    guild_id: int,
+) -> None:
+    return await run_in_db_thread(
+        models.upsert_message_discordinfo,
+        ogmessage_id,
+        replymessage_jump_url,
+        replymessage_id,
+        author_id,
+        channel_id,
+        guild_id,
+    )
+
+
+async def get_minmax_roundness_byuserid(user_id: int, orderby: OrderBy) -> dict:
+    return await run_in_db_thread(models.get_minmax_roundness_byuserid, user_id, orderby)
+
+
+async def get_roundness_stats_byuserid(user_id: int) -> dict:
+    return await run_in_db_thread(models.get_roundness_stats_byuserid, user_id)
+
+
+async def get_roundness_stats_byguildid(guild_id: int) -> dict:
+    return await run_in_db_thread(models.get_roundness_stats_byguildid, guild_id)
+
+
+async def get_minmax_roundness_leaderboard(n: int, orderby: OrderBy) -> dict:
+    return await run_in_db_thread(models.get_minmax_roundness_leaderboard, n, orderby)
+
+
+async def get_guild_leaderboard(guild_id: int, n: int, channel_id: int = None) -> dict:
+    return await run_in_db_thread(models.get_guild_leaderboard, guild_id, n, channel_id)
+
+
+async def get_global_leaderboard(n: int) -> dict:
+    return await run_in_db_thread(models.get_global_leaderboard, n)
+
+
+async def get_roundness_history(user_id: int) -> list[tuple[int, int]]:
+    return await run_in_db_thread(models.get_roundness_history, user_id)
+
+
+async def get_latest_roundness_ogmessage_id(user_id: int) -> int:
+    return await run_in_db_thread(models.get_latest_roundness_ogmessage_id, user_id)
+
+
+async def close() -> None:
+    """Flushes the queued writes and closes the connections on the DB thread, then stops it (at shutdown)"""
+    from db.connection import close_all
+
+    await run_in_db_thread(models.writequeue.close)
+    await run_in_db_thread(close_all)
+    _executor.shutdown(wait=True)
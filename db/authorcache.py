@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class AuthorCache:
+    """In-memory LRU of the discordusers rows (author_id -> nickname and name)
+
+    Lets upsert_user_info skip the write when nothing changed (almost always) and serves select_user_info
+    lookups without a query.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._authors: OrderedDict[int, tuple[str, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Metrics
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._skipped_writes = 0
+
+    def preload(self, rows: list[tuple[int, str, str]]) -> None:
+        """Fills the cache with (author_id, author_nickname, author_name) rows"""
+        with self._lock:
+            for author_id, author_nickname, author_name in rows[-self.max_entries :]:
+                self._store(author_id, author_nickname, author_name)
+
+    def changed(self, author_id: int, author_nickname: str, author_name: str) -> bool:
+        """Whether the author info differs from the cached one. The cache is updated with it
+
+        Returns:
+            bool: True if it has to be written to the DB
+        """
+        with self._lock:
+            if self._authors.get(author_id) == (author_nickname, author_name):
+                self._authors.move_to_end(author_id)
+                self._skipped_writes += 1
+                return False
+            self._store(author_id, author_nickname, author_name)
+            self._writes += 1
+            return True
+
+    def get(self, author_id: int) -> Optional[dict]:
+        """Cached author info (same format as select_user_info) or None"""
+        with self._lock:
+            if author_id not in self._authors:
+                self._misses += 1
+                return None
+            self._authors.move_to_end(author_id)
+            self._hits += 1
+            author_nickname, author_name = self._authors[author_id]
+            return {"author_id": author_id, "author_nickname": author_nickname, "author_name": author_name}
+
+    def put(self, author_id: int, author_nickname: str, author_name: str) -> None:
+        """Stores author info read from the DB"""
+        with self._lock:
+            self._store(author_id, author_nickname, author_name)
+
+    def _store(self, author_id: int, author_nickname: str, author_name: str) -> None:
+        self._authors[author_id] = (author_nickname, author_name)
+        self._authors.move_to_end(author_id)
+        while len(self._authors) > self.max_entries:
+            self._authors.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Hit/miss and skipped write metrics
+
+        Returns:
+            dict: Metrics
+        """
+        return {
+            "max_entries": self.max_entries,
+            "entries": len(self._authors),
+            "hits": self._hits,
+            "misses": self._misses,
+            "writes": self._writes,
+            "skipped_writes": self._skipped_writes,
+        }
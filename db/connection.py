@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import threading
+
+from loguru import logger
+
+# Applied to every new connection. WAL lets readers run while a write is in progress, and synchronous=NORMAL only
+# syncs at checkpoints instead of on every commit (still safe against corruption in WAL mode)
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,  # Negative: KiB, 16MB of page cache per connection
+    "mmap_size": 268435456,  # 256MB of memory mapped I/O
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,  # ms to wait on a locked database instead of failing right away
+}
+
+
+class SQLiteConnectionPool:
+    """Long-lived SQLite connections, one per thread (sqlite3 connections must not be shared between threads)
+
+    The event loop thread and every executor thread get their own connection the first time they use the database
+    and keep it open, so statements cached by sqlite3 (cached_statements) are reused across calls.
+    """
+
+    def __init__(self, db_path: str, cached_statements: int = 256):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        """Connection of the current thread, opened on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            # check_same_thread=False only so close_all can close them at shutdown, each one is used by a single thread
+            conn = sqlite3.connect(self.db_path, cached_statements=self.cached_statements, check_same_thread=False)
+            for pragma, value in PRAGMAS.items():
+                conn.execute(f"PRAGMA {pragma}={value}")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+            logger.debug(f"Opened SQLite connection to {self.db_path} ({threading.current_thread().name})")
+        return conn
+
+    def close_all(self) -> None:
+        """Closes every connection of the pool (at shutdown). Threads open a new one if they use it again"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+# One pool per database file
+_pools: dict[str, SQLiteConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str) -> SQLiteConnectionPool:
+    """Connection pool of a database file, created on first use"""
+    with _pools_lock:
+        if db_path not in _pools:
+            _pools[db_path] = SQLiteConnectionPool(db_path)
+        return _pools[db_path]
+
+
+def close_all() -> None:
+    """Closes the connections of every pool (at shutdown)"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
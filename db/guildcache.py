@@ -0,0 +1,74 @@
+import threading
+from typing import Any, Hashable, Optional
+
+
+class GuildCache:
+    """Cache of query results scoped to a guild (e.g. leaderboards), invalidated when that guild gets new roundness
+
+    Keys are (guild_id, ...) tuples. Every guild has a generation counter that is bumped on invalidation (clear bumps
+    them all), a result computed before an invalidation (read generation != current generation) is never stored,
+    so a query racing with a write can't put stale results back in the cache.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: dict[tuple, Any] = {}
+        self._generations: dict[Hashable, int] = {}
+        self._epoch = 0  # Bumped by clear, which invalidates every guild at once
+        self._lock = threading.Lock()
+        # Metrics
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def generation(self, guild_id: Hashable) -> tuple[int, int]:
+        """Current generation of a guild, read it before running the query"""
+        with self._lock:
+            return self._epoch, self._generations.get(guild_id, 0)
+
+    def get(self, key: tuple) -> Optional[Any]:
+        """Cached result for the key (guild_id first) or None"""
+        with self._lock:
+            if key in self._entries:
+                self._hits += 1
+                return self._entries[key]
+            self._misses += 1
+            return None
+
+    def put(self, key: tuple, value: Any, generation: tuple[int, int]) -> None:
+        """Stores a result, unless the guild was invalidated since its generation was read"""
+        with self._lock:
+            if (self._epoch, self._generations.get(key[0], 0)) != generation:
+                return
+            if len(self._entries) >= self.max_entries:
+                # Results are cheap to recompute: drop everything instead of tracking usage
+                self._entries.clear()
+            self._entries[key] = value
+
+    def invalidate(self, guild_id: Hashable) -> None:
+        """Drops the cached results of a guild"""
+        with self._lock:
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            for key in [key for key in self._entries if key[0] == guild_id]:
+                del self._entries[key]
+            self._invalidations += 1
+
+    def clear(self) -> None:
+        """Drops every cached result (e.g. when the guild of a change is unknown)"""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._invalidations += 1
+
+    def stats(self) -> dict:
+        """Hit/miss and invalidation metrics
+
+        Returns:
+            dict: Metrics
+        """
+        return {
+            "entries": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "invalidations": self._invalidations,
+        }
@@ -0,0 +1,395 @@
+"""Versioned schema migrations for the bot database
+
+The schema version is stored in the database itself (PRAGMA user_version). Each migration is a list of statements,
+migration N brings the database from version N - 1 to N. migrate() applies the missing ones in order, each one in
+its own transaction. Never edit a released migration, add a new one at the end instead.
+
+Check that the hot queries use the indexes (fails if any of them scans messages or sorts with a temp b-tree):
+python -m db.migrations --check
+
+Migration 3 adds materialized stats tables (userstats, guildstats, guildleaderboard) that triggers on messages keep up
+to date. Check them against the messages, or recompute them:
+python -m db.migrations --check-stats
+python -m db.migrations --rebuild-stats
+
+Migration 4 adds statstotals, the row count of each stats table kept by triggers on them, so the stats queries never
+count a whole table.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+
+from loguru import logger
+
+MIGRATIONS: list[list[str]] = [
+    # 1: Base tables (databases created before migrations existed already have them)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            ogmessage_id INTEGER PRIMARY KEY,
+            replymessage_jump_url TEXT,
+            replymessage_id INTEGER,
+            author_id INTEGER,
+            channel_id INTEGER,
+            guild_id INTEGER,
+            roundness REAL,
+            labels_json TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS discordusers (
+            author_id INTEGER PRIMARY KEY,
+            author_nickname TEXT,
+            author_name TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS predictions (
+            ogmessage_id INTEGER PRIMARY KEY,
+            model_id TEXT,
+            overrideconfidence INTEGER,
+            predictions_json TEXT
+        )
+        """,
+    ],
+    # 2: Indexes for the stats queries (ogmessage_id is the rowid, so it's implicitly the last column of every index)
+    [
+        # User min/max: filter on author, sort on roundness
+        "CREATE INDEX IF NOT EXISTS idx_messages_author_roundness ON messages (author_id, roundness)",
+        # User history: filter on author, sort on ogmessage_id. Includes roundness so the query never reads the table
+        "CREATE INDEX IF NOT EXISTS idx_messages_author_ogmessage ON messages (author_id, ogmessage_id, roundness)",
+        # Guild leaderboards
+        "CREATE INDEX IF NOT EXISTS idx_messages_guild_roundness ON messages (guild_id, roundness)",
+        # Global leaderboard
+        "CREATE INDEX IF NOT EXISTS idx_messages_roundness ON messages (roundness)",
+    ],
+]
+
+
+# Top and bottom messages kept per guild in guildleaderboard (breadstats --top goes up to 10)
+LEADERBOARD_K = 10
+STATS_TABLES = [("userstats", "author_id"), ("guildstats", "guild_id")]
+
+
+def stats_remove_sql(table: str, key: str, ref: str = "OLD") -> list[str]:
+    # Removes the contribution of a message row (OLD or NEW in a trigger) from a stats table. count and sum are
+    # incremental, min/max are looked up again (LIMIT 1 on the index) only if the row was the min/max
+    statements = [f"""
+        UPDATE {table} SET count = count - 1, roundness_sum = roundness_sum - {ref}.roundness
+        WHERE {key} = {ref}.{key} AND {ref}.roundness IS NOT NULL
+        """]
+    for column, order in [("min", "ASC"), ("max", "DESC")]:
+        lookup = f"""
+            FROM messages WHERE {key} = {ref}.{key} AND roundness IS NOT NULL
+            ORDER BY roundness {order}, ogmessage_id {order} LIMIT 1
+        """
+        statements.append(f"""
+            UPDATE {table} SET
+                {column}_roundness = (SELECT roundness {lookup}),
+                {column}_ogmessage_id = (SELECT ogmessage_id {lookup})
+            WHERE {key} = {ref}.{key} AND {column}_ogmessage_id = {ref}.ogmessage_id
+            """)
+    statements.append(f"DELETE FROM {table} WHERE {key} = {ref}.{key} AND count = 0")
+    return statements
+
+
+def stats_add_sql(table: str, key: str, ref: str = "NEW") -> list[str]:
+    # Adds a message row to a stats table (ties on roundness go to the lowest id for min and highest id for max,
+    # same as the ORDER BY of the stats queries)
+    return [f"""
+        INSERT INTO {table} ({key}, count, roundness_sum, min_roundness, min_ogmessage_id, max_roundness, max_ogmessage_id)
+        SELECT {ref}.{key}, 1, {ref}.roundness, {ref}.roundness, {ref}.ogmessage_id, {ref}.roundness, {ref}.ogmessage_id
+        WHERE {ref}.{key} IS NOT NULL AND {ref}.roundness IS NOT NULL
+        ON CONFLICT({key}) DO UPDATE SET
+            count = count + 1,
+            roundness_sum = roundness_sum + excluded.roundness_sum,
+            min_roundness = CASE WHEN min_roundness IS NULL OR excluded.min_roundness < min_roundness
+                THEN excluded.min_roundness ELSE min_roundness END,
+            min_ogmessage_id = CASE WHEN min_roundness IS NULL OR excluded.min_roundness < min_roundness
+                OR (excluded.min_roundness = min_roundness AND excluded.min_ogmessage_id < min_ogmessage_id)
+                THEN excluded.min_ogmessage_id ELSE min_ogmessage_id END,
+            max_roundness = CASE WHEN max_roundness IS NULL OR excluded.max_roundness > max_roundness
+                THEN excluded.max_roundness ELSE max_roundness END,
+            max_ogmessage_id = CASE WHEN max_roundness IS NULL OR excluded.max_roundness > max_roundness
+                OR (excluded.max_roundness = max_roundness AND excluded.max_ogmessage_id > max_ogmessage_id)
+                THEN excluded.max_ogmessage_id ELSE max_ogmessage_id END
+        """]
+
+
+def leaderboard_refresh_sql(ref: str, condition: str = "1") -> list[str]:
+    # Reloads the top and bottom LEADERBOARD_K of the guild of a message row, O(K) on the (guild_id, roundness) index
+    statements = [f"DELETE FROM guildleaderboard WHERE guild_id = {ref}.guild_id AND {condition}"]
+    for board, order in [("top", "DESC"), ("bottom", "ASC")]:
+        statements.append(f"""
+            INSERT INTO guildleaderboard (guild_id, board, ogmessage_id, roundness)
+            SELECT guild_id, '{board}', ogmessage_id, roundness FROM messages
+            WHERE guild_id = {ref}.guild_id AND roundness IS NOT NULL AND {condition}
+            ORDER BY roundness {order}, ogmessage_id {order}
+            LIMIT {LEADERBOARD_K}
+            """)
+    return statements
+
+
+def trigger_sql(name: str, event: str, statements: list[str], when: str = None) -> str:
+    when = f"WHEN {when}" if when else ""
+    body = ";\n".join(statement.strip() for statement in statements)
+    return f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON messages {when} BEGIN\n{body};\nEND"
+
+
+def rebuild_stats_sql() -> list[str]:
+    # Recomputes every materialized stats table from messages (backfill and consistency checks)
+    statements = []
+    for table, key in STATS_TABLES:
+        statements += [
+            f"DELETE FROM {table}",
+            f"""
+            INSERT INTO {table} ({key}, count, roundness_sum)
+            SELECT {key}, COUNT(*), SUM(roundness) FROM messages
+            WHERE {key} IS NOT NULL AND roundness IS NOT NULL
+            GROUP BY {key}
+            """,
+        ]
+        for column, order in [("min", "ASC"), ("max", "DESC")]:
+            lookup = f"""
+                FROM messages WHERE messages.{key} = {table}.{key} AND roundness IS NOT NULL
+                ORDER BY roundness {order}, ogmessage_id {order} LIMIT 1
+            """
+            statements.append(f"""
+                UPDATE {table} SET
+                    {column}_roundness = (SELECT roundness {lookup}),
+                    {column}_ogmessage_id = (SELECT ogmessage_id {lookup})
+                """)
+    statements.append("DELETE FROM guildleaderboard")
+    for board, order in [("top", "DESC"), ("bottom", "ASC")]:
+        statements.append(f"""
+            INSERT INTO guildleaderboard (guild_id, board, ogmessage_id, roundness)
+            SELECT guild_id, '{board}', ogmessage_id, roundness FROM (
+                SELECT guild_id, ogmessage_id, roundness, ROW_NUMBER() OVER (
+                    PARTITION BY guild_id ORDER BY roundness {order}, ogmessage_id {order}
+                ) AS position
+                FROM messages WHERE guild_id IS NOT NULL AND roundness IS NOT NULL
+            )
+            WHERE position <= {LEADERBOARD_K}
+            """)
+    return statements
+
+
+def stats_migration() -> list[str]:
+    # Materialized per-user and per-guild stats and guild leaderboards, kept up to date by triggers on messages
+    # (so they change in the same transaction as the message rows, whichever upsert writes them)
+    statements = []
+    for table, key in STATS_TABLES:
+        statements.append(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                {key} INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0,
+                roundness_sum REAL NOT NULL DEFAULT 0,
+                min_roundness REAL,
+                min_ogmessage_id INTEGER,
+                max_roundness REAL,
+                max_ogmessage_id INTEGER
+            )
+            """)
+    statements += [
+        # Percentile rank of the users' best bread
+        "CREATE INDEX IF NOT EXISTS idx_userstats_max_roundness ON userstats (max_roundness)",
+        """
+        CREATE TABLE IF NOT EXISTS guildleaderboard (
+            guild_id INTEGER,
+            board TEXT,
+            ogmessage_id INTEGER,
+            roundness REAL,
+            PRIMARY KEY (guild_id, board, ogmessage_id)
+        )
+        """,
+    ]
+    insert, update, delete = [], [], []
+    for table, key in STATS_TABLES:
+        insert += stats_add_sql(table, key, "NEW")
+        update += stats_remove_sql(table, key, "OLD") + stats_add_sql(table, key, "NEW")
+        delete += stats_remove_sql(table, key, "OLD")
+    insert += leaderboard_refresh_sql("NEW")
+    # The OLD guild is reloaded after the change, so the NEW one only needs it if the message moved to another guild
+    update += leaderboard_refresh_sql("OLD") + leaderboard_refresh_sql("NEW", "NEW.guild_id IS NOT OLD.guild_id")
+    delete += leaderboard_refresh_sql("OLD")
+    changed = (
+        "OLD.roundness IS NOT NEW.roundness OR OLD.author_id IS NOT NEW.author_id OR OLD.guild_id IS NOT NEW.guild_id"
+    )
+    statements += [
+        trigger_sql("messages_stats_insert", "INSERT", insert),
+        trigger_sql("messages_stats_update", "UPDATE OF roundness, author_id, guild_id", update, when=changed),
+        trigger_sql("messages_stats_delete", "DELETE", delete),
+    ]
+    # Backfill
+    return statements + rebuild_stats_sql()
+
+
+# 3: Materialized stats (see stats_migration)
+MIGRATIONS.append(stats_migration())
+
+
+def rebuild_totals_sql() -> list[str]:
+    # Recounts the rows of every stats table (run after rebuild_stats_sql, that migration 3 also uses)
+    return [
+        f"INSERT OR REPLACE INTO statstotals (name, count) SELECT '{table}', COUNT(*) FROM {table}"
+        for table, _ in STATS_TABLES
+    ]
+
+
+def totals_migration() -> list[str]:
+    # Row count of each stats table (users with stats for the percentile of --self), kept by triggers on the stats
+    # tables themselves: their rows are only inserted and deleted by the messages triggers, the upserts that update
+    # an existing row fire UPDATE triggers and don't change the count
+    statements = ["CREATE TABLE IF NOT EXISTS statstotals (name TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)"]
+    for table, _ in STATS_TABLES:
+        for event, delta in [("INSERT", "+ 1"), ("DELETE", "- 1")]:
+            statements.append(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_totals_{event.lower()} AFTER {event} ON {table} BEGIN
+                UPDATE statstotals SET count = count {delta} WHERE name = '{table}';
+                END
+                """)
+    # Backfill
+    return statements + rebuild_totals_sql()
+
+
+# 4: Stats tables row counts (see totals_migration)
+MIGRATIONS.append(totals_migration())
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection, target: int = None) -> int:
+    """Applies the missing migrations, each one in its own transaction
+
+    Args:
+        conn (sqlite3.Connection): Database connection
+        target (int, optional): Version to migrate to. Defaults to the latest one.
+
+    Returns:
+        int: Schema version after migrating
+    """
+    target = len(MIGRATIONS) if target is None else target
+    version = schema_version(conn)
+    for number in range(version + 1, target + 1):
+        logger.info(f"Applying database migration {number}")
+        try:
+            conn.execute("BEGIN")
+            for statement in MIGRATIONS[number - 1]:
+                conn.execute(statement)
+            # PRAGMA doesn't take parameters, number is always an int from the range
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return schema_version(conn)
+
+
+def explain(conn: sqlite3.Connection, sql: str, params: tuple) -> list[str]:
+    """EXPLAIN QUERY PLAN of a query, one line per plan step"""
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+
+def check_query_plans(conn: sqlite3.Connection, queries: list[tuple[str, str, tuple]]) -> list[str]:
+    """Checks that queries are answered from an index, without scanning messages or sorting in a temp b-tree
+
+    Args:
+        conn (sqlite3.Connection): Migrated database connection
+        queries (list[tuple[str, str, tuple]]): (name, sql, params) of each query
+
+    Returns:
+        list[str]: Problems found (empty if every plan is fine)
+    """
+    problems = []
+    for name, sql, params in queries:
+        plan = explain(conn, sql, params)
+        logger.info(f"{name}: {' | '.join(plan)}")
+        for step in plan:
+            if (step.startswith("SCAN messages") and "INDEX" not in step) or "TEMP B-TREE" in step:
+                problems.append(f"{name}: {step}")
+    return problems
+
+
+def rebuild_stats(conn: sqlite3.Connection) -> None:
+    """Recomputes the materialized stats tables from the messages (if they ever drift, e.g. after editing messages
+    by hand with the triggers dropped)
+
+    Args:
+        conn (sqlite3.Connection): Database connection
+    """
+    conn.execute("BEGIN")
+    for statement in rebuild_stats_sql() + rebuild_totals_sql():
+        conn.execute(statement)
+    conn.commit()
+
+
+def check_stats(conn: sqlite3.Connection) -> list[str]:
+    """Compares the materialized stats tables with stats recomputed from the messages, without changing them
+
+    Args:
+        conn (sqlite3.Connection): Database connection
+
+    Returns:
+        list[str]: Rows that differ (empty if consistent)
+    """
+    tables = [table for table, _ in STATS_TABLES] + ["guildleaderboard", "statstotals"]
+
+    def snapshot() -> dict[str, set]:
+        # Rounded so sums accumulated by the triggers compare equal to the recomputed ones
+        return {
+            table: {
+                tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+                for row in conn.execute(f"SELECT * FROM {table}")
+            }
+            for table in tables
+        }
+
+    conn.execute("BEGIN")
+    try:
+        materialized = snapshot()
+        for statement in rebuild_stats_sql() + rebuild_totals_sql():
+            conn.execute(statement)
+        expected = snapshot()
+    finally:
+        conn.rollback()
+    problems = []
+    for table in tables:
+        problems += [f"{table}: unexpected {row}" for row in materialized[table] - expected[table]]
+        problems += [f"{table}: missing {row}" for row in expected[table] - materialized[table]]
+    return problems
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Migrate the bot database and check the query plans")
+    parser.add_argument("--db", help="Database path. Defaults to DBDATAPATH")
+    parser.add_argument("--check", action="store_true", help="Check the hot queries use the indexes")
+    parser.add_argument("--check-stats", action="store_true", help="Check the materialized stats match the messages")
+    parser.add_argument("--rebuild-stats", action="store_true", help="Recompute the materialized stats")
+    args = parser.parse_args(argv)
+    from db import models
+
+    db_path = args.db or models.dbdatapath
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    print(f"Schema version: {migrate(conn)}")
+    problems = []
+    if args.rebuild_stats:
+        rebuild_stats(conn)
+        print("Materialized stats rebuilt")
+    if args.check:
+        for problem in check_query_plans(conn, models.HOT_QUERIES):
+            problems.append(f"Not indexed: {problem}")
+    if args.check_stats:
+        for problem in check_stats(conn):
+            problems.append(f"Stats mismatch: {problem}")
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
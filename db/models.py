@@ -7,61 +7,78 @@ from enum import Enum
 from dotenv import load_dotenv
 from loguru import logger
 
+from db.authorcache import AuthorCache
+from db.connection import get_pool
+from db.guildcache import GuildCache
+from db.migrations import LEADERBOARD_K, migrate
+from db.writebehind import WriteBehindQueue
+
 load_dotenv()
 dbdatapath = os.path.join(os.getcwd(), os.environ.get("DBDATAPATH"))
 
 
 @contextmanager
 def sqlite_connection(db_path=dbdatapath):
-    conn = None
+    # Long-lived connection of this thread (WAL enabled) instead of opening a new one for every statement
+    conn = get_pool(db_path).connection()
     cursor = None
     try:
-        conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
         yield cursor
         conn.commit()
     except sqlite3.Error as e:
         logger.error(f"SQLite error: {e}")
-        if conn:
-            conn.rollback()
+        conn.rollback()
     finally:
         if cursor:
             cursor.close()
-        if conn:
-            conn.close()
 
 
-def create_db() -> None:
-    # Define the SQL command to create the "messages" table
-    create_table_sql = """
-    CREATE TABLE IF NOT EXISTS messages (
-        ogmessage_id INTEGER PRIMARY KEY,
-        replymessage_jump_url TEXT,
-        replymessage_id INTEGER,
-        author_id INTEGER,
-        channel_id INTEGER,
-        guild_id INTEGER,
-        roundness REAL,
-        labels_json TEXT
-    )
-    """
+def execute_write_batch(batches: list[tuple[str, list[tuple]]]) -> None:
+    # Writes the queued upserts in a single transaction: batches are (sql, rows), one executemany each.
+    # Errors are raised (after rolling back) so the write queue retries the batch instead of losing it
+    conn = get_pool(dbdatapath).connection()
+    try:
+        for sql, rows in batches:
+            conn.executemany(sql, rows)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
 
-    create_usertable_sql = """
-    CREATE TABLE IF NOT EXISTS discordusers (
-        author_id INTEGER PRIMARY KEY,
-        author_nickname TEXT,
-        author_name TEXT
-    ) ;  
-    """
+
+# Upserts are queued and written in batches by a background thread (DB_WRITE_BEHIND_MS=0 writes them right away)
+writequeue = WriteBehindQueue(
+    execute_write_batch,
+    flush_ms=float(os.environ.get("DB_WRITE_BEHIND_MS", 1000)),
+    max_pending=int(os.environ.get("DB_WRITE_BEHIND_MAX_PENDING", 256)),
+)
+
+
+# Guild leaderboards, dropped whenever a guild gets new roundness values
+leaderboardcache = GuildCache()
+# Known authors, so unchanged user info is never written again
+authorcache = AuthorCache(max_entries=int(os.environ.get("AUTHOR_CACHE_SIZE", 10000)))
+
+
+def create_db() -> None:
+    # Creates the tables and indexes, or brings an existing database up to the latest schema version
     if not os.path.exists(os.path.dirname(dbdatapath)):
         os.makedirs(os.path.dirname(dbdatapath))
-    with sqlite_connection() as cursor:
-        # Execute the SQL command
-        cursor.execute(create_table_sql)
-        cursor.execute(create_usertable_sql)
+    # Not through sqlite_connection: a failed migration must stop the bot, not be logged and skipped
+    version = migrate(get_pool(dbdatapath).connection())
+    logger.info(f"Database schema version {version}")
 
 
-def upsert_message_stats(ogmessage_id: int, roundness: float, labels_json: dict) -> None:
+def upsert_message_stats(
+    ogmessage_id: int,
+    roundness: float,
+    labels_json: dict,
+    predictions: dict = None,
+    model_id: str = None,
+    overrideconfidence: bool = False,
+    guild_id: int = None,
+) -> None:
     logger.info(f"Upserting: {ogmessage_id}, {roundness}, {labels_json} in messages")
     # Convert the labels_json dictionary to a JSON string
     labels_json_str = json.dumps(labels_json)
@@ -74,15 +91,70 @@ def upsert_message_stats(ogmessage_id: int, roundness: float, labels_json: dict)
         roundness=excluded.roundness,
         labels_json=excluded.labels_json
     """
+    # Raw (unfiltered) predictions, so the message can be rescored later without running the models
+    upsert_predictions_sql = """
+    INSERT INTO predictions (ogmessage_id, model_id, overrideconfidence, predictions_json)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(ogmessage_id) DO UPDATE SET
+        model_id=excluded.model_id,
+        overrideconfidence=excluded.overrideconfidence,
+        predictions_json=excluded.predictions_json
+    """
 
+    writequeue.enqueue(upsert_sql, ogmessage_id, (ogmessage_id, roundness, labels_json_str))
+    # The message may already be on a leaderboard (e.g. "are you sure" reruns). Unknown guild: drop them all
+    if guild_id is None:
+        leaderboardcache.clear()
+    else:
+        leaderboardcache.invalidate(guild_id)
+    if predictions is not None:
+        writequeue.enqueue(
+            upsert_predictions_sql,
+            ogmessage_id,
+            (ogmessage_id, model_id, int(overrideconfidence), json.dumps(predictions)),
+        )
+
+
+def get_message_predictions() -> list[dict]:
+    # Returns the stored raw predictions of every message
+    logger.info("Fetching stored predictions")
+    select_sql = "SELECT ogmessage_id, model_id, overrideconfidence, predictions_json FROM predictions"
+    result = []
+    writequeue.flush()  # Reads must see the queued writes
     with sqlite_connection() as cursor:
-        cursor.execute(upsert_sql, (ogmessage_id, roundness, labels_json_str))
+        cursor.execute(select_sql)
+        for row in cursor.fetchall():
+            result.append(
+                {
+                    "ogmessage_id": row[0],
+                    "model_id": row[1],
+                    "overrideconfidence": bool(row[2]),
+                    "predictions": json.loads(row[3]),
+                }
+            )
+    return result
+
+
+def update_message_scores(scores: list[tuple[int, float, dict]]) -> None:
+    # Updates roundness and labels of already stored messages: scores are (ogmessage_id, roundness, labels_json)
+    logger.info(f"Updating scores of {len(scores)} messages")
+    update_sql = "UPDATE messages SET roundness = ?, labels_json = ? WHERE ogmessage_id = ?"
+    # Queued upserts first, so they can't overwrite the new scores later
+    writequeue.flush()
+    with sqlite_connection() as cursor:
+        cursor.executemany(
+            update_sql,
+            [(roundness, json.dumps(labels_json), ogmessage_id) for ogmessage_id, roundness, labels_json in scores],
+        )
+    leaderboardcache.clear()
 
 
 def upsert_user_info(author_id: int, author_nickname: str, author_name: str):
     # Inserts the author info to cache results so we don't have to get info from discord all the time
+    # Names rarely change: nothing is written unless they differ from the cached ones
+    if not authorcache.changed(author_id, author_nickname, author_name):
+        return
     logger.info(f"Upserting: {author_id}, {author_nickname}, {author_name} in discordusers")
-    # Convert the labels_json dictionary to a JSON string
     # Define the UPSERT SQL command
     upsert_sql = """
     INSERT INTO discordusers (author_id, author_nickname, author_name)
@@ -92,17 +164,21 @@ def upsert_user_info(author_id: int, author_nickname: str, author_name: str):
         author_name=excluded.author_name
     """
 
-    with sqlite_connection() as cursor:
-        cursor.execute(upsert_sql, (author_id, author_nickname, author_name))
+    writequeue.enqueue(upsert_sql, author_id, (author_id, author_nickname, author_name))
 
 
 def select_user_info(author_id: int):
     logger.trace(f"Getting user info from {author_id}")
+    user_info = authorcache.get(author_id)
+    if user_info is not None:
+        return user_info
     select_sql = "SELECT author_id, author_nickname, author_name FROM discordusers WHERE author_id = ?"
+    writequeue.flush()  # Reads must see the queued writes
     with sqlite_connection() as cursor:
         cursor.execute(select_sql, (author_id,))
         row = cursor.fetchone()
         if row:
+            authorcache.put(*row)
             return {
                 "author_id": row[0],
                 "author_nickname": row[1],
@@ -111,6 +187,16 @@ def select_user_info(author_id: int):
         return None
 
 
+def load_author_cache() -> None:
+    # Preloads the author cache with the discordusers table (at startup)
+    select_sql = "SELECT author_id, author_nickname, author_name FROM discordusers"
+    with sqlite_connection() as cursor:
+        cursor.execute(select_sql)
+        rows = cursor.fetchall()
+    authorcache.preload(rows)
+    logger.info(f"Loaded {len(rows)} users in the author cache")
+
+
 def upsert_message_discordinfo(
     ogmessage_id: int,
     replymessage_jump_url: str,
@@ -134,18 +220,13 @@ def upsert_message_discordinfo(
         guild_id=excluded.guild_id
     """
 
-    with sqlite_connection() as cursor:
-        cursor.execute(
-            upsert_sql,
-            (
-                ogmessage_id,
-                replymessage_jump_url,
-                replymessage_id,
-                author_id,
-                channel_id,
-                guild_id,
-            ),
-        )
+    writequeue.enqueue(
+        upsert_sql,
+        ogmessage_id,
+        (ogmessage_id, replymessage_jump_url, replymessage_id, author_id, channel_id, guild_id),
+    )
+    # The message (and its roundness) is now part of the guild leaderboards
+    leaderboardcache.invalidate(guild_id)
 
 
 class OrderBy(Enum):
@@ -153,17 +234,144 @@ class OrderBy(Enum):
     DES = "DESC"
 
 
+# Stats queries, see db.migrations for their indexes
+# SQL query to fetch min or max roundness, ogmessage_id, and jump_url of a user (only the first row is needed)
+USER_ROUNDNESS_SQL = """
+SELECT roundness, ogmessage_id, replymessage_jump_url
+FROM messages
+WHERE author_id = ?
+AND roundness not null
+ORDER BY roundness {orderby}, ogmessage_id {orderby}
+LIMIT 1
+"""
+# SQL query to fetch every roundness stat of a user at once from the materialized userstats row (kept up to date by
+# triggers on messages): count, mean, min and max (with their messages) and percentile rank of the user's best bread
+# among the best breads of every user. The number of users comes from statstotals, the users below are counted on the
+# idx_userstats_max_roundness range
+USER_STATS_SQL = """
+SELECT
+    count,
+    roundness_sum / count,
+    min_roundness,
+    min_ogmessage_id,
+    (SELECT replymessage_jump_url FROM messages WHERE ogmessage_id = min_ogmessage_id),
+    max_roundness,
+    max_ogmessage_id,
+    (SELECT replymessage_jump_url FROM messages WHERE ogmessage_id = max_ogmessage_id),
+    (SELECT COUNT(*) FROM userstats AS other WHERE other.max_roundness < userstats.max_roundness) AS below,
+    (SELECT count FROM statstotals WHERE name = 'userstats') AS total
+FROM userstats
+WHERE author_id = :user_id
+"""
+# SQL query to fetch the materialized roundness stats of a guild
+GUILD_STATS_SQL = """
+SELECT count, roundness_sum / count, min_roundness, max_roundness
+FROM guildstats
+WHERE guild_id = :guild_id
+"""
+# SQL query to fetch top 'n' min and max roundness, ogmessage_id, and jump_url
+LEADERBOARD_SQL = """
+SELECT roundness, ogmessage_id, replymessage_jump_url, author_id, guild_id, channel_id
+FROM messages
+WHERE roundness not null
+ORDER BY roundness {orderby}
+LIMIT ?
+"""
+# SQL query to fetch the top and bottom 'n' roundness of a guild (optionally a single channel) with author names
+GUILD_LEADERBOARD_SQL = """
+SELECT * FROM (
+    SELECT 'top', messages.roundness, messages.ogmessage_id, messages.replymessage_jump_url,
+        messages.author_id, messages.channel_id, u.author_nickname, u.author_name
+    FROM messages
+    LEFT JOIN discordusers AS u ON u.author_id = messages.author_id
+    WHERE messages.guild_id = :guild_id
+    AND (:channel_id IS NULL OR messages.channel_id = :channel_id)
+    AND messages.roundness not null
+    ORDER BY messages.roundness DESC
+    LIMIT :n
+)
+UNION ALL
+SELECT * FROM (
+    SELECT 'bottom', messages.roundness, messages.ogmessage_id, messages.replymessage_jump_url,
+        messages.author_id, messages.channel_id, u.author_nickname, u.author_name
+    FROM messages
+    LEFT JOIN discordusers AS u ON u.author_id = messages.author_id
+    WHERE messages.guild_id = :guild_id
+    AND (:channel_id IS NULL OR messages.channel_id = :channel_id)
+    AND messages.roundness not null
+    ORDER BY messages.roundness ASC
+    LIMIT :n
+)
+"""
+# SQL query to fetch the top and bottom 'n' roundness of every guild (and DMs) with author names
+GLOBAL_LEADERBOARD_SQL = """
+SELECT * FROM (
+    SELECT 'top', messages.roundness, messages.ogmessage_id, messages.replymessage_jump_url,
+        messages.author_id, messages.channel_id, u.author_nickname, u.author_name, messages.guild_id
+    FROM messages
+    LEFT JOIN discordusers AS u ON u.author_id = messages.author_id
+    WHERE messages.roundness not null
+    ORDER BY messages.roundness DESC
+    LIMIT :n
+)
+UNION ALL
+SELECT * FROM (
+    SELECT 'bottom', messages.roundness, messages.ogmessage_id, messages.replymessage_jump_url,
+        messages.author_id, messages.channel_id, u.author_nickname, u.author_name, messages.guild_id
+    FROM messages
+    LEFT JOIN discordusers AS u ON u.author_id = messages.author_id
+    WHERE messages.roundness not null
+    ORDER BY messages.roundness ASC
+    LIMIT :n
+)
+"""
+# SQL query to fetch the materialized top and bottom LEADERBOARD_K of a guild with author names
+GUILD_BOARD_SQL = """
+SELECT guildleaderboard.board, guildleaderboard.roundness, guildleaderboard.ogmessage_id,
+    messages.replymessage_jump_url, messages.author_id, messages.channel_id, u.author_nickname, u.author_name
+FROM guildleaderboard
+JOIN messages ON messages.ogmessage_id = guildleaderboard.ogmessage_id
+LEFT JOIN discordusers AS u ON u.author_id = messages.author_id
+WHERE guildleaderboard.guild_id = :guild_id
+"""
+# SQL query to fetch the last 50 roundness values of a user
+ROUNDNESS_HISTORY_SQL = f"""
+SELECT ogmessage_id, roundness
+FROM messages
+WHERE 1=1
+AND roundness not null
+AND author_id = ?
+ORDER BY ogmessage_id {OrderBy.DES.value}
+LIMIT 50
+"""
+# SQL query to fetch the latest message with roundness of a user (history plots are cached until it changes)
+LATEST_ROUNDNESS_SQL = """
+SELECT ogmessage_id
+FROM messages
+WHERE roundness not null
+AND author_id = ?
+ORDER BY ogmessage_id DESC
+LIMIT 1
+"""
+# (name, sql, params) of the queries that must always use an index, checked by python -m db.migrations --check
+HOT_QUERIES = [
+    *[(f"user roundness {o.value}", USER_ROUNDNESS_SQL.format(orderby=o.value), (1,)) for o in OrderBy],
+    ("user stats", USER_STATS_SQL, {"user_id": 1}),
+    ("guild stats", GUILD_STATS_SQL, {"guild_id": 1}),
+    *[(f"leaderboard {o.value}", LEADERBOARD_SQL.format(orderby=o.value), (3,)) for o in OrderBy],
+    ("guild leaderboard", GUILD_LEADERBOARD_SQL, {"guild_id": 1, "channel_id": None, "n": 3}),
+    ("guild board", GUILD_BOARD_SQL, {"guild_id": 1}),
+    ("global leaderboard", GLOBAL_LEADERBOARD_SQL, {"n": 3}),
+    ("roundness history", ROUNDNESS_HISTORY_SQL, (1,)),
+    ("roundness latest", LATEST_ROUNDNESS_SQL, (1,)),
+]
+
+
 def get_minmax_roundness_byuserid(user_id: int, orderby: OrderBy) -> dict:
     # Returns min and max roundness of specified user, returning the ogmessage_id and jump_url as well
     logger.info(f"Fetching min and max roundness for user_id: {user_id}")
 
-    # Define the SQL query to fetch min and max roundness, ogmessage_id, and jump_url
-    query = f"""
-    SELECT roundness, ogmessage_id, replymessage_jump_url
-    FROM messages
-    WHERE author_id = ?
-    ORDER BY roundness {orderby}, ogmessage_id {orderby}
-    """
+    query = USER_ROUNDNESS_SQL.format(orderby=orderby)
 
     result = {
         "roundness": None,
@@ -171,31 +379,61 @@ def get_minmax_roundness_byuserid(user_id: int, orderby: OrderBy) -> dict:
         "roundness_ogmessage_id": None,
     }
 
+    writequeue.flush()  # Reads must see the queued writes
     with sqlite_connection() as cursor:
         cursor.execute(query, (user_id,))
-        rows = cursor.fetchall()
-        if rows:
-            result["roundness"] = rows[0][0]
-            result["roundness_ogmessage_id"] = rows[0][1]
-            result["roundness_url"] = rows[0][2]
+        row = cursor.fetchone()
+        if row:
+            result["roundness"] = row[0]
+            result["roundness_ogmessage_id"] = row[1]
+            result["roundness_url"] = row[2]
     return result
 
 
+def get_roundness_stats_byuserid(user_id: int) -> dict:
+    # Returns count, mean, min and max roundness (with ogmessage_id and jump_url) of the user from the materialized
+    # stats, and the percentile rank of their best bread (% of users whose best bread is less round)
+    logger.info(f"Fetching roundness stats for user_id: {user_id}")
+    writequeue.flush()  # Reads must see the queued writes
+    with sqlite_connection() as cursor:
+        cursor.execute(USER_STATS_SQL, {"user_id": user_id})
+        row = cursor.fetchone()
+    count, mean, min_roundness, min_id, min_url, max_roundness, max_id, max_url, below, total = (
+        row or (0,) + (None,) * 9
+    )
+    return {
+        "count": count,
+        "mean_roundness": mean,
+        "min_roundness": min_roundness,
+        "min_roundness_ogmessage_id": min_id,
+        "min_roundness_url": min_url,
+        "max_roundness": max_roundness,
+        "max_roundness_ogmessage_id": max_id,
+        "max_roundness_url": max_url,
+        "percentile_rank": below / total * 100 if count and total else None,
+    }
+
+
+def get_roundness_stats_byguildid(guild_id: int) -> dict:
+    # Returns count, mean, min and max roundness of the guild from the materialized stats
+    logger.info(f"Fetching roundness stats for guild {guild_id}")
+    writequeue.flush()  # Reads must see the queued writes
+    with sqlite_connection() as cursor:
+        cursor.execute(GUILD_STATS_SQL, {"guild_id": guild_id})
+        row = cursor.fetchone()
+    count, mean, min_roundness, max_roundness = row or (0, None, None, None)
+    return {"count": count, "mean_roundness": mean, "min_roundness": min_roundness, "max_roundness": max_roundness}
+
+
 def get_minmax_roundness_leaderboard(n: int, orderby: OrderBy) -> dict:
     # Returns top 'n' min and max roundness returning the ogmessage_id and jump_url as well for each row
     logger.info(f"Fetching min and max roundness top {n} leaderboard")
 
-    # Define the SQL queries to fetch top 'n' min and max roundness, ogmessage_id, and jump_url
-    roundness_query = f"""
-    SELECT roundness, ogmessage_id, replymessage_jump_url, author_id, guild_id, channel_id
-    FROM messages
-    WHERE roundness not null
-    ORDER BY roundness {orderby}
-    LIMIT ?
-    """
+    roundness_query = LEADERBOARD_SQL.format(orderby=orderby)
 
     result = []
 
+    writequeue.flush()  # Reads must see the queued writes
     with sqlite_connection() as cursor:
         cursor.execute(roundness_query, (n,))
         min_rows = cursor.fetchall()
@@ -213,23 +451,78 @@ def get_minmax_roundness_leaderboard(n: int, orderby: OrderBy) -> dict:
     return result
 
 
+def get_guild_leaderboard(guild_id: int, n: int, channel_id: int = None) -> dict:
+    # Returns the top and bottom 'n' roundness of the guild (or one of its channels) with the author names,
+    # in a single query. Results are cached until the guild gets new roundness values
+    key = (guild_id, channel_id, n)
+    cached = leaderboardcache.get(key)
+    if cached is not None:
+        return cached
+    logger.info(f"Fetching top {n} leaderboard for guild {guild_id} (channel {channel_id})")
+    generation = leaderboardcache.generation(guild_id)
+    result = {"top": [], "bottom": []}
+    writequeue.flush()  # Reads must see the queued writes
+    with sqlite_connection() as cursor:
+        if channel_id is None and n <= LEADERBOARD_K:
+            # Whole guild: read the materialized board (top and bottom LEADERBOARD_K) instead of sorting messages
+            cursor.execute(GUILD_BOARD_SQL, {"guild_id": guild_id})
+            rows = sorted(cursor.fetchall(), key=lambda row: (row[1], row[2]))
+            rows = [row for row in reversed(rows) if row[0] == "top"][:n] + [row for row in rows if row[0] == "bottom"][
+                :n
+            ]
+        else:
+            cursor.execute(GUILD_LEADERBOARD_SQL, {"guild_id": guild_id, "channel_id": channel_id, "n": n})
+            rows = cursor.fetchall()
+        for row in rows:
+            result[row[0]].append(
+                {
+                    "roundness": row[1],
+                    "ogmessage_id": row[2],
+                    "jump_url": row[3],
+                    "author_id": row[4],
+                    "guild_id": guild_id,
+                    "channel_id": row[5],
+                    "author_nickname": row[6],
+                    "author_name": row[7],
+                }
+            )
+    leaderboardcache.put(key, result, generation)
+    return result
+
+
+def get_global_leaderboard(n: int) -> dict:
+    # Returns the top and bottom 'n' roundness of every guild with the author names, in a single query.
+    # Not cached: a write to any guild would invalidate it
+    logger.info(f"Fetching top {n} global leaderboard")
+    result = {"top": [], "bottom": []}
+    writequeue.flush()  # Reads must see the queued writes
+    with sqlite_connection() as cursor:
+        cursor.execute(GLOBAL_LEADERBOARD_SQL, {"n": n})
+        for row in cursor.fetchall():
+            result[row[0]].append(
+                {
+                    "roundness": row[1],
+                    "ogmessage_id": row[2],
+                    "jump_url": row[3],
+                    "author_id": row[4],
+                    "guild_id": row[8],
+                    "channel_id": row[5],
+                    "author_nickname": row[6],
+                    "author_name": row[7],
+                }
+            )
+    return result
+
+
 def get_roundness_history(user_id: int) -> list[tuple[int, int]]:
     # Returns the roundness history for the user
     logger.info(f"Fetching  roundness of user {user_id}")
 
-    # Define the SQL queries to fetch top 'n' min and max roundness, ogmessage_id, and jump_url
-    roundness_query = f"""
-    SELECT ogmessage_id, roundness
-    FROM messages
-    WHERE 1=1
-    AND roundness not null
-    AND author_id = ?
-    ORDER BY ogmessage_id {OrderBy.DES.value}
-    LIMIT 50
-    """
+    roundness_query = ROUNDNESS_HISTORY_SQL
 
     result = []
 
+    writequeue.flush()  # Reads must see the queued writes
     with sqlite_connection() as cursor:
         cursor.execute(roundness_query, (user_id,))
         rows = cursor.fetchall()
@@ -238,6 +531,15 @@ def get_roundness_history(user_id: int) -> list[tuple[int, int]]:
     return result
 
 
+def get_latest_roundness_ogmessage_id(user_id: int) -> int:
+    # Returns the ogmessage_id of the latest message of the user with roundness (None if there's none)
+    writequeue.flush()  # Reads must see the queued writes
+    with sqlite_connection() as cursor:
+        cursor.execute(LATEST_ROUNDNESS_SQL, (user_id,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
 if __name__ == "__main__":
     # create db
     # create_db()
@@ -0,0 +1,192 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from loguru import logger
+
+
+class WriteBehindQueue:
+    """Write-behind queue for upserts: callers only queue the statement and return right away
+
+    Writes are coalesced by (sql, key): a newer upsert of the same row replaces the queued one (e.g. repeated
+    upsert_user_info calls for the same author_id end up as a single row write). A background thread flushes
+    everything queued in a single transaction, with one executemany per statement, when max_pending writes are
+    queued or flush_ms after the first queued write. flush() can also be called directly, e.g. before a read that
+    must see the latest writes, and close() flushes what's left at shutdown.
+    With flush_ms=0 there's no background thread and every write is flushed by its caller.
+    If a batch fails it's queued again (newer writes of the same rows win) and retried with exponential backoff,
+    after max_retries failed attempts in a row it's dropped and counted as rows_dropped.
+    """
+
+    def __init__(
+        self,
+        execute_batch: Callable[[list], None],
+        flush_ms: float = 1000.0,
+        max_pending: int = 256,
+        max_retries: int = 3,
+    ):
+        """
+        Args:
+            execute_batch (Callable[[list], None]): Writes a batch in one transaction, gets a list of (sql, rows).
+                Must raise if the transaction wasn't committed
+            flush_ms (float, optional): Max time a write waits in the queue. Defaults to 1000.0.
+            max_pending (int, optional): Queued writes that trigger a flush right away. Defaults to 256.
+            max_retries (int, optional): Failed flushes in a row before the queued writes are dropped. Defaults to 3.
+        """
+        self.execute_batch = execute_batch
+        self.flush_interval = max(0.0, flush_ms) / 1000
+        self.max_pending = max(1, max_pending)
+        self.max_retries = max(0, max_retries)
+        self._failures = 0  # Failed flushes in a row
+        self._retry_at: float = None  # No flush before this time (backoff after a failed flush)
+        self._pending: OrderedDict[tuple[str, Hashable], tuple] = OrderedDict()
+        self._first_queued_at: float = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()  # Flushes run one at a time so batches are written in order
+        self._closed = False
+        self._thread: threading.Thread = None
+        # Metrics
+        self._enqueued = 0
+        self._coalesced = 0
+        self._flushes = 0
+        self._rows_written = 0
+        self._rows_dropped = 0
+        self._failed_flushes = 0
+        self._max_queue_depth = 0
+        self._total_flush_time = 0.0
+        self._max_flush_time = 0.0
+
+    def enqueue(self, sql: str, key: Hashable, params: tuple) -> None:
+        """Queues a write
+
+        Args:
+            sql (str): Statement
+            key (Hashable): Row key, a queued write of the same statement and key is replaced
+            params (tuple): Statement parameters
+        """
+        with self._condition:
+            if (sql, key) in self._pending:
+                self._coalesced += 1
+            self._pending[(sql, key)] = params
+            self._enqueued += 1
+            self._max_queue_depth = max(self._max_queue_depth, len(self._pending))
+            if self._first_queued_at is None:
+                self._first_queued_at = time.perf_counter()
+            if self.flush_interval and not self._closed:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+                    self._thread.start()
+                self._condition.notify()
+                return
+        # No background thread: write-through
+        self.flush()
+
+    def _run(self) -> None:
+        """Flusher thread: waits for the size or time trigger, then flushes"""
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if self._retry_at is not None and time.perf_counter() < self._retry_at:
+                        self._condition.wait(self._retry_at - time.perf_counter())
+                        continue
+                    if len(self._pending) >= self.max_pending:
+                        break
+                    if self._first_queued_at is None:
+                        self._condition.wait()
+                        continue
+                    timeout = self._first_queued_at + self.flush_interval - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self, force: bool = False) -> int:
+        """Writes everything queued in a single transaction. Blocking
+
+        Args:
+            force (bool, optional): Flush even while backing off after a failed flush. Defaults to False.
+
+        Returns:
+            int: Number of rows written
+        """
+        with self._flush_lock:
+            with self._condition:
+                if not force and self._retry_at is not None and time.perf_counter() < self._retry_at:
+                    return 0
+                pending, self._pending = self._pending, OrderedDict()
+                self._first_queued_at = None
+            if not pending:
+                return 0
+            # Group by statement (keeps the order in which each statement was first queued)
+            batches: OrderedDict[str, list] = OrderedDict()
+            for (sql, _), params in pending.items():
+                batches.setdefault(sql, []).append(params)
+            started = time.perf_counter()
+            try:
+                self.execute_batch(list(batches.items()))
+            except Exception as e:
+                self._failed(pending, e)
+                return 0
+            elapsed = time.perf_counter() - started
+            self._failures = 0
+            self._retry_at = None
+            self._flushes += 1
+            self._rows_written += len(pending)
+            self._total_flush_time += elapsed
+            self._max_flush_time = max(self._max_flush_time, elapsed)
+            logger.debug(f"Flushed {len(pending)} queued writes in {elapsed * 1000:.1f}ms")
+            return len(pending)
+
+    def _failed(self, pending: OrderedDict, error: Exception) -> None:
+        # Queues the failed writes again ahead of the newer ones (which replace them), or drops them after max_retries
+        self._failed_flushes += 1
+        self._failures += 1
+        with self._condition:
+            if self._failures > self.max_retries or self._closed:
+                logger.error(f"Dropping {len(pending)} queued writes after {self._failures} failed flushes: {error}")
+                self._rows_dropped += len(pending)
+                self._failures = 0
+                self._retry_at = None
+                return
+            backoff = max(self.flush_interval, 0.1) * 2 ** (self._failures - 1)
+            logger.error(f"Error flushing {len(pending)} queued writes, retrying in {backoff:.1f}s: {error}")
+            pending.update(self._pending)
+            self._pending = pending
+            self._retry_at = time.perf_counter() + backoff
+            if self._first_queued_at is None:
+                self._first_queued_at = time.perf_counter()
+            self._condition.notify()
+
+    def close(self) -> None:
+        """Stops the flusher thread and flushes what's left (at shutdown)"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(force=True)
+
+    def stats(self) -> dict:
+        """Queue depth, coalescing and flush latency metrics
+
+        Returns:
+            dict: Metrics
+        """
+        return {
+            "flush_ms": self.flush_interval * 1000,
+            "max_pending": self.max_pending,
+            "queue_depth": len(self._pending),
+            "max_queue_depth": self._max_queue_depth,
+            "enqueued": self._enqueued,
+            "coalesced": self._coalesced,
+            "flushes": self._flushes,
+            "rows_written": self._rows_written,
+            "failed_flushes": self._failed_flushes,
+            "rows_dropped": self._rows_dropped,
+            "mean_flush_ms": self._total_flush_time / self._flushes * 1000 if self._flushes else 0,
+            "max_flush_ms": self._max_flush_time * 1000,
+        }
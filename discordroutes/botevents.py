@@ -1,18 +1,20 @@
+import io
 import logging
 import shlex
 
 import discord
 from loguru import logger
 
-from db.models import (
-    OrderBy,
-    get_minmax_roundness_byuserid,
-    get_minmax_roundness_leaderboard,
-    select_user_info,
+from db.asyncmodels import (
+    get_global_leaderboard,
+    get_guild_leaderboard,
+    get_roundness_stats_byguildid,
+    get_roundness_stats_byuserid,
     upsert_message_discordinfo,
     upsert_user_info,
 )
 from discordroutes import bread as breadroute
+from discordroutes import prefilter
 from plots import plots
 
 # This example requires the 'message_content' intent.
@@ -32,28 +34,35 @@ async def breadstats_handler(message: discord.Message, args: list[str]):
     if len(args) < 2:
         await message.channel.send(content="Not enough arguments", reference=message)
     elif args[1] == "--history":
-        ...
-        plot_filepath = plots.plot_roundness_by_user(message.author.id)
-        discord_file = discord.File(plot_filepath)
+        # Rendered off the event loop, and only when the user has new breads since the last one
+        png = await plots.roundness_history_png(message.author.id)
+        if png is None:
+            await message.channel.send(content="No breads, no graph. Go bake something", reference=message)
+            return
+        discord_file = discord.File(io.BytesIO(png), filename=f"{message.author.id}_roundhistory.png")
         reply_content = f"Here's your dumb graph"
         await message.channel.send(content=reply_content, reference=message, file=discord_file)
 
     elif args[1] == "--self":
-        # Return results (top 1) for current user
-        results_min = get_minmax_roundness_byuserid(message.author.id, orderby=OrderBy.ASC.value)
-        min_roundness_percent = round(results_min["roundness"] * 100, 2) if results_min["roundness"] is not None else 0
-        results_max = get_minmax_roundness_byuserid(message.author.id, orderby=OrderBy.DES.value)
-        max_roundness_percent = round(results_max["roundness"] * 100, 2) if results_max["roundness"] is not None else 0
+        # Return results (top 1) for current user, every stat comes from the materialized user stats
+        stats = await get_roundness_stats_byuserid(message.author.id)
+        min_roundness_percent = round(stats["min_roundness"] * 100, 2) if stats["min_roundness"] is not None else 0
+        max_roundness_percent = round(stats["max_roundness"] * 100, 2) if stats["max_roundness"] is not None else 0
+        mean_roundness_percent = round(stats["mean_roundness"] * 100, 2) if stats["mean_roundness"] is not None else 0
+        percentile_rank = stats["percentile_rank"] if stats["percentile_rank"] is not None else 0
         reply_content = f"""
                             Hello {message.author.name}:
-                            Min roundness:  {min_roundness_percent:.2f}% on message: {results_min["roundness_url"]},
-                            Max roundness {max_roundness_percent:.2f}% on message: {results_max["roundness_url"]}
+                            Min roundness:  {min_roundness_percent:.2f}% on message: {stats["min_roundness_url"]},
+                            Max roundness {max_roundness_percent:.2f}% on message: {stats["max_roundness_url"]}
+                            Mean roundness {mean_roundness_percent:.2f}% over {stats["count"]} breads
+                            Your best bread is rounder than the best bread of {percentile_rank:.1f}% of bakers
                             """
         await message.channel.send(content=reply_content, reference=message)
     elif args[1] == "--top":
-        # Return "top X" for the server
+        # Return "top X" for the server (or only this channel with --here). In DMs, for every server
+        channel_id = message.channel.id if "--here" in args else None
         try:
-            limit = int(args[2])
+            limit = int([arg for arg in args[2:] if arg != "--here"][0])
             append_to_limit = ""
             if limit > 10:
                 limit = 10
@@ -62,27 +71,34 @@ async def breadstats_handler(message: discord.Message, args: list[str]):
             logger.warning(e)
             limit = 3
             append_to_limit = " (You didn't enter a valid number. Shame on you)"
-        # Query DB and get results
-        results_max = get_minmax_roundness_leaderboard(limit, orderby=OrderBy.DES.value)
-        results_min = get_minmax_roundness_leaderboard(limit, orderby=OrderBy.ASC.value)
+        # Query DB and get results: top and worst with the author names in a single (cached) query
+        if message.guild is None:
+            leaderboard = await get_global_leaderboard(limit)
+        else:
+            leaderboard = await get_guild_leaderboard(message.guild.id, limit, channel_id=channel_id)
         # Generate message part for top X
         reply_content_max = f"Top {limit}{append_to_limit}:"
-        for idx, val in enumerate(results_max):
+        for idx, val in enumerate(leaderboard["top"]):
             roundness_percent = round(val["roundness"] * 100, 2) if val["roundness"] is not None else 0
-            user_info = select_user_info(val["author_id"])
-            if user_info is None:
-                user_info = {"author_name": "unknown"}
-            reply_content_max = f"""{reply_content_max}\n #{idx + 1}: {user_info["author_name"]} with {roundness_percent:.2f}% on message {val["jump_url"]}"""
+            author_name = val["author_name"] or "unknown"
+            reply_content_max = f"""{reply_content_max}\n #{idx + 1}: {author_name} with {roundness_percent:.2f}% on message {val["jump_url"]}"""
         # Generate message part for worst X
-        reply_content_min = "Worst 3:"
-        for idx, val in enumerate(results_min):
-            user_info = select_user_info(val["author_id"])
-            if user_info is None:
-                user_info = {"author_name": "unknown"}
+        reply_content_min = f"Worst {limit}:"
+        for idx, val in enumerate(leaderboard["bottom"]):
+            author_name = val["author_name"] or "unknown"
             roundness_percent = round(val["roundness"] * 100, 2) if val["roundness"] is not None else 0
-            reply_content_min = f"""{reply_content_min}\n #{idx + 1}: {user_info["author_name"]} with {roundness_percent:.2f}% on message {val["jump_url"]}"""
+            reply_content_min = f"""{reply_content_min}\n #{idx + 1}: {author_name} with {roundness_percent:.2f}% on message {val["jump_url"]}"""
 
         reply_content = f"{reply_content_max}\n{reply_content_min}"
+        if message.guild is not None:
+            guild_stats = await get_roundness_stats_byguildid(message.guild.id)
+            mean_roundness_percent = (
+                round(guild_stats["mean_roundness"] * 100, 2) if guild_stats["mean_roundness"] is not None else 0
+            )
+            reply_content_guild = (
+                f"{guild_stats['count']} breads on this server, {mean_roundness_percent:.2f}% round on average"
+            )
+            reply_content = f"{reply_content}\n{reply_content_guild}"
         await message.channel.send(content=reply_content, reference=message)
 
 
@@ -109,7 +125,7 @@ async def breadinference_handler(message: discord.Message, args: list[str]):
             sentmessages = await breadroute.send_bread_message(message=message, overrideconfidence=False)
             # Store data in DB
             for sentmessage in sentmessages:
-                upsert_message_discordinfo(
+                await upsert_message_discordinfo(
                     ogmessage_id=message.id,
                     replymessage_jump_url=sentmessage.jump_url,
                     replymessage_id=sentmessage.id,
@@ -131,7 +147,7 @@ async def breadinference_handler(message: discord.Message, args: list[str]):
             sentmessages = await breadroute.send_bread_message(message=ogmessage, overrideconfidence=True)
             # Store data in DB
             for sentmessage in sentmessages:
-                upsert_message_discordinfo(
+                await upsert_message_discordinfo(
                     ogmessage_id=ogmessage.id,
                     replymessage_jump_url=sentmessage.jump_url,
                     replymessage_id=sentmessage.id,
@@ -148,6 +164,7 @@ async def help_handler(message: discord.Message, args: list[str]):
     help_message = """Available commands:
                     $breadstats --self : Get your roundness bread stats
                     $breadstats --top X : Get the server roundness breadstats (X is a number)
+                    $breadstats --top X --here : Same, only for this channel
                     $breadstats --history : Get your roundness history
                     $help : you just used this
                     """
@@ -162,25 +179,33 @@ mapping_functions = {
 }
 
 
+def split_args(content: str) -> list[str]:
+    # Shell-like arguments, unbalanced quotes fall back to splitting on whitespace
+    try:
+        return shlex.split(content.strip())
+    except ValueError:
+        return content.split()
+
+
 @bot.event
 async def on_message(message: discord.Message):
-    logger.debug("Received message!")
-    # Cache the user info
-    upsert_user_info(
+    # Most messages are dropped here with O(1) checks (own messages too, to avoid endlessly triggering itself)
+    route = prefilter.route_message(message, bot.user, mapping_functions.keys())
+    if route is None:
+        return
+    logger.debug(f"Received {route} message!")
+    # Cache the user info (only written if it changed)
+    await upsert_user_info(
         author_id=message.author.id,
-        author_nickname=message.author.nick,
+        author_nickname=getattr(message.author, "nick", None),
         author_name=message.author.name,
     )
-    if message.author == bot.user:
-        # This is just to avoid endlessly triggering itself
-        return
-    message_args = shlex.split(message.content.strip())
-    func_args = (message, message_args)
-    if message_args and message_args[0].startswith("$") and message_args[0] in mapping_functions.keys():
-        await mapping_functions[message_args[0]](*func_args)
+    if route == "command":
+        message_args = split_args(message.content)
+        await mapping_functions[message_args[0]](message, message_args)
     else:
-        # Default - assume it was a bread message and scan it anyway
-        await breadinference_handler(message=message, args=message_args)
+        # Bread picture or "are you sure" reply
+        await breadinference_handler(message=message, args=[])
 
 
 async def get_message_by_id(guild_id: int, channel_id: int, message_id: int):
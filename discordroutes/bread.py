@@ -1,3 +1,5 @@
+import asyncio
+import io
 import json
 import os
 from typing import Tuple
@@ -6,14 +8,40 @@ import discord
 from dotenv import load_dotenv
 from loguru import logger
 
-from db.models import upsert_message_stats
+from breadinfer.admission import AdmissionController, AdmissionRejected
+from breadinfer.inference import BreadAnalysis
+from db.asyncmodels import upsert_message_stats
+from db.models import get_message_predictions, update_message_scores
+from discordroutes.download import AttachmentRejected, download_attachment
 
 load_dotenv()
 download_directory = os.path.join(
     os.getcwd(), os.environ.get("DISCORD_DOWNLOAD_DIRECTORY")
 )
-discord_bread_channels = json.loads(os.environ.get("DISCORD_BREAD_CHANNELS"))
-allowed_bread_groups = json.loads(os.environ.get("DISCORD_BREAD_ROLE"))
+segmented_directory = os.path.join(os.getcwd(), "output", "segmented")
+# Sets: checked for every message the bot sees
+discord_bread_channels = frozenset(json.loads(os.environ.get("DISCORD_BREAD_CHANNELS")))
+allowed_bread_groups = frozenset(json.loads(os.environ.get("DISCORD_BREAD_ROLE")))
+# Replies to the bot that make it run the inference again with override confidences
+areyousure_triggers = ["are you sure", "fr no cap", "no way"]
+# Reply when the shape (or the whole picture) couldn't be analyzed
+shape_dough_comment = (
+    "I couldn't find the shape dough. (Get it? Though - dough ehehehehe)"
+)
+# Keep a copy of the attachments and segmented images on disk (written in the background)
+persist_bread_images = os.environ.get("PERSIST_BREAD_IMAGES", "false").lower() == "true"
+_persist_tasks = set()
+# Attachments downloaded at once
+_download_semaphore = asyncio.Semaphore(
+    int(os.environ.get("DISCORD_DOWNLOAD_CONCURRENCY", 4))
+)
+# Images analyzed at once (in total and per guild) and waiting, admitted round-robin by guild and user
+inferenceadmission = AdmissionController(
+    max_in_flight=int(os.environ.get("INFERENCE_MAX_IN_FLIGHT", 4)),
+    max_queued=int(os.environ.get("INFERENCE_MAX_QUEUED", 32)),
+    max_queued_per_user=int(os.environ.get("INFERENCE_MAX_QUEUED_PER_USER", 10)),
+    max_in_flight_per_guild=int(os.environ.get("BREAD_GUILD_CONCURRENCY", 2)),
+)
 
 
 async def send_bread_message(
@@ -21,46 +49,202 @@ async def send_bread_message(
 ) -> Tuple[discord.Message, dict, int]:
     """Main "bread analyze" function -> calls the compute function and sends message based on results
 
+    Every attachment is downloaded and analyzed concurrently (so the inference requests can be batched together),
+    the replies are still sent (and the results stored) in attachment order, as soon as they're ready.
+    An attachment that fails gets its own error reply, the others are still processed.
+
     Args:
         message (_type_): _description_
     """
-
-    # Download and process each attached picture
+    guild_id = message.guild.id if message.guild else None
+    tasks = [
+        asyncio.create_task(
+            analyze_bread_attachment(
+                attachment, overrideconfidence, guild_id, message.author.id
+            )
+        )
+        for attachment in message.attachments
+    ]
     sentmessages = []
-    for attachment in message.attachments:
-        filename = os.path.join(download_directory, attachment.filename)
-        if not os.path.exists(download_directory):
-            os.makedirs(download_directory)
-        await attachment.save(filename)
-        logger.info(f"Saved {attachment.filename} to {download_directory}")
+    try:
         async with message.channel.typing():
-            # Compute: Get file (or None) and comment to be used
-            discord_file, breadcomment = await compute_bread_message(
-                filename=filename,
-                overrideconfidence=overrideconfidence,
-                ogmessage_id=message.id,
-            )
-            # Send the image back with the comment
-            sentmessage = await message.channel.send(
-                file=discord_file, content=breadcomment, reference=message
-            )
-            sentmessages.append(sentmessage)
+            for attachment, task in zip(message.attachments, tasks):
+                try:
+                    image_bytes, analysis = await task
+                except AdmissionRejected as e:
+                    logger.warning(f"Inference queue full ({e.reason}), skipping")
+                    await message.channel.send(
+                        content="The oven's full! Try again in a bit", reference=message
+                    )
+                    break
+                except AttachmentRejected as e:
+                    if e.reason in ("too_large", "too_many_pixels"):
+                        await message.channel.send(
+                            content=f"{attachment.filename} is too big for my oven",
+                            reference=message,
+                        )
+                    continue
+                except Exception as e:
+                    logger.opt(exception=e).error(
+                        f"Error analyzing {attachment.filename}"
+                    )
+                    await send_failure_reply(message, attachment)
+                    continue
+                try:
+                    # Compute: Get file (or None) and comment to be used
+                    discord_file, breadcomment = await compute_bread_message(
+                        image_bytes=image_bytes,
+                        filename=attachment.filename,
+                        overrideconfidence=overrideconfidence,
+                        ogmessage_id=message.id,
+                        guild_id=guild_id,
+                        analysis=analysis,
+                    )
+                    # Send the image back with the comment
+                    sentmessage = await message.channel.send(
+                        file=discord_file, content=breadcomment, reference=message
+                    )
+                except Exception as e:
+                    logger.opt(exception=e).error(
+                        f"Error replying to {attachment.filename}"
+                    )
+                    await send_failure_reply(message, attachment)
+                    continue
+                sentmessages.append(sentmessage)
+    finally:
+        # Only left after "the oven's full" (or if this was cancelled): the rest isn't replied to.
+        # Awaited so their errors are retrieved
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
     return sentmessages
 
 
-async def compute_bread_message(
-    filename: str, overrideconfidence: bool = False, ogmessage_id: int = 1
-) -> Tuple[discord.File, str]:
-    """Main "bread compute" function -> Does all the compute calls
-    and returns the artifacts to be sent on the discord message
+async def send_failure_reply(
+    message: discord.Message, attachment: discord.Attachment
+) -> None:
+    """Replies that an attachment couldn't be analyzed (errors sending it are only logged)
 
     Args:
-        message (_type_): _description_
+        message (discord.Message): Message with the attachment
+        attachment (discord.Attachment): Attachment that failed
+    """
+    try:
+        await message.channel.send(
+            content=f"{attachment.filename}: {shape_dough_comment}", reference=message
+        )
+    except discord.HTTPException as e:
+        logger.error(f"Error sending failure reply: {e}")
+
+
+async def analyze_bread_attachment(
+    attachment: discord.Attachment,
+    overrideconfidence: bool,
+    guild_id: int = None,
+    user_id: int = None,
+) -> Tuple[bytes, BreadAnalysis]:
+    """Downloads an attachment and runs the inference on it, once admitted by inferenceadmission
+
+    The download only starts once admitted, so waiting requests don't hold images in memory. Downloads are also
+    limited to DISCORD_DOWNLOAD_CONCURRENCY at once, streamed and aborted early if the attachment isn't an image
+    or is too large
+
+    Args:
+        attachment (discord.Attachment): Attached picture
+        overrideconfidence (bool): Whether to use the lower "override" confidences
+        guild_id (int, optional): Guild of the message. Defaults to None.
+        user_id (int, optional): Author of the message. Defaults to None.
+
+    Raises:
+        AdmissionRejected: Too many images are already waiting for inference
+        AttachmentRejected: The attachment is too large or isn't an image
+
+    Returns:
+        Tuple[bytes, BreadAnalysis]: Attachment contents and analysis
+    """
+    async with inferenceadmission.slot(user_id, guild_id):
+        async with _download_semaphore:
+            image_bytes = await download_attachment(attachment)
+        logger.info(f"Downloaded {attachment.filename} ({len(image_bytes)} bytes)")
+        analysis = await analyze_bread_image(image_bytes, overrideconfidence)
+    return image_bytes, analysis
+
+
+async def analyze_bread_image(
+    image_bytes: bytes, overrideconfidence: bool = False
+) -> BreadAnalysis:
+    """Runs the labels and segmentation models on an image
+
+    Args:
+        image_bytes (bytes): Attachment contents
+        overrideconfidence (bool, optional): Whether to use the lower "override" confidences. Defaults to False.
+
+    Returns:
+        BreadAnalysis: Labels, roundness and annotated image
     """
     # Lazy import to make sure it's always updated
     from breadinfer.inference import inferhandler
 
-    # Set confidences based on whether this was an "override" request or default
+    breadpic_confidence, _, breadseg_confidence = get_bread_confidences(
+        overrideconfidence
+    )
+    # Compute labels and segmentation in a single pass. Segmentation only runs if it is good enough of a bread picture
+    # Models run at the floor confidence, these confidences are only filters over the raw predictions
+    return await inferhandler.async_analyze_bytes(
+        image_bytes=image_bytes,
+        label_confidence=float(os.environ.get("MIN_BREAD_LABEL_CONFIDENCE")),
+        seg_confidence=breadseg_confidence,
+        bread_confidence=breadpic_confidence,
+    )
+
+
+def save_bread_images(
+    filename: str, image_bytes: bytes, annotated_image_bytes: bytes = None
+) -> None:
+    """Writes the original attachment and the segmented image to disk
+
+    Args:
+        filename (str): Attachment filename
+        image_bytes (bytes): Original attachment
+        annotated_image_bytes (bytes, optional): Segmented image (jpg). Defaults to None.
+    """
+    os.makedirs(download_directory, exist_ok=True)
+    with open(os.path.join(download_directory, filename), "wb") as file:
+        file.write(image_bytes)
+    logger.info(f"Saved {filename} to {download_directory}")
+    if annotated_image_bytes is not None:
+        os.makedirs(segmented_directory, exist_ok=True)
+        segmented_filename = f"{os.path.splitext(filename)[0]}.jpg"
+        with open(os.path.join(segmented_directory, segmented_filename), "wb") as file:
+            file.write(annotated_image_bytes)
+        logger.info(f"Saved {segmented_filename} to {segmented_directory}")
+
+
+def persist_bread_images_background(
+    filename: str, image_bytes: bytes, annotated_image_bytes: bytes = None
+) -> None:
+    """Schedules save_bread_images on the executor without waiting for it (if PERSIST_BREAD_IMAGES is enabled)"""
+    if not persist_bread_images:
+        return
+    loop = asyncio.get_running_loop()
+    task = loop.run_in_executor(
+        None, save_bread_images, filename, image_bytes, annotated_image_bytes
+    )
+    _persist_tasks.add(task)
+    task.add_done_callback(_persist_tasks.discard)
+
+
+def get_bread_confidences(
+    overrideconfidence: bool = False,
+) -> Tuple[float, float, float]:
+    """Confidences for a bread message, based on whether this was an "override" request or default
+
+    Args:
+        overrideconfidence (bool, optional): Whether to use the lower "override" confidences. Defaults to False.
+
+    Returns:
+        Tuple[float, float, float]: bread detection, label and segmentation confidences
+    """
     if overrideconfidence:
         breadpic_confidence = float(os.environ.get("OVERRIDE_DETECTION_CONFIDENCE"))
         breadlabel_confidence = float(os.environ.get("MIN_BREAD_LABEL_CONFIDENCE"))
@@ -69,8 +253,65 @@ async def compute_bread_message(
         breadpic_confidence = float(os.environ.get("BREAD_DETECTION_CONFIDENCE"))
         breadlabel_confidence = float(os.environ.get("FILTER_BREAD_LABEL_CONFIDENCE"))
         breadseg_confidence = float(os.environ.get("FILTER_BREAD_SEG_CONFIDENCE"))
-    # Compute labels, this also works as detection with confidence
-    labels = await inferhandler.async_labels_from_imgpath(filename)
+    return breadpic_confidence, breadlabel_confidence, breadseg_confidence
+
+
+def rescore_bread_messages() -> int:
+    """Recomputes labels_json and roundness of every stored message under the current confidences,
+    from the stored raw predictions (no inference is run)
+
+    Returns:
+        int: Number of rescored messages
+    """
+    from breadinfer.inference import inferhandler
+
+    label_confidence = float(os.environ.get("MIN_BREAD_LABEL_CONFIDENCE"))
+    scores = []
+    for row in get_message_predictions():
+        _, _, breadseg_confidence = get_bread_confidences(row["overrideconfidence"])
+        labels, roundness = inferhandler.rescore_predictions(
+            row["predictions"], label_confidence, breadseg_confidence
+        )
+        scores.append((row["ogmessage_id"], roundness, labels))
+    update_message_scores(scores)
+    return len(scores)
+
+
+async def compute_bread_message(
+    image_bytes: bytes,
+    filename: str,
+    overrideconfidence: bool = False,
+    ogmessage_id: int = 1,
+    guild_id: int = None,
+    analysis: BreadAnalysis = None,
+) -> Tuple[discord.File, str]:
+    """Main "bread compute" function -> Does all the compute calls
+    and returns the artifacts to be sent on the discord message.
+    Everything is done in memory, nothing is read from or written to disk (unless PERSIST_BREAD_IMAGES is enabled)
+
+    Args:
+        image_bytes (bytes): Attachment contents
+        filename (str): Attachment filename
+        overrideconfidence (bool, optional): Whether to use the lower "override" confidences. Defaults to False.
+        ogmessage_id (int, optional): Message id to store the results in DB. Defaults to 1.
+        guild_id (int, optional): Guild of the message, its cached leaderboards are refreshed. Defaults to None.
+        analysis (BreadAnalysis, optional): Inference results if they were already computed. Defaults to None.
+    """
+    # Lazy import to make sure it's always updated
+    from breadinfer.inference import inferhandler
+
+    # Set confidences based on whether this was an "override" request or default
+    (
+        breadpic_confidence,
+        breadlabel_confidence,
+        breadseg_confidence,
+    ) = get_bread_confidences(overrideconfidence)
+    if analysis is None:
+        analysis = await analyze_bread_image(image_bytes, overrideconfidence)
+    persist_bread_images_background(
+        filename, image_bytes, analysis.annotated_image_bytes
+    )
+    labels = analysis.labels
     # First we check if it is a bread picture at all
     if "bread" in labels.keys():
         # And then we check if it is good enough of a bread picture to do segmentation on it
@@ -79,33 +320,28 @@ async def compute_bread_message(
                 predictions=labels, min_confidence=breadlabel_confidence
             )
             # We try to get the segmentation and roundness.
-            try:
-                (
-                    out_img,
-                    result,
-                ) = await inferhandler.async_segmentation_from_imgpath(
-                    input_img_path=filename, confidence=breadseg_confidence
-                )
+            if analysis.annotated_image_bytes is not None:
                 # We get it here to use it later on and also save it on db
-                roundness = inferhandler.estimate_roundness_from_mask(result)
+                roundness = analysis.roundness
                 roundcomment = inferhandler.get_message_from_roundness(roundness)
-                discord_file = discord.File(out_img)
-                breadcomment = breadcomment + roundcomment
-
-            # TODO get the proper exception(s)
-            except Exception as e:
-                logger.error(e)
-                discord_file = discord.File(filename)
-                breadcomment = (
-                    breadcomment
-                    + ". I couldn't find the shape dough. (Get it? Though - dough ehehehehe)"
+                discord_file = discord.File(
+                    io.BytesIO(analysis.annotated_image_bytes),
+                    filename=f"{os.path.splitext(filename)[0]}.jpg",
                 )
+                breadcomment = breadcomment + roundcomment
+            else:
+                discord_file = discord.File(io.BytesIO(image_bytes), filename=filename)
+                breadcomment = f"{breadcomment}. {shape_dough_comment}"
                 roundness = None
             # Insert data in DB for rankings
-            upsert_message_stats(
+            await upsert_message_stats(
                 ogmessage_id=ogmessage_id,
                 roundness=roundness,
                 labels_json=labels,
+                predictions=analysis.raw_predictions,
+                model_id=inferhandler.model_id,
+                overrideconfidence=overrideconfidence,
+                guild_id=guild_id,
             )
             # Send the image back with the comment
             file, content = discord_file, breadcomment
@@ -134,8 +370,8 @@ async def check_bread_message(
 
     Args:
         message (DiscordMessage): DiscordMessage object
-        allowed_channels (List): List of allowed channels for the message
-        allowed_group (List): List of allowed roles for the user
+        allowed_channels (Set): Allowed channel ids for the message
+        allowed_group (Set): Allowed role ids for the user
 
     Returns:
         Bool: Whether it passes all checks or not
@@ -148,11 +384,9 @@ async def check_bread_message(
         return False
 
     # Check if the author is from the specific group
-    author = message.author
-    author_role_ids = set([role.id for role in author.roles])
-    allowed_role_ids = set(allowed_group)
-
-    if not bool(author_role_ids.intersection(allowed_role_ids)):
+    if not any(
+        role.id in allowed_group for role in getattr(message.author, "roles", ())
+    ):
         logger.debug("Message not from correct author in group")
         return False
 
@@ -175,7 +409,6 @@ async def check_areyousure_message(message: discord.Message, botuser: str) -> No
         Bool: Whether it passes all checks or not
     """
 
-    trigger_texts = ["are you sure", "fr no cap", "no way"]
     logger.debug("Checking message for areyousure content...")
     # Check if the message is a reply
     if not (
@@ -185,6 +418,6 @@ async def check_areyousure_message(message: discord.Message, botuser: str) -> No
     ):
         return False
     # Check if message includes "are you sure or similar words"
-    if not any(trigger in message.content.lower() for trigger in trigger_texts):
+    if not any(trigger in message.content.lower() for trigger in areyousure_triggers):
         return False
     return True
@@ -0,0 +1,120 @@
+"""Streaming attachment downloads: checked before and while downloading, aborted as soon as they're rejected
+
+Attachments are rejected from their metadata first (size, content type) without downloading anything, then while
+streaming them: magic bytes of the first chunk (only formats decode_image handles), size so far and image dimensions
+(read from the header as soon as it has arrived). Accepted attachments are kept in memory, never written to disk.
+"""
+
+import os
+from collections import Counter
+
+import aiohttp
+import discord
+from loguru import logger
+
+from breadinfer.preprocess import MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS, image_dimensions, image_format
+
+CHUNK_SIZE = int(os.environ.get("DISCORD_DOWNLOAD_CHUNK_SIZE", 64 * 1024))
+# Image dimensions are looked for in this many bytes at most (JPEG headers are usually in the first few KB,
+# the other formats have them in the first few bytes)
+HEADER_MAX_BYTES = 1024 * 1024
+
+_session: aiohttp.ClientSession = None
+_counters = Counter()
+
+
+class AttachmentRejected(Exception):
+    """The attachment isn't an image we can analyze
+
+    Reasons: too_large, too_many_pixels, content_type (not image/*) or unsupported_format (not jpeg, png, webp or bmp)
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _reject(reason: str, attachment: discord.Attachment, downloaded: int = 0) -> AttachmentRejected:
+    _counters[f"rejected_{reason}"] += 1
+    if attachment.size:
+        _counters["bytes_skipped"] += max(0, attachment.size - downloaded)
+    logger.info(f"Rejected attachment {attachment.filename} ({reason}) after {downloaded} bytes")
+    return AttachmentRejected(reason)
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+    return _session
+
+
+async def download_attachment(
+    attachment: discord.Attachment, max_bytes: int = MAX_IMAGE_BYTES, max_pixels: int = MAX_IMAGE_PIXELS
+) -> bytes:
+    """Downloads an image attachment in chunks, aborting as soon as it turns out to be something we'd reject
+
+    Args:
+        attachment (discord.Attachment): Discord attachment
+        max_bytes (int, optional): Max file size. Defaults to INFERENCE_MAX_IMAGE_BYTES.
+        max_pixels (int, optional): Max image pixels. Defaults to INFERENCE_MAX_IMAGE_PIXELS.
+
+    Raises:
+        AttachmentRejected: Too large, or not an image we can decode
+        aiohttp.ClientError: The download failed
+
+    Returns:
+        bytes: Attachment contents
+    """
+    _counters["requested"] += 1
+    # Metadata checks, nothing downloaded yet
+    if attachment.size and attachment.size > max_bytes:
+        raise _reject("too_large", attachment)
+    if attachment.content_type and not attachment.content_type.startswith("image/"):
+        raise _reject("content_type", attachment)
+    buffer = bytearray()
+    file_format, dimensions = None, None
+    session = await _get_session()
+    async with session.get(attachment.url) as response:
+        response.raise_for_status()
+        if response.content_length and response.content_length > max_bytes:
+            raise _reject("too_large", attachment)
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) > max_bytes:
+                raise _reject("too_large", attachment, len(buffer))
+            if file_format is None and len(buffer) >= 12:
+                file_format = image_format(bytes(buffer[:12]))
+                if file_format is None:
+                    raise _reject("unsupported_format", attachment, len(buffer))
+            if dimensions is None and file_format is not None and len(buffer) <= HEADER_MAX_BYTES:
+                dimensions = image_dimensions(buffer)
+                if dimensions and dimensions[0] * dimensions[1] > max_pixels:
+                    raise _reject("too_many_pixels", attachment, len(buffer))
+    if file_format is None:
+        raise _reject("unsupported_format", attachment, len(buffer))
+    if dimensions is None:
+        # Header not found while streaming: decode_image would refuse it too
+        dimensions = image_dimensions(buffer)
+        if dimensions is None:
+            raise _reject("unsupported_format", attachment, len(buffer))
+        if dimensions[0] * dimensions[1] > max_pixels:
+            raise _reject("too_many_pixels", attachment, len(buffer))
+    _counters["downloaded"] += 1
+    _counters["bytes_downloaded"] += len(buffer)
+    return bytes(buffer)
+
+
+def stats() -> dict:
+    """Attachments requested, downloaded and rejected (by reason), bytes downloaded and skipped
+
+    Returns:
+        dict: Counters
+    """
+    return dict(_counters)
+
+
+async def close() -> None:
+    """Closes the HTTP session (at shutdown)"""
+    if _session is not None and not _session.closed:
+        await _session.close()
@@ -0,0 +1,79 @@
+"""Cheap checks run on every message the bot sees, before any DB work, tokenizing or inference
+
+Only the messages that could be a command, a bread picture or an "are you sure" reply get through, everything
+else is dropped with a few attribute lookups. Counters keep track of what each stage drops.
+"""
+
+import os
+import threading
+from collections import Counter
+from typing import Optional
+
+import discord
+
+from discordroutes.bread import allowed_bread_groups, areyousure_triggers, discord_bread_channels
+
+IMAGE_EXTENSIONS = frozenset([".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".heic", ".heif", ".tif", ".tiff"])
+
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def _count(stage: str) -> None:
+    with _lock:
+        _counters[stage] += 1
+
+
+def is_image_attachment(attachment: discord.Attachment) -> bool:
+    """Whether the attachment is an image, from its content type (or its extension if Discord didn't set one)"""
+    if attachment.content_type:
+        return attachment.content_type.startswith("image/")
+    return os.path.splitext(attachment.filename)[1].lower() in IMAGE_EXTENSIONS
+
+
+def route_message(message: discord.Message, botuser: discord.ClientUser, commands: set[str]) -> Optional[str]:
+    """Decides what kind of message this is, cheapest checks first
+
+    Args:
+        message (discord.Message): Discord message
+        botuser (discord.ClientUser): The bot user (its own messages are ignored)
+        commands (set[str]): Known commands ($breadstats, ...)
+
+    Returns:
+        Optional[str]: "command", "areyousure" or "bread", None if the message can be ignored
+    """
+    _count("received")
+    if message.author == botuser:
+        _count("dropped_own")
+        return None
+    content = message.content.lstrip()
+    if content.startswith("$") and content.split(maxsplit=1)[0] in commands:
+        _count("command")
+        return "command"
+    if message.reference is not None and any(trigger in content.lower() for trigger in areyousure_triggers):
+        _count("areyousure")
+        return "areyousure"
+    if not message.attachments:
+        _count("dropped_no_attachments")
+        return None
+    if message.channel.id not in discord_bread_channels:
+        _count("dropped_channel")
+        return None
+    if not any(is_image_attachment(attachment) for attachment in message.attachments):
+        _count("dropped_content_type")
+        return None
+    if not any(role.id in allowed_bread_groups for role in getattr(message.author, "roles", ())):
+        _count("dropped_role")
+        return None
+    _count("bread")
+    return "bread"
+
+
+def stats() -> dict:
+    """Messages received, routed and dropped by each stage
+
+    Returns:
+        dict: Counters
+    """
+    with _lock:
+        return dict(_counters)
@@ -11,13 +11,14 @@ from fastapi.responses import RedirectResponse
 from loguru import logger
 
 from apiroutes import api_router
-from db.models import create_db
+from db import asyncmodels
 from discordroutes.botevents import bot
 
 load_dotenv()
 
 app = FastAPI()
 app.include_router(api_router)
+_background_tasks = set()  # Keep references to background startup tasks
 
 
 # Logger
@@ -30,8 +31,33 @@ async def startup_event():  # this function will run before the main API starts
     asyncio.create_task(bot.start(os.environ.get("DISCORD_TOKEN")))
     await asyncio.sleep(4)  # optional sleep for established connection with discord
     logger.info(f"{bot.user} has connected to Discord!")
-    create_db()
+    await asyncmodels.create_db()
+    await asyncmodels.load_author_cache()
     logger.info("Started DB")
+    # Load and warm up the inference models without blocking the event loop
+    from breadinfer import inference
+
+    loop = asyncio.get_event_loop()
+    warmup = loop.run_in_executor(None, inference.inferhandler.warmup)
+    _background_tasks.add(warmup)
+    warmup.add_done_callback(_warmup_done)
+
+
+def _warmup_done(future: asyncio.Future):
+    _background_tasks.discard(future)
+    if not future.cancelled() and future.exception() is not None:
+        logger.opt(exception=future.exception()).error("Inference warmup failed")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    from breadinfer import inference
+    from discordroutes import download
+
+    inference.inferhandler.shutdown()
+    await download.close()
+    # Queued DB writes are flushed before closing the connections
+    await asyncmodels.close()
 
 
 @app.get("/")
@@ -0,0 +1,108 @@
+"""Roundness history plot drawn with OpenCV/NumPy, same layout as the seaborn one without importing matplotlib"""
+
+import cv2
+import numpy as np
+
+# Colors (BGR), close to the seaborn darkgrid style
+BACKGROUND = (255, 255, 255)
+PLOT_AREA = (242, 234, 234)
+GRID = (255, 255, 255)
+TEXT = (40, 40, 40)
+LINE = (128, 128, 0)  # teal
+MARKER = (0, 165, 255)  # orange
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def _dashed_line(img: np.ndarray, p1: tuple, p2: tuple, color: tuple, thickness: int, dash: int, gap: int) -> None:
+    length = float(np.hypot(p2[0] - p1[0], p2[1] - p1[1]))
+    if length == 0:
+        return
+    direction = (np.array(p2, dtype=float) - p1) / length
+    starts = np.arange(0, length, dash + gap)
+    ends = np.minimum(starts + dash, length)
+    a = np.round(np.array(p1) + direction * starts[:, None]).astype(int)
+    b = np.round(np.array(p1) + direction * ends[:, None]).astype(int)
+    for start, end in zip(a.tolist(), b.tolist()):
+        cv2.line(img, start, end, color, thickness, cv2.LINE_AA)
+
+
+def _centered_text(img: np.ndarray, text: str, center_x: int, y: int, scale: float, thickness: int) -> None:
+    (width, _), _ = cv2.getTextSize(text, FONT, scale, thickness)
+    cv2.putText(img, text, (center_x - width // 2, y), FONT, scale, TEXT, thickness, cv2.LINE_AA)
+
+
+def render_roundness_history(data: list[tuple[int, float]], scale: float = 1.0) -> bytes:
+    """Renders the roundness history plot
+
+    Args:
+        data (list[tuple[int, float]]): (X, Y) values, Y being the roundness (0 to 1)
+        scale (float, optional): Size multiplier of the 1200x700 image. Defaults to 1.0.
+
+    Returns:
+        bytes: PNG image
+    """
+    width, height = int(1200 * scale), int(700 * scale)
+    left, right, top, bottom = int(100 * scale), int(30 * scale), int(70 * scale), int(80 * scale)
+    thickness = max(1, round(2 * scale))
+    img = np.full((height, width, 3), BACKGROUND, dtype=np.uint8)
+    cv2.rectangle(img, (left, top), (width - right, height - bottom), PLOT_AREA, -1)
+
+    x_values = np.array([x for x, _ in data], dtype=float)
+    y_values = np.array([y * 100 for _, y in data], dtype=float)
+    x_min, x_max = x_values.min(), x_values.max()
+    if x_min == x_max:
+        x_min, x_max = x_min - 1, x_max + 1
+    x_pad = (x_max - x_min) * 0.03
+    x_min, x_max = x_min - x_pad, x_max + x_pad
+
+    def to_pixel(x: float, y: float) -> tuple[int, int]:
+        px = left + (x - x_min) / (x_max - x_min) * (width - right - left)
+        py = height - bottom - y / 100 * (height - bottom - top)
+        return int(round(px)), int(round(py))
+
+    # Grid and ticks: Y every 20%, X on about 10 integer steps
+    text_scale = 0.6 * scale
+    for y in range(0, 101, 20):
+        _, py = to_pixel(x_min, y)
+        cv2.line(img, (left, py), (width - right, py), GRID, thickness)
+        label = str(y)
+        (label_width, label_height), _ = cv2.getTextSize(label, FONT, text_scale, 1)
+        cv2.putText(
+            img,
+            label,
+            (left - label_width - int(10 * scale), py + label_height // 2),
+            FONT,
+            text_scale,
+            TEXT,
+            1,
+            cv2.LINE_AA,
+        )
+    step = max(1, int(np.ceil((x_values.max() - x_values.min()) / 10)))
+    for x in range(int(np.ceil(x_values.min())), int(x_values.max()) + 1, step):
+        px, _ = to_pixel(x, 0)
+        cv2.line(img, (px, top), (px, height - bottom), GRID, thickness)
+        _centered_text(img, str(x), px, height - bottom + int(25 * scale), text_scale, 1)
+
+    # Dashed line with small markers, then the big orange points on top
+    points = [to_pixel(x, y) for x, y in zip(x_values, y_values)]
+    for p1, p2 in zip(points, points[1:]):
+        _dashed_line(img, p1, p2, LINE, max(1, round(2.5 * scale)), int(10 * scale), int(6 * scale))
+    for point in points:
+        cv2.circle(img, point, max(2, round(5 * scale)), LINE, -1, cv2.LINE_AA)
+    for point in points:
+        cv2.circle(img, point, max(3, round(7 * scale)), MARKER, -1, cv2.LINE_AA)
+
+    # Labels and title
+    _centered_text(img, "Amazing roundness history for User", width // 2, int(45 * scale), 0.9 * scale, thickness)
+    _centered_text(img, "X", (left + width - right) // 2, height - int(25 * scale), 0.7 * scale, thickness)
+    y_label = np.full((int(40 * scale), int(120 * scale), 3), BACKGROUND, dtype=np.uint8)
+    _centered_text(y_label, "Y (%)", y_label.shape[1] // 2, int(28 * scale), 0.7 * scale, thickness)
+    y_label = cv2.rotate(y_label, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    y_center = (top + height - bottom) // 2 - y_label.shape[0] // 2
+    img[y_center : y_center + y_label.shape[0], 0 : y_label.shape[1]] = y_label
+
+    # Fastest compression: the size barely changes for flat colors
+    ok, png = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise ValueError("Could not encode the plot")
+    return png.tobytes()
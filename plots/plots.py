@@ -1,28 +1,150 @@
+import asyncio
+import io
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Optional
 
-import matplotlib.pyplot as plt
-import seaborn as sns
+from dotenv import load_dotenv
+from loguru import logger
 
-from db import models
+from db import asyncmodels, models
 
+load_dotenv()
+
+PLOT_DPI = int(os.environ.get("PLOT_DPI", 100))
+# opencv (plots/cvplot.py) or matplotlib (seaborn, only imported when used: it's slow to import and heavy)
+PLOT_RENDERER = os.environ.get("PLOT_RENDERER", "opencv")
+
+# pyplot isn't thread safe: every plot is rendered on this thread, off the event loop
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plots")
+
+
+class PlotCache:
+    """Rendered plots (PNG bytes) by key, least recently used ones are dropped first"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+        # Metrics
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return self._entries[key]
+            self._misses += 1
+            return None
+
+    def put(self, key: tuple, png: bytes) -> None:
+        with self._lock:
+            self._entries[key] = png
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+
+# History plots by (user_id, latest ogmessage_id): a new bread changes the key, /rescore clears it
+plotcache = PlotCache(max_entries=int(os.environ.get("PLOT_CACHE_SIZE", 256)))
+
+
+def render_roundness_history(data: list[tuple[int, float]], dpi: int = PLOT_DPI) -> bytes:
+    """Renders the roundness history plot with PLOT_RENDERER (falls back to matplotlib without OpenCV)
+
+    Args:
+        data (list[tuple[int, float]]): (X, Y) values, Y being the roundness (0 to 1)
+        dpi (int, optional): Resolution, 100 is 1200x700. Defaults to PLOT_DPI.
+
+    Returns:
+        bytes: PNG image
+    """
+    if PLOT_RENDERER == "opencv":
+        try:
+            from plots import cvplot
+        except ImportError as e:
+            logger.warning(f"OpenCV plots not available ({e}), using matplotlib")
+        else:
+            return cvplot.render_roundness_history(data, scale=dpi / 100)
+    return render_roundness_history_matplotlib(data, dpi=dpi)
+
+
+def render_roundness_history_matplotlib(data: list[tuple[int, float]], dpi: int = PLOT_DPI) -> bytes:
+    """Renders the roundness history plot with seaborn
+
+    Args:
+        data (list[tuple[int, float]]): (X, Y) values, Y being the roundness (0 to 1)
+        dpi (int, optional): Resolution. Defaults to PLOT_DPI.
+
+    Returns:
+        bytes: PNG image
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")  # Render to memory, no GUI backend
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
-def plot_roundness_by_user(user_id: int) -> str:
-    # Data: list of tuples with (X, Y) values
-    data = models.get_roundness_history(user_id)
     x_values, y_values = zip(*data)
     # Scale Y values to percentages
     y_values_percent = [y * 100 for y in y_values]
 
     sns.set(style="darkgrid", context="talk")
-    plt.figure(figsize=(12, 7))
-    sns.lineplot(x=x_values, y=y_values_percent, marker="o", color="teal", linewidth=2.5, linestyle="--")
-    sns.scatterplot(x=x_values, y=y_values_percent, color="orange", s=100, zorder=5)
+    fig = plt.figure(figsize=(12, 7))
+    try:
+        sns.lineplot(x=x_values, y=y_values_percent, marker="o", color="teal", linewidth=2.5, linestyle="--")
+        sns.scatterplot(x=x_values, y=y_values_percent, color="orange", s=100, zorder=5)
+
+        # Set the plot labels and title
+        plt.xlabel("X", fontsize=14, fontweight="bold")
+        plt.ylabel("Y (%)", fontsize=14, fontweight="bold")
+        plt.title("Amazing roundness history for User", fontsize=18, fontweight="bold")
+
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=dpi, bbox_inches="tight")
+    finally:
+        plt.close(fig)  # Figures are kept by pyplot until closed
+    return buffer.getvalue()
+
+
+async def roundness_history_png(user_id: int) -> Optional[bytes]:
+    """History plot of a user, rendered on the plots thread or taken from the cache if they have no new breads
+
+    Args:
+        user_id (int): Discord user id
+
+    Returns:
+        Optional[bytes]: PNG image, None if the user has no roundness history
+    """
+    latest = await asyncmodels.get_latest_roundness_ogmessage_id(user_id)
+    if latest is None:
+        return None
+    key = (user_id, latest)
+    png = plotcache.get(key)
+    if png is None:
+        history = await asyncmodels.get_roundness_history(user_id)
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(_executor, render_roundness_history, history)
+        plotcache.put(key, png)
+    return png
+
 
-    # Set the plot labels and title
-    plt.xlabel("X", fontsize=14, fontweight="bold")
-    plt.ylabel("Y (%)", fontsize=14, fontweight="bold")
-    plt.title("Amazing roundness history for User", fontsize=18, fontweight="bold")
+def plot_roundness_by_user(user_id: int, data: list[tuple[int, float]] = None) -> str:
+    # Data: list of tuples with (X, Y) values, fetched here if the caller didn't already
+    if data is None:
+        data = models.get_roundness_history(user_id)
 
     # Save the plot as a PNG image
     outputfolder = os.path.join(os.getcwd(), "output", "plots")
@@ -30,7 +152,8 @@ def plot_roundness_by_user(user_id: int) -> str:
 
     filename = f"{user_id}_roundhistory.png"
     output_img_path = os.path.join(outputfolder, filename)
-    plt.savefig(output_img_path, dpi=300, bbox_inches="tight")
+    with open(output_img_path, "wb") as f:
+        f.write(render_roundness_history(data, dpi=300))
     return output_img_path
 
 